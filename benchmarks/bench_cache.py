@@ -0,0 +1,291 @@
+"""
+Measures throughput and p50/p99 latency of SimpleCache and cache_it
+operations, writing the results as JSON so runs can be compared between
+commits.
+
+A throwaway redis-server is started on a free port if one is on the PATH
+(or given with --redis-server); --port uses an already running server
+instead, and --backend fakeredis an in-process stand-in (fakeredis, with
+lupa for the Lua scripts). --backend memory and --backend shared benchmark
+the cache's own MemoryBackend and SharedMemoryBackend (see
+redis_cache/backends.py), the latter on a throwaway database.
+
+    python benchmarks/bench_cache.py [--value-sizes 100,10000] [--keys 1000]
+        [--ops 5000] [--concurrency 1,8] [--output results.json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis
+
+from redis_cache import SimpleCache, cache_it
+from redis_cache.backends import DEFAULT_SHARED_PATH, MemoryBackend, SharedMemoryBackend
+
+clock = getattr(time, 'perf_counter', time.time)
+
+BENCHMARKS = ('store', 'get', 'mget', 'store_json', 'get_json', 'store_pickle',
+              'get_pickle', 'cache_it_hit', 'cache_it_miss', 'store_evicting')
+
+
+def _which(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_redis_server(executable):
+    """
+    Starts a redis-server without persistence on a free port.
+    :return: (process, port)
+    """
+    port = _free_port()
+    process = subprocess.Popen(
+        [executable, '--port', str(port), '--bind', '127.0.0.1', '--save', '',
+         '--appendonly', 'no'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    client = redis.StrictRedis(port=port)
+    deadline = time.time() + 10
+    while True:
+        try:
+            client.ping()
+            return process, port
+        except redis.ConnectionError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise RuntimeError("redis-server didn't start")
+            time.sleep(0.05)
+
+
+class Backend(object):
+    """
+    Creates caches connected to the benchmarked server.
+    """
+    def __init__(self, args):
+        self.process = None
+        self.name = args.backend
+        self.host, self.port = args.host, args.port
+        if self.name == 'auto':
+            executable = args.redis_server or _which('redis-server')
+            if args.port:
+                self.name = 'server'
+            elif executable:
+                self.name = 'redis-server'
+            else:
+                self.name = 'fakeredis'
+        if self.name == 'redis-server':
+            executable = args.redis_server or _which('redis-server')
+            if not executable:
+                raise SystemExit("redis-server not found, use --redis-server or --port")
+            self.process, self.port = start_redis_server(executable)
+            self.host = '127.0.0.1'
+        elif self.name == 'fakeredis':
+            try:
+                import fakeredis
+            except ImportError:
+                raise SystemExit("Neither redis-server nor fakeredis is available")
+            self.fake_server = fakeredis.FakeServer()
+            self.fakeredis = fakeredis
+        elif self.name == 'memory':
+            self.backend = MemoryBackend()
+        elif self.name == 'shared':
+            self.backend = SharedMemoryBackend('%s.bench-%d' % (DEFAULT_SHARED_PATH, os.getpid()))
+
+    def cache(self, limit, namespace):
+        if self.name in ('memory', 'shared'):
+            return SimpleCache(limit, namespace=namespace, backend=self.backend)
+        cache = SimpleCache(limit, namespace=namespace, host=self.host, port=self.port)
+        if self.name == 'fakeredis':
+            cache.connection = self.fakeredis.FakeStrictRedis(server=self.fake_server)
+        return cache
+
+    def info(self):
+        if self.name in ('fakeredis', 'memory', 'shared'):
+            return {'backend': self.name}
+        client = redis.StrictRedis(host=self.host, port=self.port)
+        return {'backend': self.name,
+                'redis_version': client.info('server').get('redis_version')}
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        if self.name == 'shared':
+            self.backend.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.backend.path + suffix):
+                    os.remove(self.backend.path + suffix)
+
+
+def run(operation, ops, concurrency):
+    """
+    Calls operation(i) for i in range(ops), spread over `concurrency`
+    threads, timing every call.
+    :return: dict of throughput and latency percentiles
+    """
+    latencies = [[] for _ in range(concurrency)]
+
+    def worker(n):
+        timings = latencies[n]
+        for i in range(n, ops, concurrency):
+            start = clock()
+            operation(i)
+            timings.append(clock() - start)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    timings = sorted(t for thread_timings in latencies for t in thread_timings)
+    return {
+        'ops': ops,
+        'seconds': round(elapsed, 6),
+        'ops_per_sec': round(ops / elapsed, 1),
+        'p50_us': round(timings[len(timings) // 2] * 1e6, 1),
+        'p99_us': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6, 1),
+    }
+
+
+def payload(size):
+    """
+    Returns a json/pickle friendly payload of about `size` bytes.
+    """
+    return {'id': 1, 'name': 'x' * max(0, size - 30), 'active': True}
+
+
+def benchmarks(backend, size, args):
+    """
+    Yields (name, operation, ops) for every benchmark, after setting up
+    its data, so any benchmark can run on its own.
+    """
+    keys = ['key:%d' % i for i in range(args.keys)]
+    value = 'v' * size
+    data = payload(size)
+    cache = backend.cache(0, 'bench-%d' % size)
+    cache.flush()
+
+    yield 'store', lambda i: cache.store(keys[i % args.keys], value), args.ops
+    cache.store_many((key, value) for key in keys)
+    yield 'get', lambda i: cache.get(keys[i % args.keys]), args.ops
+    mget_keys = [keys[i:i + args.mget_size] for i in range(0, args.keys, args.mget_size)]
+    yield 'mget', lambda i: cache.mget(mget_keys[i % len(mget_keys)]), \
+        max(1, args.ops // args.mget_size)
+    yield 'store_json', lambda i: cache.store_json(keys[i % args.keys], data), args.ops
+    cache.store_many_json((key, data) for key in keys)
+    yield 'get_json', lambda i: cache.get_json(keys[i % args.keys]), args.ops
+    yield 'store_pickle', lambda i: cache.store_pickle(keys[i % args.keys], data), args.ops
+    cache.store_many_pickle((key, data) for key in keys)
+    yield 'get_pickle', lambda i: cache.get_pickle(keys[i % args.keys]), args.ops
+
+    @cache_it(cache=cache)
+    def cached(i):
+        return data
+    for i in range(args.keys):
+        cached(i)
+    yield 'cache_it_hit', lambda i: cached(i % args.keys), args.ops
+    yield 'cache_it_miss', lambda i: cached(args.keys + i), args.ops
+    cache.flush()
+
+    # Stores into a full cache, each of them evicting a key
+    full = backend.cache(args.keys, 'bench-full-%d' % size)
+    full.flush()
+    full.store_many((key, value) for key in keys)
+    yield 'store_evicting', lambda i: full.store('new:%d' % i, value), args.ops
+    full.flush()
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--value-sizes', type=_int_list, default=[100, 10000],
+                        help='comma separated value sizes in bytes')
+    parser.add_argument('--keys', type=int, default=1000,
+                        help='number of distinct keys, also the limit of the full cache')
+    parser.add_argument('--ops', type=int, default=5000,
+                        help='operations per measurement')
+    parser.add_argument('--mget-size', type=int, default=100,
+                        help='keys per mget')
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 8],
+                        help='comma separated numbers of threads')
+    parser.add_argument('--only', default=','.join(BENCHMARKS),
+                        help='comma separated benchmarks to run')
+    parser.add_argument('--backend', default='auto',
+                        choices=['auto', 'redis-server', 'server', 'fakeredis',
+                                 'memory', 'shared'])
+    parser.add_argument('--redis-server', help='path of the redis-server to start')
+    parser.add_argument('--host', default='localhost',
+                        help='host of a running server (with --port)')
+    parser.add_argument('--port', type=int, help='port of a running server to use')
+    parser.add_argument('--output', help='JSON file to write, stdout by default')
+    args = parser.parse_args()
+    only = set(args.only.split(','))
+
+    backend = Backend(args)
+    try:
+        results = []
+        for size in args.value_sizes:
+            for concurrency in args.concurrency:
+                for name, operation, ops in benchmarks(backend, size, args):
+                    if name not in only:
+                        continue
+                    result = run(operation, ops, concurrency)
+                    result.update(name=name, value_size=size, concurrency=concurrency)
+                    results.append(result)
+                    print('{0:<16} {1:>7}B x{2:<3} {3:>10.0f} ops/s  p50 {4:>8.1f}us  '
+                          'p99 {5:>8.1f}us'.format(name, size, concurrency,
+                                                   result['ops_per_sec'],
+                                                   result['p50_us'], result['p99_us']),
+                          file=sys.stderr)
+        report = {
+            'meta': dict(backend.info(), commit=_git_commit(),
+                         python=platform.python_version(),
+                         redis_py=redis.__version__,
+                         keys=args.keys, ops=args.ops, mget_size=args.mget_size),
+            'results': results,
+        }
+    finally:
+        backend.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Measures the redis memory used per entry by SimpleCache and BucketedCache
+for small values, writing the results as JSON.
+
+Needs a real server (memory use of fakeredis means nothing): a throwaway
+redis-server is started on a free port if one is on the PATH (or given with
+--redis-server), or --port uses an already running server, which should be
+otherwise empty.
+
+    python benchmarks/bench_memory.py [--entries 100000] [--value-sizes 10,40]
+        [--output results.json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import redis
+
+from bench_cache import Backend, _git_commit, _int_list
+from redis_cache.buckets import BUCKET_FILL, BucketedCache
+
+
+def used_memory(client):
+    return client.info('memory')['used_memory']
+
+
+def measure(backend, kind, entries, size, expire):
+    """
+    Fills a cache of `kind` with `entries` values of `size` bytes, without
+    a limit so that nothing is evicted.
+    :return: dict of the memory used in total and per entry
+    """
+    client = redis.StrictRedis(host=backend.host, port=backend.port)
+    namespace = 'bench-memory-%s-%d' % (kind, size)
+    if kind == 'bucketed':
+        cache = BucketedCache(0, namespace=namespace, expire=expire,
+                              buckets=int(math.ceil(entries / float(BUCKET_FILL))),
+                              host=backend.host, port=backend.port)
+    else:
+        cache = backend.cache(0, namespace)
+        cache.expire = expire
+    cache.flush()
+    before = used_memory(client)
+    value = 'v' * size
+    keys = ('key:%d' % i for i in range(entries))
+    cache.store_many((key, value) for key in keys)
+    used = used_memory(client) - before
+    cache.flush()
+    result = {'cache': kind, 'entries': entries, 'value_size': size,
+              'used_memory': used, 'bytes_per_entry': round(used / float(entries), 1)}
+    if kind == 'bucketed':
+        result.update(buckets=cache.buckets, field_ttl=cache.field_ttl)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--value-sizes', type=_int_list, default=[10, 40],
+                        help='comma separated value sizes in bytes')
+    parser.add_argument('--expire', type=int, default=3600,
+                        help='ttl of the entries, 0 for none')
+    parser.add_argument('--backend', default='auto',
+                        choices=['auto', 'redis-server', 'server'])
+    parser.add_argument('--redis-server', help='path of the redis-server to start')
+    parser.add_argument('--host', default='localhost',
+                        help='host of a running server (with --port)')
+    parser.add_argument('--port', type=int, help='port of a running server to use')
+    parser.add_argument('--output', help='JSON file to write, stdout by default')
+    args = parser.parse_args()
+
+    backend = Backend(args)
+    if backend.name == 'fakeredis':
+        raise SystemExit("bench_memory needs redis-server or --port")
+    try:
+        results = []
+        for size in args.value_sizes:
+            for kind in ('simple', 'bucketed'):
+                result = measure(backend, kind, args.entries, size, args.expire)
+                results.append(result)
+                print('{0:<9} {1:>5}B {2:>10.1f} bytes/entry'.format(
+                    kind, size, result['bytes_per_entry']), file=sys.stderr)
+        report = {
+            'meta': dict(backend.info(), commit=_git_commit(),
+                         python=platform.python_version(),
+                         redis_py=redis.__version__, expire=args.expire),
+            'results': results,
+        }
+    finally:
+        backend.close()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures the per-call cost of building cache_it keys, comparing the former
+pickle + md5 + str.format keys with KeyBuilder. Doesn't need a redis server.
+
+    python benchmarks/keys.py [--number 100000] [--repeat 5]
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redis_cache.rediscache import KEY_HASHES, KeyBuilder
+
+CALLS = {
+    'no args': ((), {}),
+    'one int': ((42,), {}),
+    'str + kwargs': (('user:42',), {'limit': 10, 'offset': 20}),
+    'tuple args': ((1, 2.5, 'abc', (4, 5), None), {}),
+    'list arg': (([1, 2, 3, 4, 5, 6, 7, 8, 9, 10],), {}),
+}
+
+
+def function():
+    pass
+
+
+def legacy_key(args, kwargs, namespace='bench'):
+    """
+    cache_it keys as built before KeyBuilder, with hashkeys set.
+    """
+    key = hashlib.md5(pickle.dumps([args, kwargs])).hexdigest()
+    cache_key = '{func_name}:{key}'.format(func_name=function.__name__, key=key)
+    return '{namespace}:{key}'.format(namespace=namespace, key=cache_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=100000,
+                        help='calls per measurement')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measurements per builder, the fastest being kept')
+    args = parser.parse_args()
+
+    builders = [('legacy md5', legacy_key),
+                ('canonical', KeyBuilder(function, 'bench'))]
+    for name in sorted(KEY_HASHES):
+        builders.append((name, KeyBuilder(function, 'bench', name)))
+
+    print('{0:<14}'.format('call') +
+          ''.join('{0:>14}'.format(name) for name, _ in builders) + '  (us/call)')
+    for call, (call_args, call_kwargs) in sorted(CALLS.items()):
+        timings = [min(timeit.repeat(lambda: builder(call_args, call_kwargs),
+                                     number=args.number, repeat=args.repeat))
+                   / args.number * 1e6 for _, builder in builders]
+        print('{0:<14}'.format(call) +
+              ''.join('{0:>14.2f}'.format(t) for t in timings))
+
+
+if __name__ == '__main__':
+    main()
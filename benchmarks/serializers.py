@@ -0,0 +1,58 @@
+"""
+Compares encode/decode time and encoded size of every registered format and
+compression on a few typical payloads. Doesn't need a redis server.
+
+    python benchmarks/serializers.py [--number 2000]
+"""
+from __future__ import print_function
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from redis_cache.serializers import Codec, compressions, formats
+
+PAYLOADS = {
+    'small dict': {'id': 42, 'name': 'Ada Lovelace', 'active': True},
+    'int list': list(range(1000)),
+    'records': [{'id': i, 'name': 'user %d' % i, 'score': i * 1.5,
+                 'tags': ['a', 'b', 'c']} for i in range(500)],
+    'text': 'lorem ipsum dolor sit amet ' * 400,
+}
+
+
+def bench(codec, payload, number):
+    try:
+        data = codec.dumps(payload)
+        assert codec.loads(data) == payload
+    except (TypeError, ValueError, AssertionError):
+        return None  # format can't round trip this payload
+    encode = timeit.timeit(lambda: codec.dumps(payload), number=number)
+    decode = timeit.timeit(lambda: codec.loads(data), number=number)
+    return encode / number * 1e6, decode / number * 1e6, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='iterations per measurement')
+    parser.add_argument('--compress-threshold', type=int, default=1024)
+    args = parser.parse_args()
+
+    print('{0:<12} {1:<8} {2:<6} {3:>12} {4:>12} {5:>10}'.format(
+        'payload', 'format', 'compr', 'encode (us)', 'decode (us)', 'bytes'))
+    for name, payload in sorted(PAYLOADS.items()):
+        for format in formats():
+            for compression in [None] + compressions():
+                codec = Codec(format, compression, args.compress_threshold)
+                result = bench(codec, payload, args.number)
+                if result is None:
+                    continue
+                print('{0:<12} {1:<8} {2:<6} {3:>12.1f} {4:>12.1f} {5:>10}'.format(
+                    name, format, compression or '-', *result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from rediscache import *
\ No newline at end of file
+from .rediscache import *
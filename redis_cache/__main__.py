@@ -0,0 +1,8 @@
+"""
+Snapshot command line tool, see snapshot.py:
+
+    python -m redis_cache export --namespace users users.snap.gz
+"""
+from .snapshot import main
+
+main()
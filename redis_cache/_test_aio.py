@@ -0,0 +1,93 @@
+#AsyncSimpleCache Tests (python 3.8+)
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Loaded by test_aio.py, as python 2 can't parse them.
+import asyncio
+from unittest import IsolatedAsyncioTestCase
+
+from redis_cache.aio import AsyncSimpleCache, cache_it, cache_it_json
+from redis_cache.rediscache import CacheMissException, ExpiredKeyException, SimpleCache
+
+
+class AsyncSimpleCacheTest(IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.c = AsyncSimpleCache(10, namespace="AsyncSimpleCache")
+
+    async def test_store_retrieve(self):
+        await self.c.store("foo", "bar")
+        self.assertEqual(await self.c.get("foo"), b"bar")
+
+    async def test_json_pickle(self):
+        await self.c.store_json("json", {"example": "data"})
+        await self.c.store_pickle("pickle", (3, 4))
+        self.assertEqual(await self.c.get_json("json"), {"example": "data"})
+        self.assertEqual(await self.c.get_pickle("pickle"), (3, 4))
+
+    async def test_miss_and_expired(self):
+        with self.assertRaises(CacheMissException):
+            await self.c.get("blablabla")
+        await self.c.store("foo", "bar")
+        await self.c.expire_all_in_set()
+        with self.assertRaises(ExpiredKeyException):
+            await self.c.get("foo")
+
+    async def test_expired_values_are_uncounted(self):
+        c = AsyncSimpleCache(10, namespace="AsyncSimpleCacheBytes", max_bytes=1000)
+        await c.store("a", "aaa", expire=1)
+        await c.store("b", "bb", expire=1)
+        self.assertEqual(await c.used_bytes(), 5)
+        await asyncio.sleep(1.5)
+        with self.assertRaises(ExpiredKeyException):
+            await c.get("a")
+        self.assertEqual(await c.mget(["b"]), {})
+        self.assertEqual(await c.used_bytes(), 0)
+        self.assertEqual(await c.size(), 0)
+
+    async def test_bulk_and_chunked_values(self):
+        self.assertEqual(await self.c.store_many_pickle({"p1": (1, 2), "p2": [3]}), 2)
+        self.assertEqual(await self.c.mget_pickle(["p1", "p2", "p3"]), {"p1": (1, 2), "p2": [3]})
+        SimpleCache(10, namespace="AsyncSimpleCache").store_chunks(
+            "chunked", [b"x" * 10 for _ in range(20)])
+        self.assertEqual(await self.c.get("chunked"), b"x" * 200)
+        self.assertEqual(await self.c.mget(["chunked"]), {"chunked": b"x" * 200})
+
+    async def test_mget_invalidate(self):
+        await self.c.store("a1", "a")
+        await self.c.store("a2", "aa")
+        await self.c.invalidate("a2")
+        self.assertEqual(await self.c.mget(["a1", "a2"]), {"a1": b"a"})
+
+    async def test_cache_limit(self):
+        for i in range(20):
+            await self.c.store("foo%d" % i, "foobar")
+        self.assertEqual(await self.c.size(), 10)
+
+    async def test_flush_namespace(self):
+        await self.c.store("foo:one", "bir")
+        await self.c.store("fii", "bur")
+        await self.c.flush_namespace("foo")
+        self.assertEqual(await self.c.keys(), {b"fii"})
+
+    async def test_decorator_single_flight(self):
+        calls = []
+
+        @cache_it(cache=self.c)
+        async def slow_double(n):
+            calls.append(n)
+            await asyncio.sleep(0.1)
+            return n * 2
+
+        results = await asyncio.gather(*[slow_double(21) for _ in range(5)])
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(await slow_double(21), 42)
+        self.assertEqual(calls, [21])
+
+    async def test_decorator_json(self):
+        @cache_it_json(cache=self.c)
+        async def add_it(a, b=10):
+            return {"sum": a + b}
+        self.assertEqual(await add_it(3), {"sum": 13})
+        self.assertEqual(await add_it(3), {"sum": 13})
+
+    async def asyncTearDown(self):
+        await self.c.flush()
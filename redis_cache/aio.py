@@ -0,0 +1,496 @@
+"""
+asyncio counterparts of SimpleCache and cache_it.
+Requires Python 3.6+ and redis-py 4.2+ (pip install redis-simple-cache[asyncio]).
+Entries are stored with the same layout as SimpleCache, so sync and async
+code can share a namespace.
+"""
+from functools import wraps
+import asyncio
+import json
+import logging
+import pickle
+import weakref
+
+import redis
+from redis import asyncio as aioredis
+from redis.exceptions import NoScriptError
+
+from .rediscache import (BaseCache, BulkProgress, CacheMissException,
+                         DEFAULT_EXPIRY, DELETE_SCRIPT, DoNotCache,
+                         EVICTION_POLICIES, ExpiredKeyException, FETCH_SCRIPT,
+                         REAP_SCRIPT, STORE_SCRIPT, _chunk_manifest,
+                         _glob_escape, _key_builder, _size, to_unicode)
+
+# asyncio connections are bound to the event loop they were created in, so
+# pools are shared per loop, and per connection configuration within a loop.
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_connection_pool(**kwargs):
+    """
+    Returns the pool of the running event loop for this configuration.
+    """
+    loop_pools = _pools.setdefault(asyncio.get_event_loop(), {})
+    key = tuple(sorted(kwargs.items()))
+    pool = loop_pools.get(key)
+    if pool is None:
+        pool = loop_pools[key] = aioredis.ConnectionPool(**kwargs)
+    return pool
+
+
+async def _coalesce(inflight, key, factory):
+    """
+    Awaits factory() for `key`, sharing a single in-flight call between all
+    concurrent callers with the same key.
+    """
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        inflight[key] = future
+        future.add_done_callback(lambda f: inflight.pop(key, None))
+    # shield so a cancelled caller doesn't cancel the lookup for the others
+    return await asyncio.shield(future)
+
+
+class AsyncSimpleCache(BaseCache):
+    """
+    Same API as SimpleCache with coroutine methods. len(), `in` and
+    iteration can't be awaited, use size(), contains() and keys() instead.
+    Concurrent gets of the same key share a single redis lookup. Values
+    chunked by SimpleCache.store_chunks are joined on read, but can only be
+    written by SimpleCache.
+    Orphans of namespace generations are cleaned up with the synchronous
+    SimpleCache.cleanup_generations().
+    """
+    def __init__(self,
+                 limit=10000,
+                 expire=DEFAULT_EXPIRY,
+                 hashkeys=False,
+                 host=None,
+                 port=None,
+                 db=None,
+                 password=None,
+                 namespace="SimpleCache",
+                 publish_invalidations=True,
+                 eviction_policy='random',
+                 eviction_batch=1,
+                 unix_socket_path=None,
+                 max_connections=None,
+                 socket_timeout=None,
+                 socket_connect_timeout=None,
+                 socket_keepalive=None,
+                 namespace_generations=False,
+                 max_bytes=None):
+
+        self.limit = limit
+        self.expire = expire
+        self.prefix = namespace
+        self.host = host if host else 'localhost'
+        self.port = port if port else 6379
+        self.db = db if db else 0
+        self.hashkeys = hashkeys
+        self.publish_invalidations = publish_invalidations
+        self.namespace_generations = namespace_generations
+        self.max_bytes = max_bytes
+
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError("eviction_policy must be one of {0}".format(
+                ', '.join(EVICTION_POLICIES)))
+        self.eviction_policy = eviction_policy
+        self.eviction_batch = eviction_batch
+
+        self.pool_kwargs = {'db': self.db, 'password': password}
+        if unix_socket_path:
+            self.pool_kwargs['connection_class'] = aioredis.UnixDomainSocketConnection
+            self.pool_kwargs['path'] = unix_socket_path
+        else:
+            self.pool_kwargs['host'] = self.host
+            self.pool_kwargs['port'] = self.port
+            if socket_connect_timeout is not None:
+                self.pool_kwargs['socket_connect_timeout'] = socket_connect_timeout
+            if socket_keepalive is not None:
+                self.pool_kwargs['socket_keepalive'] = socket_keepalive
+        if max_connections is not None:
+            self.pool_kwargs['max_connections'] = max_connections
+        if socket_timeout is not None:
+            self.pool_kwargs['socket_timeout'] = socket_timeout
+
+        self._inflight = {}
+
+    @property
+    def connection(self):
+        return aioredis.StrictRedis(
+            connection_pool=get_async_connection_pool(**self.pool_kwargs))
+
+    async def _run_script(self, script, keys, args):
+        connection = self.connection
+        try:
+            return await connection.evalsha(script.sha, len(keys), *(keys + args))
+        except NoScriptError:
+            return await connection.eval(script.source, len(keys), *(keys + args))
+
+    async def _store_items(self, items):
+        """
+        Stores a list of (key, value, expire) items in a single round trip.
+        :return: int, number of values written (not those over max_bytes)
+        """
+        if self.max_bytes:
+            too_large = [key for key, value, _ in items if _size(value) > self.max_bytes]
+            if too_large:
+                logging.warning("redis-simple-cache: not storing %r, larger than max_bytes",
+                                too_large)
+                items = [item for item in items if _size(item[1]) <= self.max_bytes]
+        if items:
+            await self._run_script(STORE_SCRIPT, *self._store_script_args(items))
+        return len(items)
+
+    async def store(self, key, value, expire=None):
+        await self._store_items([(key, value, expire)])
+
+    async def store_json(self, key, value, expire=None):
+        await self.store(key, json.dumps(value), expire)
+
+    async def store_pickle(self, key, value, expire=None):
+        await self.store(key, pickle.dumps(value), expire)
+
+    async def store_many(self, mapping, expire=None, chunk_size=1000):
+        """
+        Stores many values, one round trip per `chunk_size` values.
+        :param mapping: dict (or iterable of pairs) of keys and values
+        :param expire: time-to-live (ttl) for these data
+        :param chunk_size: number of values per round trip
+        :return: int, number of values stored, not counting those larger than
+            max_bytes
+        """
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        stored = 0
+        items = []
+        for key, value in mapping:
+            items.append((key, value, expire))
+            if len(items) >= chunk_size:
+                stored += await self._store_items(items)
+                items = []
+        return stored + await self._store_items(items)
+
+    async def store_many_json(self, mapping, expire=None, chunk_size=1000):
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        return await self.store_many(((k, json.dumps(v)) for k, v in mapping),
+                                     expire, chunk_size)
+
+    async def store_many_pickle(self, mapping, expire=None, chunk_size=1000):
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        return await self.store_many(((k, pickle.dumps(v)) for k, v in mapping),
+                                     expire, chunk_size)
+
+    async def _get(self, key):
+        connection = self.connection
+        if self.namespace_generations:
+            value = (await self._run_script(FETCH_SCRIPT,
+                                            *self._fetch_script_args([key])))[0]
+        elif self.eviction_policy in ('lru', 'lfu'):
+            pipe = connection.pipeline(transaction=False)
+            pipe.get(self.make_key(key))
+            self._track_access(pipe, [key])
+            value = (await pipe.execute())[0]
+        else:
+            value = await connection.get(self.make_key(key))
+        if value is None:
+            if not await self.contains(key):
+                raise CacheMissException
+            await self._reap([key])
+            raise ExpiredKeyException
+        manifest = _chunk_manifest(value)
+        if manifest is not None:
+            value = await self._join_chunks(manifest)
+        return value
+
+    async def _join_chunks(self, manifest, batch=8):
+        """
+        Returns the value of a parsed chunk manifest, fetching `batch` chunks
+        per round trip.
+        """
+        count, length, base = manifest
+        chunks = []
+        for start in range(0, count, batch):
+            names = [base + b':' + str(i).encode('ascii')
+                     for i in range(start, min(count, start + batch))]
+            chunks.extend(await self.connection.mget(names))
+            if None in chunks:  # expired or invalidated meanwhile
+                raise ExpiredKeyException
+        value = b''.join(chunks)
+        if len(value) != length:
+            raise ExpiredKeyException
+        return value
+
+    async def get(self, key):
+        key = to_unicode(key)
+        if key:
+            return await _coalesce(self._inflight, key, lambda: self._get(key))
+
+    async def get_json(self, key):
+        return json.loads(await self.get(key))
+
+    async def get_pickle(self, key):
+        return pickle.loads(await self.get(key))
+
+    async def mget(self, keys):
+        """
+        Method returns a dict of key/values for found keys.
+        :param keys: array of keys to look up in Redis
+        :return: dict of found key/values
+        """
+        if keys:
+            connection = self.connection
+            if self.namespace_generations:
+                values = await self._run_script(FETCH_SCRIPT, *self._fetch_script_args(
+                    [to_unicode(key) for key in keys]))
+            elif self.eviction_policy in ('lru', 'lfu'):
+                pipe = connection.pipeline(transaction=False)
+                pipe.mget([self.make_key(to_unicode(key)) for key in keys])
+                self._track_access(pipe, [to_unicode(key) for key in keys])
+                values = (await pipe.execute())[0]
+            else:
+                values = await connection.mget([self.make_key(to_unicode(key))
+                                                for key in keys])
+
+            missing = [to_unicode(k) for (k, v) in zip(keys, values) if v is None]
+            if missing:  # non-existant or expired keys
+                await self._reap(missing)
+
+            found = {}
+            for key, value in zip(keys, values):
+                if value is not None:
+                    manifest = _chunk_manifest(value)
+                    if manifest is not None:
+                        try:
+                            value = await self._join_chunks(manifest)
+                        except ExpiredKeyException:
+                            continue
+                    found[key] = value
+            return found
+
+    async def _reap(self, keys):
+        # Only unindexes keys whose value is gone, forgetting their sizes
+        return await self._run_script(REAP_SCRIPT, *self._reap_script_args(keys))
+
+    async def mget_json(self, keys):
+        d = await self.mget(keys)
+        if d:
+            for key in d.keys():
+                d[key] = json.loads(d[key]) if d[key] else None
+            return d
+
+    async def mget_pickle(self, keys):
+        d = await self.mget(keys)
+        if d:
+            for key in d.keys():
+                d[key] = pickle.loads(d[key])
+            return d
+
+    async def invalidate(self, key):
+        key = to_unicode(key)
+        await self._run_script(DELETE_SCRIPT,
+                               *self._delete_script_args([key], True, 'key', key))
+
+    async def _data_key(self, key):
+        key = to_unicode(key)
+        if self.namespace_generations and ':' in key:
+            namespace = key.split(':', 1)[0]
+            return self._generation_key(
+                key, await self.connection.get(self.get_generation_name(namespace)))
+        return self.make_key(key)
+
+    async def isexpired(self, key):
+        ttl = await self.connection.pttl(await self._data_key(key))
+        if ttl in (-1, -2):
+            return True
+        return ttl
+
+    async def contains(self, key):
+        return await self.connection.sismember(self.get_set_name(), key)
+
+    async def size(self):
+        return await self.connection.scard(self.get_set_name())
+
+    async def keys(self):
+        return await self.connection.smembers(self.get_set_name())
+
+    async def used_bytes(self):
+        """
+        Returns the bytes of values counted against max_bytes. Values that
+        expire are only uncounted once missed by a get.
+        """
+        return int(await self.connection.get(self.get_bytes_name()) or 0)
+
+    async def expire_all_in_set(self, chunk_size=1000, rate_limit=None):
+        """
+        Deletes the values of every key in the set, leaving the set itself so
+        that gets raise ExpiredKeyException. Run it as a task to have it
+        proceed in the background.
+        :return: int, int
+        """
+        progress = await self._bulk_delete(False, chunk_size, rate_limit)
+        return await self.size(), progress.deleted
+
+    async def _bulk_delete(self, unindex, chunk_size, rate_limit):
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        progress = BulkProgress()
+        connection = self.connection
+        cursor = 0
+        while True:
+            cursor, members = await connection.sscan(self.get_set_name(), cursor,
+                                                     count=chunk_size)
+            if members:
+                progress.deleted += await self._run_script(
+                    DELETE_SCRIPT, *self._delete_script_args(
+                        [to_unicode(m) for m in members], unindex, None))
+                progress.scanned += len(members)
+            if int(cursor) == 0:
+                break
+            if rate_limit:
+                await asyncio.sleep(max(0, started + progress.scanned / rate_limit
+                                        - loop.time()))
+        pipe = connection.pipeline()
+        self._publish_invalidation(pipe, 'all')
+        await pipe.execute()
+        progress.finished.set()
+        return progress
+
+    async def _delete_matching(self, pattern):
+        connection = self.connection
+        deleted = 0
+        batch = []
+        async for key in connection.scan_iter(match=pattern, count=1000):
+            batch.append(key)
+            if len(batch) >= 1000:
+                deleted += await connection.delete(*batch)
+                batch = []
+        if batch:
+            deleted += await connection.delete(*batch)
+        return deleted
+
+    async def _scan_namespace(self, namespace, handle, count=1000):
+        """
+        Awaits handle(keys) on the keys of `namespace` in the key set, read
+        with SSCAN, `count` at a time.
+        :return: int, sum of the results of handle
+        """
+        total = 0
+        batch = []
+        async for member in self.connection.sscan_iter(
+                self.get_set_name(), match=_glob_escape(namespace) + ':*', count=count):
+            batch.append(to_unicode(member))
+            if len(batch) >= count:
+                total += await handle(batch)
+                batch = []
+        if batch:
+            total += await handle(batch)
+        return total
+
+    async def expire_namespace(self, namespace):
+        """
+        Deletes the values of every key in `namespace`, read from the key set
+        with SSCAN rather than KEYS so the server isn't blocked, with the
+        delete script so their sizes are forgotten too, or increments the
+        namespace's generation with namespace generations (the count is then
+        None).
+        :return: int, int
+        """
+        pipe = self.connection.pipeline()
+        if self.namespace_generations:
+            deleted = None
+            pipe.incr(self.get_generation_name(namespace))
+        else:
+            deleted = await self._scan_namespace(namespace, lambda members: self._run_script(
+                DELETE_SCRIPT, *self._delete_script_args(members, False, None)))
+        self._publish_invalidation(pipe, 'prefix', namespace + ':')
+        await pipe.execute()
+        return await self.size(), deleted
+
+    async def flush(self, chunk_size=1000, rate_limit=None):
+        """
+        Removes every key of this cache, `chunk_size` keys per round trip.
+        :return: BulkProgress
+        """
+        return await self._bulk_delete(True, chunk_size, rate_limit)
+
+    async def flush_namespace(self, space):
+        pipe = self.connection.pipeline()
+        if self.namespace_generations:
+            pipe.incr(self.get_generation_name(space))
+        self._publish_invalidation(pipe, 'prefix', space + ':')
+        await pipe.execute()
+        if not self.namespace_generations:
+            await self._delete_matching(
+                _glob_escape(self.make_key(space + ':')) + '*')
+        await self._scan_namespace(space, self._reap)
+
+
+def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
+             use_json=False, namespace=None, key_hash=None, key_func=None):
+    """
+    Decorator for `async def` functions. Concurrent calls with the same
+    arguments share one cache lookup and, on a miss, one computation.
+    Arguments and function result must be pickleable.
+    :param limit: maximum number of keys to maintain in the set
+    :param expire: period after which an entry in cache is considered expired
+    :param cache: AsyncSimpleCache object, if created separately
+    :param key_hash: name of the KEY_HASHES function hashing argument keys
+    :param key_func: function taking the decorated function's arguments and
+        returning their key
+    :return: decorated function
+    """
+    cache_, expire_ = cache, expire
+
+    def decorator(function):
+        cache, expire = cache_, expire_
+        if cache is None:
+            cache = AsyncSimpleCache(limit, expire, hashkeys=True,
+                                     namespace=function.__module__)
+        elif expire == DEFAULT_EXPIRY:
+            expire = None
+        fetcher = cache.get_json if use_json else cache.get_pickle
+        storer = cache.store_json if use_json else cache.store_pickle
+        key_builder = _key_builder(cache, function, namespace, key_hash, key_func)
+        inflight = {}
+
+        async def fetch_or_compute(cache_key, args, kwargs):
+            try:
+                return await fetcher(cache_key)
+            except (ExpiredKeyException, CacheMissException):
+                pass
+            except redis.RedisError:
+                logging.exception("Unknown redis-simple-cache error. Please check your Redis free space.")
+
+            try:
+                result = await function(*args, **kwargs)
+            except DoNotCache as e:
+                result = e.result
+            else:
+                try:
+                    await storer(cache_key, result, expire)
+                except redis.RedisError as e:
+                    logging.exception(e)
+            return result
+
+        @wraps(function)
+        async def func(*args, **kwargs):
+            cache_key = key_builder(args, kwargs)
+            return await _coalesce(inflight, cache_key,
+                                   lambda: fetch_or_compute(cache_key, args, kwargs))
+        func.cache_key = lambda *args, **kwargs: key_builder(args, kwargs)
+        return func
+    return decorator
+
+
+def cache_it_json(limit=10000, expire=DEFAULT_EXPIRY, cache=None, namespace=None,
+                  **kwargs):
+    """
+    Function result must be able to convert to JSON.
+    """
+    return cache_it(limit=limit, expire=expire, use_json=True,
+                    cache=cache, namespace=namespace, **kwargs)
@@ -0,0 +1,1474 @@
+"""
+Backends holding the data of a SimpleCache, picked with its `backend`
+argument. A backend is any object with the subset of the redis.StrictRedis
+API the caches use: string, set, sorted set and hash commands, expiry, SCAN,
+pipelines, pub/sub and EVALSHA of the cache's scripts. Besides redis itself
+(the default):
+
+* MemoryBackend keeps the data in dicts of the process, for single process
+  deployments and tests without a redis server.
+* SharedMemoryBackend keeps it in a sqlite database in shared memory
+  (/dev/shm) by default, memory mapped by every process of the host opening
+  it, so that co-located workers share one cache without a network hop.
+
+Both run the Python port of a script (see LuaScript.ported) in place of its
+Lua source, atomically, and reply like redis-py (bytes values, int counts,
+float scores), so the caches can't tell them from redis.
+"""
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from functools import wraps
+import hashlib
+import heapq
+import os
+import random
+import re
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+import redis
+from redis.exceptions import NoScriptError
+
+try:
+    from queue import Empty, Queue
+except ImportError:  # python 2
+    from Queue import Empty, Queue
+
+try:
+    text_type, integer_types = unicode, (int, long)
+except NameError:  # python 3
+    text_type, integer_types = str, (int,)
+
+try:
+    _blob = buffer  # python 2 binds str as TEXT
+except NameError:  # python 3
+    _blob = bytes
+
+# Default database of SharedMemoryBackend, on tmpfs where there is one.
+DEFAULT_SHARED_PATH = os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+    'redis-simple-cache.sqlite3')
+
+# Seconds SharedMemoryBackend keeps published messages for its subscribers.
+MESSAGE_TTL = 60
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+
+# Prefix of the DUMP payloads of the backends, which only they can RESTORE.
+DUMP_MAGIC = b'\x00rsc-dump1:'
+
+# Python ports of the LuaScripts, by sha1 of their source.
+_ports = {}
+
+
+def register_port(sha, function):
+    """
+    Registers function(client, keys, args) as the port of the script whose
+    sha1 is `sha`, see LuaScript.ported.
+    """
+    _ports[sha] = function
+
+
+def _encode(value):
+    """
+    Encodes a key, value or argument to bytes, like redis-py does.
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+    if isinstance(value, bytearray):
+        return bytes(value)
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, float):
+        return repr(value).encode('ascii')
+    if isinstance(value, integer_types) and not isinstance(value, bool):
+        return str(value).encode('ascii')
+    raise redis.DataError("Invalid input of type: '{0}'. Convert to a bytes, string, "
+                          "int or float first.".format(type(value).__name__))
+
+
+def _score(value):
+    score = float(value)
+    if score != score:
+        raise redis.ResponseError("resulting score is not a number (NaN)")
+    return score
+
+
+def _seconds(ex=None, px=None):
+    """
+    Returns the ttl given as seconds or milliseconds (ints or timedeltas)
+    in seconds, or None.
+    """
+    if ex is not None:
+        seconds = ex.total_seconds() if isinstance(ex, timedelta) else float(ex)
+    elif px is not None:
+        seconds = (px.total_seconds() if isinstance(px, timedelta) else float(px)) / 1000
+    else:
+        return None
+    if seconds <= 0:
+        raise redis.ResponseError("invalid expire time in 'set' command")
+    return seconds
+
+
+def _range(length, start, end):
+    """
+    Returns the slice of a redis start/end (inclusive, possibly negative)
+    range over `length` items.
+    """
+    start, end = int(start), int(end)
+    if start < 0:
+        start = max(0, start + length)
+    if end < 0:
+        end += length
+    return slice(start, max(start, min(end, length - 1) + 1))
+
+
+def _slot(name):
+    return zlib.crc32(name) & 0xffffffff
+
+
+def _glob(pattern):
+    """
+    Compiles a redis glob pattern (*, ?, [...] and \\ escapes) into the
+    match function of a regular expression.
+    """
+    pattern = _encode(pattern)
+    regex, i = [], 0
+    while i < len(pattern):
+        char = pattern[i:i + 1]
+        i += 1
+        if char == b'\\' and i < len(pattern):
+            regex.append(re.escape(pattern[i:i + 1]))
+            i += 1
+        elif char == b'*':
+            regex.append(b'.*')
+        elif char == b'?':
+            regex.append(b'.')
+        elif char == b'[' and b']' in pattern[i:]:
+            parts = [b'[']
+            if pattern[i:i + 1] == b'^':
+                parts.append(b'^')
+                i += 1
+            while i < len(pattern) and pattern[i:i + 1] != b']':
+                char = pattern[i:i + 1]
+                if char == b'\\' and i + 1 < len(pattern):
+                    i += 1
+                    parts.append(re.escape(pattern[i:i + 1]))
+                elif char == b'-' and len(parts) > 1 and pattern[i + 1:i + 2] != b']':
+                    parts.append(b'-')
+                else:
+                    parts.append(re.escape(char))
+                i += 1
+            regex.append(b''.join(parts) + b']')
+            i += 1
+        else:
+            regex.append(re.escape(char))
+    return re.compile(b''.join(regex) + b'\\Z', re.S).match
+
+
+def _match(names, match):
+    if match is None:
+        return list(names)
+    matches = _glob(match)
+    return [name for name in names if matches(name)]
+
+
+def _scan_threshold(cursor):
+    """
+    SCAN cursors are crc32 slots plus one (0 being the start and the end),
+    so that a scan returns every element present throughout it, whatever
+    is added or removed meanwhile.
+    """
+    cursor = int(cursor)
+    return cursor - 1 if cursor else 0
+
+
+def _scan_chunk(names, cursor, count):
+    """
+    Returns the (cursor, names) of a SCAN-like chunk of about `count` of
+    `names`, in slot order.
+    """
+    threshold = _scan_threshold(cursor)
+    slotted = [(_slot(name), name) for name in names]
+    slotted = [item for item in slotted if item[0] >= threshold]
+    if len(slotted) <= count:
+        return 0, [name for _, name in slotted]
+    last = heapq.nsmallest(count, [slot for slot, _ in slotted])[-1]
+    return last + 2, [name for slot, name in slotted if slot <= last]
+
+
+def _pack(parts):
+    return b''.join(struct.pack('>I', len(part)) + part for part in parts)
+
+
+def _unpack(data):
+    parts, position = [], 0
+    while position < len(data):
+        size, = struct.unpack('>I', data[position:position + 4])
+        parts.append(data[position + 4:position + 4 + size])
+        position += 4 + size
+    return parts
+
+
+def _command(method):
+    """
+    Runs a backend command atomically, after deleting the keys whose ttl
+    passed.
+    """
+    @wraps(method)
+    def command(self, *args, **kwargs):
+        with self.atomic():
+            self._expire_due()
+            return method(self, *args, **kwargs)
+    return command
+
+
+def _query(method):
+    """
+    Runs a read-only backend command atomically, without the write lock nor
+    the expiry sweep of _command: the keys whose ttl passed read as missing.
+    """
+    @wraps(method)
+    def query(self, *args, **kwargs):
+        with self.atomic(write=False):
+            return method(self, *args, **kwargs)
+    return query
+
+
+class Pipeline(object):
+    """
+    Queues the commands called on it and runs them atomically on execute,
+    like a redis-py pipeline.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def reset(self):
+        self.commands = []
+
+    def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        results = []
+        with self.backend.atomic():
+            for method, args, kwargs in commands:
+                try:
+                    results.append(method(*args, **kwargs))
+                except redis.ResponseError as e:
+                    results.append(e)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, redis.ResponseError):
+                    raise result
+        return results
+
+
+class Backend(object):
+    """
+    Base of the in-process backends, implementing the commands that derive
+    from others, scripts, DUMP/RESTORE and the SCAN iterators. Subclasses
+    provide atomic() and the primitive commands.
+    """
+    name = None
+
+    def __repr__(self):
+        return '{0}()'.format(type(self).__name__)
+
+    def atomic(self, write=True):
+        """
+        Returns a context manager running the commands called within it as
+        one atomic operation.
+
+        :param write: False if only read-only commands run within it.
+        """
+        raise NotImplementedError
+
+    def _expire_due(self):
+        pass
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def ping(self):
+        return True
+
+    def info(self, section=None):
+        return {'backend': self.name}
+
+    def close(self):
+        pass
+
+    def execute_command(self, *args):
+        command = _encode(args[0]).decode('ascii').lower()
+        if command == 'zadd':
+            return self._zadd_command(*args[1:])
+        method = getattr(self, command, None)
+        if method is None or command.startswith('_') or command in ('pipeline', 'pubsub'):
+            raise redis.ResponseError("unknown command '{0}'".format(args[0]))
+        return method(*args[1:])
+
+    def _zadd_command(self, name, *args):
+        args = list(args)
+        options = {}
+        while args and _encode(args[0]).upper() in (b'NX', b'XX', b'CH', b'INCR', b'GT', b'LT'):
+            options[_encode(args.pop(0)).decode('ascii').lower()] = True
+        mapping = OrderedDict((args[i + 1], args[i]) for i in range(0, len(args), 2))
+        return self.zadd(name, mapping, **options)
+
+    # Scripts
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        port = _ports.get(sha)
+        if port is None:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        keys_and_args = [_encode(arg) for arg in keys_and_args]
+        with self.atomic():
+            self._expire_due()
+            return port(self, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    def eval(self, script, numkeys, *keys_and_args):
+        sha = hashlib.sha1(_encode(script)).hexdigest()
+        if sha not in _ports:
+            raise redis.ResponseError("{0} only runs the scripts of redis_cache".format(
+                type(self).__name__))
+        return self.evalsha(sha, numkeys, *keys_and_args)
+
+    def script_load(self, script):
+        return hashlib.sha1(_encode(script)).hexdigest()
+
+    def script_flush(self, sync_type=None):
+        return True
+
+    # Commands derived from the primitive ones
+
+    def setex(self, name, time, value):
+        return self.set(name, value, ex=time)
+
+    def mget(self, keys, *args):
+        if isinstance(keys, (bytes, text_type)):
+            keys = [keys]
+        with self.atomic(write=False):
+            return [self.get(key) for key in list(keys) + list(args)]
+
+    def getrange(self, key, start, end):
+        value = self.get(key) or b''
+        return value[_range(len(value), start, end)]
+
+    def incr(self, name, amount=1):
+        return self.incrby(name, amount)
+
+    def decrby(self, name, amount=1):
+        return self.incrby(name, -amount)
+
+    def unlink(self, *names):
+        return self.delete(*names)
+
+    def expire(self, name, time):
+        if isinstance(time, timedelta):
+            time = time.total_seconds()
+        return self.pexpire(name, float(time) * 1000)
+
+    def ttl(self, name):
+        ttl = self.pttl(name)
+        return ttl if ttl < 0 else int((ttl + 500) // 1000)
+
+    def zincrby(self, name, amount, value):
+        return self.zadd(name, {value: amount}, incr=True)
+
+    def hmget(self, name, keys, *args):
+        if isinstance(keys, (bytes, text_type)):
+            keys = [keys]
+        with self.atomic(write=False):
+            return [self.hget(name, key) for key in list(keys) + list(args)]
+
+    def hexists(self, name, key):
+        return self.hget(name, key) is not None
+
+    def keys(self, pattern='*'):
+        return list(self.scan_iter(match=pattern, count=1000))
+
+    def scan_iter(self, match=None, count=None):
+        cursor = None
+        while cursor != 0:
+            cursor, names = self.scan(cursor or 0, match, count)
+            for name in names:
+                yield name
+
+    def sscan_iter(self, name, match=None, count=None):
+        cursor = None
+        while cursor != 0:
+            cursor, members = self.sscan(name, cursor or 0, match, count)
+            for member in members:
+                yield member
+
+    def hscan_iter(self, name, match=None, count=None):
+        cursor = None
+        while cursor != 0:
+            cursor, fields = self.hscan(name, cursor or 0, match, count)
+            for item in fields.items():
+                yield item
+
+    def dump(self, name):
+        """
+        Serializes a key in the backends' own format (not redis' RDB one).
+        """
+        with self.atomic(write=False):
+            kind = self.type(name)
+            if kind == b'none':
+                return None
+            if kind == b'string':
+                parts = [self.get(name)]
+            elif kind == b'set':
+                parts = sorted(self.smembers(name))
+            elif kind == b'hash':
+                parts = [part for item in sorted(self.hgetall(name).items()) for part in item]
+            else:
+                parts = [part for member, score in self.zrange(name, 0, -1, withscores=True)
+                         for part in (member, repr(score).encode('ascii'))]
+        return DUMP_MAGIC + kind + b':' + _pack(parts)
+
+    def restore(self, name, ttl, value, replace=False, absttl=False,
+                idletime=None, frequency=None):
+        if not value.startswith(DUMP_MAGIC):
+            raise redis.ResponseError("DUMP payload version or checksum are wrong")
+        kind, _, data = value[len(DUMP_MAGIC):].partition(b':')
+        parts = _unpack(data)
+        with self.atomic():
+            if self.exists(name):
+                if not replace:
+                    raise redis.ResponseError("BUSYKEY Target key name already exists.")
+                self.delete(name)
+            if kind == b'string':
+                self.set(name, parts[0])
+            elif kind == b'set':
+                self.sadd(name, *parts)
+            elif kind == b'hash':
+                self.hset(name, mapping=dict(zip(parts[::2], parts[1::2])))
+            elif kind == b'zset':
+                self.zadd(name, dict(zip(parts[::2], [float(s) for s in parts[1::2]])))
+            else:
+                raise redis.ResponseError("DUMP payload version or checksum are wrong")
+            if ttl:
+                self.pexpire(name, ttl - time.time() * 1000 if absttl else ttl)
+        return True
+
+
+class _SortedSet(object):
+    """
+    Members and scores of a sorted set, the (score, member) pairs being
+    kept sorted for ZRANGE.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+
+    def __len__(self):
+        return len(self.scores)
+
+    def add(self, member, score):
+        old = self.scores.get(member)
+        if old is not None:
+            del self.order[bisect_left(self.order, (old, member))]
+        self.scores[member] = score
+        insort(self.order, (score, member))
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        del self.order[bisect_left(self.order, (score, member))]
+        return True
+
+
+_TYPE_NAMES = ((bytes, b'string'), (set, b'set'), (dict, b'hash'), (_SortedSet, b'zset'))
+
+
+class _MemoryPubSub(object):
+    def __init__(self, backend):
+        self.backend = backend
+        self.channels = set()
+        self.queue = Queue()
+
+    def subscribe(self, *channels):
+        with self.backend.atomic():
+            for channel in channels:
+                channel = _encode(channel)
+                self.backend._subscribers.setdefault(channel, set()).add(self.queue)
+                self.channels.add(channel)
+                self.queue.put({'type': 'subscribe', 'pattern': None, 'channel': channel,
+                                'data': len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        with self.backend.atomic():
+            for channel in [_encode(c) for c in channels] or list(self.channels):
+                self.backend._subscribers.get(channel, set()).discard(self.queue)
+                self.channels.discard(channel)
+
+    def get_message(self, timeout=0.0):
+        try:
+            return self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()
+        except Empty:
+            return None
+
+    def listen(self):
+        while self.channels:
+            yield self.queue.get()
+
+    def close(self):
+        self.unsubscribe()
+
+
+class MemoryBackend(Backend):
+    """
+    Keeps the data in dicts of this process, under a lock held by every
+    command, pipeline and script. Keys are deleted once their ttl passes by
+    the next command. Pair it with eviction_policy='lru' for an in-process
+    LRU cache.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        self._expires = {}
+        self._deadlines = []  # heap of (deadline, key), some of them stale
+        self._subscribers = {}
+
+    def atomic(self, write=True):
+        return self._lock
+
+    def _expire_due(self):
+        deadlines = self._deadlines
+        if deadlines and deadlines[0][0] <= time.time():
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                deadline, name = heapq.heappop(deadlines)
+                if self._expires.get(name) == deadline:
+                    self._remove(name)
+
+    def _set_deadline(self, name, deadline):
+        self._expires[name] = deadline
+        heapq.heappush(self._deadlines, (deadline, name))
+        if len(self._deadlines) > 2 * len(self._expires) + 1024:
+            self._deadlines = [(d, n) for n, d in self._expires.items()]
+            heapq.heapify(self._deadlines)
+
+    def _remove(self, name):
+        self._expires.pop(name, None)
+        return self._data.pop(name, None) is not None
+
+    def _value(self, name, kind=None, create=False):
+        """
+        Returns the value of key `name` (None if it doesn't exist), which
+        must be a `kind`, creating it empty if `create`.
+        """
+        deadline = self._expires.get(name)
+        if deadline is not None and deadline <= time.time():
+            self._remove(name)
+        value = self._data.get(name)
+        if value is None:
+            if create:
+                value = self._data[name] = kind()
+        elif kind is not None and not isinstance(value, kind):
+            raise redis.ResponseError(WRONGTYPE)
+        return value
+
+    def _drop_if_empty(self, name, value):
+        if value is not None and not value:
+            self._remove(name)
+
+    # Keys and strings
+
+    @_query
+    def get(self, name):
+        return self._value(_encode(name), bytes)
+
+    @_command
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+        name = _encode(name)
+        exists = self._value(name) is not None
+        if (nx and exists) or (xx and not exists):
+            return None
+        seconds = _seconds(ex, px)
+        if not keepttl:
+            self._expires.pop(name, None)
+        self._data[name] = _encode(value)
+        if seconds is not None:
+            self._set_deadline(name, time.time() + seconds)
+        return True
+
+    @_command
+    def incrby(self, name, amount=1):
+        name = _encode(name)
+        try:
+            value = int(self._value(name, bytes) or 0) + int(amount)
+        except ValueError:
+            raise redis.ResponseError("value is not an integer or out of range")
+        self._data[name] = str(value).encode('ascii')
+        return value
+
+    @_command
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            name = _encode(name)
+            if self._value(name) is not None:
+                deleted += self._remove(name)
+        return deleted
+
+    @_query
+    def exists(self, *names):
+        return sum(1 for name in names if self._value(_encode(name)) is not None)
+
+    @_query
+    def type(self, name):
+        value = self._value(_encode(name))
+        for kind, kind_name in _TYPE_NAMES:
+            if isinstance(value, kind):
+                return kind_name
+        return b'none'
+
+    @_command
+    def pexpire(self, name, time_ms):
+        name = _encode(name)
+        if self._value(name) is None:
+            return False
+        if isinstance(time_ms, timedelta):
+            time_ms = time_ms.total_seconds() * 1000
+        if time_ms <= 0:
+            self._remove(name)
+        else:
+            self._set_deadline(name, time.time() + float(time_ms) / 1000)
+        return True
+
+    @_command
+    def persist(self, name):
+        name = _encode(name)
+        return self._value(name) is not None and self._expires.pop(name, None) is not None
+
+    @_query
+    def pttl(self, name):
+        name = _encode(name)
+        if self._value(name) is None:
+            return -2
+        deadline = self._expires.get(name)
+        if deadline is None:
+            return -1
+        return max(0, int(round((deadline - time.time()) * 1000)))
+
+    @_query
+    def scan(self, cursor=0, match=None, count=None, _type=None):
+        cursor, names = _scan_chunk(list(self._data), cursor, count or 10)
+        return cursor, _match(names, match)
+
+    @_command
+    def flushall(self, asynchronous=False):
+        self._data.clear()
+        self._expires.clear()
+        self._deadlines = []
+        return True
+
+    flushdb = flushall
+
+    # Sets
+
+    @_command
+    def sadd(self, name, *values):
+        if not values:
+            return 0
+        members = self._value(_encode(name), set, create=True)
+        size = len(members)
+        members.update(_encode(value) for value in values)
+        return len(members) - size
+
+    @_command
+    def srem(self, name, *values):
+        name = _encode(name)
+        members = self._value(name, set)
+        if members is None:
+            return 0
+        size = len(members)
+        members.difference_update(_encode(value) for value in values)
+        self._drop_if_empty(name, members)
+        return size - len(members)
+
+    @_query
+    def sismember(self, name, value):
+        members = self._value(_encode(name), set)
+        return members is not None and _encode(value) in members
+
+    @_query
+    def smembers(self, name):
+        return set(self._value(_encode(name), set) or ())
+
+    @_query
+    def scard(self, name):
+        return len(self._value(_encode(name), set) or ())
+
+    @_command
+    def spop(self, name, count=None):
+        name = _encode(name)
+        members = self._value(name, set) or set()
+        popped = [members.pop() for _ in range(min(len(members), 1 if count is None else count))]
+        self._drop_if_empty(name, members)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    @_query
+    def sscan(self, name, cursor=0, match=None, count=None):
+        members = self._value(_encode(name), set) or ()
+        cursor, members = _scan_chunk(members, cursor, count or 10)
+        return cursor, _match(members, match)
+
+    # Sorted sets
+
+    @_command
+    def zadd(self, name, mapping, nx=False, xx=False, ch=False, incr=False,
+             gt=False, lt=False):
+        if not mapping:
+            return 0
+        name = _encode(name)
+        zset = self._value(name, _SortedSet, create=True)
+        changed, result = 0, None
+        for member, score in mapping.items():
+            member, score = _encode(member), _score(score)
+            old = zset.scores.get(member)
+            if (nx and old is not None) or (xx and old is None):
+                continue
+            if incr:
+                score += old or 0
+            if old is not None and ((gt and score <= old) or (lt and score >= old)):
+                continue
+            if old != score:
+                zset.add(member, score)
+            result = score
+            if old is None or (ch and old != score):
+                changed += 1
+        self._drop_if_empty(name, zset)
+        return result if incr else changed
+
+    @_command
+    def zrem(self, name, *values):
+        name = _encode(name)
+        zset = self._value(name, _SortedSet)
+        if zset is None:
+            return 0
+        removed = sum(zset.remove(_encode(value)) for value in values)
+        self._drop_if_empty(name, zset)
+        return removed
+
+    @_query
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        zset = self._value(_encode(name), _SortedSet)
+        if zset is None:
+            return []
+        order = zset.order[::-1] if desc else zset.order
+        items = order[_range(len(order), start, end)]
+        if withscores:
+            return [(member, score_cast_func(score)) for score, member in items]
+        return [member for _, member in items]
+
+    @_query
+    def zscore(self, name, value):
+        zset = self._value(_encode(name), _SortedSet)
+        return None if zset is None else zset.scores.get(_encode(value))
+
+    @_query
+    def zcard(self, name):
+        return len(self._value(_encode(name), _SortedSet) or ())
+
+    # Hashes
+
+    @_command
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = {} if key is None else {key: value}
+        items.update(mapping or {})
+        if not items:
+            return 0
+        fields = self._value(_encode(name), dict, create=True)
+        added = 0
+        for key, value in items.items():
+            key = _encode(key)
+            added += key not in fields
+            fields[key] = _encode(value)
+        return added
+
+    @_query
+    def hget(self, name, key):
+        return (self._value(_encode(name), dict) or {}).get(_encode(key))
+
+    @_command
+    def hdel(self, name, *keys):
+        name = _encode(name)
+        fields = self._value(name, dict)
+        if fields is None:
+            return 0
+        deleted = sum(fields.pop(_encode(key), None) is not None for key in keys)
+        self._drop_if_empty(name, fields)
+        return deleted
+
+    @_query
+    def hlen(self, name):
+        return len(self._value(_encode(name), dict) or ())
+
+    @_query
+    def hgetall(self, name):
+        return dict(self._value(_encode(name), dict) or {})
+
+    @_query
+    def hscan(self, name, cursor=0, match=None, count=None):
+        fields = self._value(_encode(name), dict) or {}
+        cursor, keys = _scan_chunk(fields, cursor, count or 10)
+        return cursor, dict((key, fields[key]) for key in _match(keys, match))
+
+    @_query
+    def hrandfield(self, name, count=None, withvalues=False):
+        fields = self._value(_encode(name), dict)
+        if not fields:
+            return None if count is None else []
+        if count is None:
+            return random.choice(list(fields))
+        keys = random.sample(list(fields), min(count, len(fields)))
+        if withvalues:
+            return [part for key in keys for part in (key, fields[key])]
+        return keys
+
+    # Pub/sub
+
+    @_command
+    def publish(self, channel, message):
+        message = {'type': 'message', 'pattern': None, 'channel': _encode(channel),
+                   'data': _encode(message)}
+        queues = self._subscribers.get(message['channel'], ())
+        for queue in queues:
+            queue.put(message)
+        return len(queues)
+
+    def pubsub(self, **kwargs):
+        return _MemoryPubSub(self)
+
+
+# Keys live in `entries`, the members (and their scores or values) of sets,
+# sorted sets and hashes in `members`. Rows carry the crc32 slot of their
+# key or member, which orders SCANs and lets SPOP/HRANDFIELD pick a random
+# row with an index lookup.
+SHARED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    name BLOB NOT NULL UNIQUE,
+    slot INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    value BLOB,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS entries_slot ON entries (slot);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires) WHERE expires IS NOT NULL;
+CREATE TABLE IF NOT EXISTS members (
+    key_id INTEGER NOT NULL REFERENCES entries (id) ON DELETE CASCADE,
+    member BLOB NOT NULL,
+    slot INTEGER NOT NULL,
+    value BLOB,
+    score REAL,
+    PRIMARY KEY (key_id, member)
+);
+CREATE INDEX IF NOT EXISTS members_slot ON members (key_id, slot);
+CREATE INDEX IF NOT EXISTS members_score ON members (key_id, score, member);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel BLOB NOT NULL,
+    data BLOB NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+def _backend_error(error):
+    if isinstance(error, sqlite3.OperationalError) and 'locked' in str(error):
+        return redis.TimeoutError(str(error))
+    return redis.ConnectionError(str(error))
+
+
+class _SharedPubSub(object):
+    """
+    Subscription polling the messages table every `poll_interval` seconds.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.channels = set()
+        self.pending = []
+        self.last_id = None
+
+    def subscribe(self, *channels):
+        if self.last_id is None:
+            with self.backend.atomic(write=False):
+                self.last_id = self.backend._db.execute(
+                    'SELECT coalesce(max(id), 0) FROM messages').fetchone()[0]
+        for channel in channels:
+            self.channels.add(_encode(channel))
+            self.pending.append({'type': 'subscribe', 'pattern': None,
+                                 'channel': _encode(channel), 'data': len(self.channels)})
+
+    def unsubscribe(self, *channels):
+        for channel in [_encode(c) for c in channels] or list(self.channels):
+            self.channels.discard(channel)
+
+    def _poll(self):
+        with self.backend.atomic(write=False):
+            rows = self.backend._db.execute(
+                'SELECT id, channel, data FROM messages WHERE id > ? ORDER BY id',
+                (self.last_id,)).fetchall()
+        for message_id, channel, data in rows:
+            self.last_id = message_id
+            if bytes(channel) in self.channels:
+                self.pending.append({'type': 'message', 'pattern': None,
+                                     'channel': bytes(channel), 'data': bytes(data)})
+
+    def get_message(self, timeout=0.0):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            if not self.pending:
+                self._poll()
+            if self.pending:
+                return self.pending.pop(0)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, self.backend.poll_interval))
+
+    def listen(self):
+        while self.channels:
+            message = self.get_message(self.backend.poll_interval)
+            if message is not None:
+                yield message
+
+    def close(self):
+        self.unsubscribe()
+
+
+class SharedMemoryBackend(Backend):
+    """
+    Keeps the data in a sqlite database shared by every process of the host
+    which opens the same `path`, in /dev/shm by default so it lives in
+    memory, read through mmap. Commands, pipelines and scripts run in
+    immediate transactions, atomic across processes. Expired keys are
+    deleted when read, and at most once a second by the next command.
+    Published messages are polled by subscribers every `poll_interval`
+    seconds.
+    :param path: database file, created if missing
+    :param timeout: seconds to wait for another process' transaction before
+        raising redis.TimeoutError
+    :param mmap_size: bytes of the database read through mmap
+    """
+    name = 'shared'
+
+    def __init__(self, path=None, timeout=5.0, poll_interval=0.05,
+                 mmap_size=1 << 28):
+        self.path = path or DEFAULT_SHARED_PATH
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.mmap_size = mmap_size
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+        self._depth = 0
+        self._writing = False
+        self._swept = 0
+
+    def __repr__(self):
+        return 'SharedMemoryBackend({0!r})'.format(self.path)
+
+    def info(self, section=None):
+        return {'backend': self.name, 'path': self.path}
+
+    def _connect(self):
+        # A connection inherited over fork is left alone, never closed.
+        self._inherited = self._db
+        try:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('PRAGMA foreign_keys=ON')
+            db.execute('PRAGMA mmap_size={0:d}'.format(self.mmap_size))
+            db.executescript(SHARED_SCHEMA)
+        except sqlite3.Error as e:
+            raise _backend_error(e)
+        self._db, self._pid, self._depth = db, os.getpid(), 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._pid == os.getpid():
+                self._db.close()
+            self._db = self._pid = None
+
+    @contextmanager
+    def atomic(self, write=True):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._connect()
+            if self._depth:
+                if write and not self._writing:
+                    raise RuntimeError("write command within a read-only transaction")
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            try:
+                self._db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            except sqlite3.Error as e:
+                raise _backend_error(e)
+            self._depth, self._writing = 1, write
+            try:
+                yield
+            except BaseException as e:
+                self._depth = 0
+                try:
+                    self._db.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                if isinstance(e, sqlite3.Error):
+                    raise _backend_error(e)
+                raise
+            self._depth = 0
+            try:
+                self._db.execute('COMMIT')
+            except sqlite3.Error as e:
+                raise _backend_error(e)
+
+    def _expire_due(self):
+        now = time.time()
+        if now - self._swept >= 1:
+            self._swept = now
+            self._db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+            self._db.execute('DELETE FROM messages WHERE created <= ?', (now - MESSAGE_TTL,))
+
+    def _key(self, name, kind=None, create=False):
+        """
+        Returns the (id, type, value, expires) row of key `name` (None if it
+        doesn't exist), which must be a `kind`, creating it empty if
+        `create`. Read-only transactions skip the rows whose ttl passed,
+        leaving them to the writers to delete.
+        """
+        if not self._writing:
+            row = self._db.execute(
+                'SELECT id, type, value, expires FROM entries'
+                ' WHERE name = ? AND (expires IS NULL OR expires > ?)',
+                (_blob(name), time.time())).fetchone()
+        else:
+            row = self._db.execute('SELECT id, type, value, expires FROM entries WHERE name = ?',
+                                   (_blob(name),)).fetchone()
+            if row is not None and row[3] is not None and row[3] <= time.time():
+                self._db.execute('DELETE FROM entries WHERE id = ?', (row[0],))
+                row = None
+        if row is None:
+            if create:
+                cursor = self._db.execute(
+                    'INSERT INTO entries (name, slot, type) VALUES (?, ?, ?)',
+                    (_blob(name), _slot(name), kind))
+                row = (cursor.lastrowid, kind, None, None)
+        elif kind is not None and row[1] != kind:
+            raise redis.ResponseError(WRONGTYPE)
+        return row
+
+    def _key_id(self, name, kind, create=False):
+        row = self._key(_encode(name), kind, create)
+        return None if row is None else row[0]
+
+    def _drop_if_empty(self, key_id):
+        if not self._db.execute('SELECT 1 FROM members WHERE key_id = ? LIMIT 1',
+                                (key_id,)).fetchone():
+            self._db.execute('DELETE FROM entries WHERE id = ?', (key_id,))
+
+    def _member(self, key_id, member, column):
+        row = self._db.execute(
+            'SELECT {0} FROM members WHERE key_id = ? AND member = ?'.format(column),
+            (key_id, _blob(member))).fetchone()
+        return None if row is None else row[0]
+
+    def _scan_rows(self, table, where, params, columns, cursor, count):
+        """
+        Returns the (cursor, rows) of a SCAN-like chunk of about `count`
+        rows of `table` matching `where`, in slot order.
+        """
+        sql = 'SELECT slot, {0} FROM {1} WHERE {2} AND slot {{0}} ? ORDER BY slot'.format(
+            columns, table, where)
+        rows = self._db.execute(sql.format('>=') + ' LIMIT ?',
+                                params + (_scan_threshold(cursor), count + 1)).fetchall()
+        if len(rows) <= count:
+            return 0, rows
+        last = rows[count - 1][0]
+        rows = [row for row in rows[:count] if row[0] != last]
+        return last + 2, rows + self._db.execute(sql.format('='), params + (last,)).fetchall()
+
+    def _random_member(self, key_id, columns):
+        sql = 'SELECT {0} FROM members WHERE key_id = ?{1} ORDER BY slot LIMIT 1'
+        return (self._db.execute(sql.format(columns, ' AND slot >= ?'),
+                                 (key_id, random.randint(0, 0xffffffff))).fetchone()
+                or self._db.execute(sql.format(columns, ''), (key_id,)).fetchone())
+
+    # Keys and strings
+
+    @_query
+    def get(self, name):
+        row = self._key(_encode(name), 'string')
+        return None if row is None else bytes(row[2])
+
+    @_command
+    def set(self, name, value, ex=None, px=None, nx=False, xx=False, keepttl=False):
+        name = _encode(name)
+        row = self._key(name)
+        if (nx and row is not None) or (xx and row is None):
+            return None
+        seconds = _seconds(ex, px)
+        expires = None if seconds is None else time.time() + seconds
+        if keepttl and row is not None and seconds is None:
+            expires = row[3]
+        if row is not None and row[1] == 'string':
+            self._db.execute('UPDATE entries SET value = ?, expires = ? WHERE id = ?',
+                             (_blob(_encode(value)), expires, row[0]))
+        else:
+            if row is not None:
+                self._db.execute('DELETE FROM entries WHERE id = ?', (row[0],))
+            self._db.execute(
+                'INSERT INTO entries (name, slot, type, value, expires) VALUES (?, ?, ?, ?, ?)',
+                (_blob(name), _slot(name), 'string', _blob(_encode(value)), expires))
+        return True
+
+    @_command
+    def incrby(self, name, amount=1):
+        row = self._key(_encode(name), 'string', create=True)
+        try:
+            value = int(bytes(row[2] or b'0')) + int(amount)
+        except ValueError:
+            raise redis.ResponseError("value is not an integer or out of range")
+        self._db.execute('UPDATE entries SET value = ? WHERE id = ?',
+                         (_blob(str(value).encode('ascii')), row[0]))
+        return value
+
+    @_command
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            row = self._key(_encode(name))
+            if row is not None:
+                self._db.execute('DELETE FROM entries WHERE id = ?', (row[0],))
+                deleted += 1
+        return deleted
+
+    @_query
+    def exists(self, *names):
+        return sum(1 for name in names if self._key(_encode(name)) is not None)
+
+    @_query
+    def type(self, name):
+        row = self._key(_encode(name))
+        return b'none' if row is None else row[1].encode('ascii')
+
+    @_command
+    def pexpire(self, name, time_ms):
+        row = self._key(_encode(name))
+        if row is None:
+            return False
+        if isinstance(time_ms, timedelta):
+            time_ms = time_ms.total_seconds() * 1000
+        if time_ms <= 0:
+            self._db.execute('DELETE FROM entries WHERE id = ?', (row[0],))
+        else:
+            self._db.execute('UPDATE entries SET expires = ? WHERE id = ?',
+                             (time.time() + float(time_ms) / 1000, row[0]))
+        return True
+
+    @_command
+    def persist(self, name):
+        row = self._key(_encode(name))
+        if row is None or row[3] is None:
+            return False
+        self._db.execute('UPDATE entries SET expires = NULL WHERE id = ?', (row[0],))
+        return True
+
+    @_query
+    def pttl(self, name):
+        row = self._key(_encode(name))
+        if row is None:
+            return -2
+        if row[3] is None:
+            return -1
+        return max(0, int(round((row[3] - time.time()) * 1000)))
+
+    @_query
+    def scan(self, cursor=0, match=None, count=None, _type=None):
+        cursor, rows = self._scan_rows('entries', '1', (), 'name, expires', cursor,
+                                       count or 10)
+        now = time.time()
+        return cursor, _match([bytes(name) for _, name, expires in rows
+                               if expires is None or expires > now], match)
+
+    @_command
+    def flushall(self, asynchronous=False):
+        self._db.execute('DELETE FROM members')
+        self._db.execute('DELETE FROM entries')
+        return True
+
+    flushdb = flushall
+
+    # Sets
+
+    @_command
+    def sadd(self, name, *values):
+        if not values:
+            return 0
+        key_id = self._key_id(name, 'set', create=True)
+        members = [_encode(value) for value in values]
+        return self._db.executemany(
+            'INSERT OR IGNORE INTO members (key_id, member, slot) VALUES (?, ?, ?)',
+            [(key_id, _blob(member), _slot(member)) for member in members]).rowcount
+
+    @_command
+    def srem(self, name, *values):
+        key_id = self._key_id(name, 'set')
+        if key_id is None or not values:
+            return 0
+        removed = self._db.executemany(
+            'DELETE FROM members WHERE key_id = ? AND member = ?',
+            [(key_id, _blob(_encode(value))) for value in values]).rowcount
+        self._drop_if_empty(key_id)
+        return removed
+
+    @_query
+    def sismember(self, name, value):
+        key_id = self._key_id(name, 'set')
+        return key_id is not None and self._member(key_id, _encode(value), '1') is not None
+
+    @_query
+    def smembers(self, name):
+        key_id = self._key_id(name, 'set')
+        return set(bytes(row[0]) for row in self._db.execute(
+            'SELECT member FROM members WHERE key_id = ?', (key_id,)))
+
+    @_query
+    def scard(self, name):
+        return self._db.execute('SELECT count(*) FROM members WHERE key_id = ?',
+                                (self._key_id(name, 'set'),)).fetchone()[0]
+
+    @_command
+    def spop(self, name, count=None):
+        key_id = self._key_id(name, 'set')
+        popped = []
+        while key_id is not None and len(popped) < (1 if count is None else count):
+            row = self._random_member(key_id, 'member')
+            if row is None:
+                break
+            self._db.execute('DELETE FROM members WHERE key_id = ? AND member = ?',
+                             (key_id, row[0]))
+            popped.append(bytes(row[0]))
+        if key_id is not None:
+            self._drop_if_empty(key_id)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    @_query
+    def sscan(self, name, cursor=0, match=None, count=None):
+        cursor, rows = self._scan_rows('members', 'key_id = ?', (self._key_id(name, 'set'),),
+                                       'member', cursor, count or 10)
+        return cursor, _match([bytes(member) for _, member in rows], match)
+
+    # Sorted sets
+
+    @_command
+    def zadd(self, name, mapping, nx=False, xx=False, ch=False, incr=False,
+             gt=False, lt=False):
+        if not mapping:
+            return 0
+        key_id = self._key_id(name, 'zset', create=True)
+        changed, result = 0, None
+        for member, score in mapping.items():
+            member, score = _encode(member), _score(score)
+            old = self._member(key_id, member, 'score')
+            if (nx and old is not None) or (xx and old is None):
+                continue
+            if incr:
+                score += old or 0
+            if old is not None and ((gt and score <= old) or (lt and score >= old)):
+                continue
+            if old is None:
+                self._db.execute(
+                    'INSERT INTO members (key_id, member, slot, score) VALUES (?, ?, ?, ?)',
+                    (key_id, _blob(member), _slot(member), score))
+            elif old != score:
+                self._db.execute('UPDATE members SET score = ? WHERE key_id = ? AND member = ?',
+                                 (score, key_id, _blob(member)))
+            result = score
+            if old is None or (ch and old != score):
+                changed += 1
+        self._drop_if_empty(key_id)
+        return result if incr else changed
+
+    @_command
+    def zrem(self, name, *values):
+        key_id = self._key_id(name, 'zset')
+        if key_id is None or not values:
+            return 0
+        removed = self._db.executemany(
+            'DELETE FROM members WHERE key_id = ? AND member = ?',
+            [(key_id, _blob(_encode(value))) for value in values]).rowcount
+        self._drop_if_empty(key_id)
+        return removed
+
+    @_query
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        key_id = self._key_id(name, 'zset')
+        if key_id is None:
+            return []
+        span = _range(self.zcard(name), start, end)
+        rows = self._db.execute(
+            'SELECT member, score FROM members WHERE key_id = ? ORDER BY {0} LIMIT ? OFFSET ?'
+            .format('score DESC, member DESC' if desc else 'score, member'),
+            (key_id, span.stop - span.start, span.start)).fetchall()
+        if withscores:
+            return [(bytes(member), score_cast_func(score)) for member, score in rows]
+        return [bytes(member) for member, _ in rows]
+
+    @_query
+    def zscore(self, name, value):
+        key_id = self._key_id(name, 'zset')
+        return None if key_id is None else self._member(key_id, _encode(value), 'score')
+
+    @_query
+    def zcard(self, name):
+        return self._db.execute('SELECT count(*) FROM members WHERE key_id = ?',
+                                (self._key_id(name, 'zset'),)).fetchone()[0]
+
+    # Hashes
+
+    @_command
+    def hset(self, name, key=None, value=None, mapping=None):
+        items = {} if key is None else {key: value}
+        items.update(mapping or {})
+        if not items:
+            return 0
+        key_id = self._key_id(name, 'hash', create=True)
+        added = 0
+        for field, value in items.items():
+            field = _encode(field)
+            if self._member(key_id, field, '1') is None:
+                self._db.execute(
+                    'INSERT INTO members (key_id, member, slot, value) VALUES (?, ?, ?, ?)',
+                    (key_id, _blob(field), _slot(field), _blob(_encode(value))))
+                added += 1
+            else:
+                self._db.execute('UPDATE members SET value = ? WHERE key_id = ? AND member = ?',
+                                 (_blob(_encode(value)), key_id, _blob(field)))
+        return added
+
+    @_query
+    def hget(self, name, key):
+        key_id = self._key_id(name, 'hash')
+        value = None if key_id is None else self._member(key_id, _encode(key), 'value')
+        return None if value is None else bytes(value)
+
+    @_command
+    def hdel(self, name, *keys):
+        key_id = self._key_id(name, 'hash')
+        if key_id is None or not keys:
+            return 0
+        deleted = self._db.executemany(
+            'DELETE FROM members WHERE key_id = ? AND member = ?',
+            [(key_id, _blob(_encode(key))) for key in keys]).rowcount
+        self._drop_if_empty(key_id)
+        return deleted
+
+    @_query
+    def hlen(self, name):
+        return self._db.execute('SELECT count(*) FROM members WHERE key_id = ?',
+                                (self._key_id(name, 'hash'),)).fetchone()[0]
+
+    @_query
+    def hgetall(self, name):
+        return dict((bytes(field), bytes(value)) for field, value in self._db.execute(
+            'SELECT member, value FROM members WHERE key_id = ?', (self._key_id(name, 'hash'),)))
+
+    @_query
+    def hscan(self, name, cursor=0, match=None, count=None):
+        cursor, rows = self._scan_rows('members', 'key_id = ?', (self._key_id(name, 'hash'),),
+                                       'member, value', cursor, count or 10)
+        fields = dict((bytes(field), bytes(value)) for _, field, value in rows)
+        return cursor, dict((field, fields[field]) for field in _match(fields, match))
+
+    @_query
+    def hrandfield(self, name, count=None, withvalues=False):
+        key_id = self._key_id(name, 'hash')
+        row = None if key_id is None else self._random_member(key_id, 'member, value')
+        if count is None:
+            return None if row is None else bytes(row[0])
+        fields = self.hgetall(name)
+        keys = random.sample(list(fields), min(count, len(fields)))
+        if withvalues:
+            return [part for key in keys for part in (key, fields[key])]
+        return keys
+
+    # Pub/sub
+
+    @_command
+    def publish(self, channel, message):
+        # Subscribers of other processes can't be counted
+        self._db.execute('INSERT INTO messages (channel, data, created) VALUES (?, ?, ?)',
+                         (_blob(_encode(channel)), _blob(_encode(message)), time.time()))
+        return 0
+
+    def pubsub(self, **kwargs):
+        return _SharedPubSub(self)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(backend):
+    """
+    Returns the process-wide MemoryBackend for 'memory', the process-wide
+    SharedMemoryBackend on DEFAULT_SHARED_PATH for 'shared', and `backend`
+    itself for backend objects.
+    """
+    if not isinstance(backend, (bytes, text_type)):
+        return backend
+    with _backends_lock:
+        if backend not in _backends:
+            if backend == 'memory':
+                _backends[backend] = MemoryBackend()
+            elif backend == 'shared':
+                _backends[backend] = SharedMemoryBackend()
+            else:
+                raise ValueError("backend must be 'redis', 'memory', 'shared' "
+                                 "or a backend object")
+        return _backends[backend]
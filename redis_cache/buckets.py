@@ -0,0 +1,426 @@
+"""
+Memory-compact storage of many small values.
+Instead of a top-level redis key (plus a key set member) per entry, entries
+are fields of a fixed number of hashes, picked by a crc32 of the key. Hashes
+of up to hash-max-listpack-entries (128) fields of up to
+hash-max-listpack-value (64) bytes are stored in the compact listpack
+encoding, which costs a few bytes per field instead of the ~50-100 bytes of
+overhead of a top-level key.
+Per entry ttls use HEXPIRE on redis 7.4+, and otherwise an expiry timestamp
+embedded in front of the value.
+"""
+import math
+import re
+import threading
+import time
+import zlib
+
+from .rediscache import (BulkProgress, CacheMissException, DEFAULT_EXPIRY,
+                         ExpiredKeyException, LuaScript, SimpleCache,
+                         _glob_escape, _size, to_unicode)
+
+# Average number of entries per bucket when the bucket count is derived
+# from the limit, leaving room under hash-max-listpack-entries (128).
+BUCKET_FILL = 64
+
+# Evicts from full buckets, then writes (field, value, expire) triples into
+# the buckets given as KEYS, one triple per bucket key. Every bucket holds
+# at most ARGV[1] fields (0 for no limit): with HEXPIRE a random field is
+# evicted, otherwise the expired fields or else the field expiring soonest.
+# Without HEXPIRE, buckets get the ttl of their longest lived field so that
+# expired entries that are never read don't outlive it. Returns the number
+# of evicted fields.
+BUCKET_STORE_SCRIPT = LuaScript("""
+local limit = tonumber(ARGV[1])
+local now = tonumber(ARGV[2])
+local hexpire = ARGV[3] == '1'
+
+local function deadline_of(value)
+    local deadline = tonumber(string.match(value, '^(%d+):'))
+    if deadline == nil or deadline == 0 then
+        return math.huge
+    end
+    return deadline
+end
+
+local function evict(bucket)
+    if hexpire then
+        local field = redis.call('HRANDFIELD', bucket)
+        return field and redis.call('HDEL', bucket, field) or 0
+    end
+    local entries = redis.call('HGETALL', bucket)
+    local expired, soonest, soonest_deadline = {}, nil, math.huge
+    for i = 1, #entries, 2 do
+        local deadline = deadline_of(entries[i + 1])
+        if deadline <= now then
+            table.insert(expired, entries[i])
+        elseif soonest == nil or deadline < soonest_deadline then
+            soonest, soonest_deadline = entries[i], deadline
+        end
+    end
+    if #expired == 0 then
+        expired = {soonest}
+    end
+    return redis.call('HDEL', bucket, unpack(expired))
+end
+
+local evicted = 0
+for i, bucket in ipairs(KEYS) do
+    local field = ARGV[1 + i * 3]
+    local value = ARGV[2 + i * 3]
+    local expire = tonumber(ARGV[3 + i * 3])
+    local exists = redis.call('EXISTS', bucket) == 1
+    if limit > 0 and exists and redis.call('HEXISTS', bucket, field) == 0
+            and redis.call('HLEN', bucket) >= limit then
+        evicted = evicted + evict(bucket)
+    end
+    redis.call('HSET', bucket, field, value)
+    if hexpire then
+        if expire > 0 then
+            redis.call('HEXPIRE', bucket, expire, 'FIELDS', 1, field)
+        else
+            redis.call('HPERSIST', bucket, 'FIELDS', 1, field)
+        end
+    elseif expire == 0 then
+        redis.call('PERSIST', bucket)
+    else
+        local ttl = redis.call('TTL', bucket)
+        if not exists or (ttl >= 0 and ttl < expire) then
+            redis.call('EXPIRE', bucket, expire)
+        end
+    end
+end
+return evicted
+""")
+
+
+@BUCKET_STORE_SCRIPT.ported
+def _bucket_store_port(client, keys, args):
+    limit, now, hexpire = int(args[0]), float(args[1]), args[2] == b'1'
+
+    def deadline_of(value):
+        match = re.match(b'(\\d+):', value)
+        return int(match.group(1)) if match and int(match.group(1)) else float('inf')
+
+    def evict(bucket):
+        if hexpire:
+            field = client.hrandfield(bucket)
+            return client.hdel(bucket, field) if field is not None else 0
+        expired, soonest, soonest_deadline = [], None, float('inf')
+        for field, value in client.hgetall(bucket).items():
+            deadline = deadline_of(value)
+            if deadline <= now:
+                expired.append(field)
+            elif soonest is None or deadline < soonest_deadline:
+                soonest, soonest_deadline = field, deadline
+        return client.hdel(bucket, *(expired or [soonest]))
+
+    evicted = 0
+    for i, bucket in enumerate(keys):
+        field, value, expire = args[3 + i * 3], args[4 + i * 3], int(args[5 + i * 3])
+        exists = client.exists(bucket) == 1
+        if (limit > 0 and exists and not client.hexists(bucket, field)
+                and client.hlen(bucket) >= limit):
+            evicted += evict(bucket)
+        client.hset(bucket, field, value)
+        if hexpire:
+            if expire > 0:
+                client.execute_command('HEXPIRE', bucket, expire, 'FIELDS', 1, field)
+            else:
+                client.execute_command('HPERSIST', bucket, 'FIELDS', 1, field)
+        elif expire == 0:
+            client.persist(bucket)
+        else:
+            ttl = client.ttl(bucket)
+            if not exists or 0 <= ttl < expire:
+                client.expire(bucket, expire)
+    return evicted
+
+
+def _bucket_of(key, buckets):
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % buckets
+
+
+def _unsupported(name):
+    """
+    Returns a method raising NotImplementedError, in place of a SimpleCache
+    method working on its key layout.
+    """
+    def method(self, *args, **kwargs):
+        raise NotImplementedError("BucketedCache doesn't support {0}()".format(name))
+    method.__name__ = name
+    return method
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    if not isinstance(value, type(u'')):
+        value = u'{0}'.format(value)
+    return value.encode('utf-8')
+
+
+class BucketedCache(SimpleCache):
+    """
+    SimpleCache storing entries as fields of `buckets` hashes rather than as
+    top-level keys, cutting redis memory several-fold for small values.
+    Supports the store, get, mget and invalidate methods (and their json,
+    pickle and encoded variants), so it can be passed to the decorators.
+    `limit` is enforced per bucket, each one holding at most
+    ceil(limit / buckets) entries.
+    :param buckets: number of hashes, by default enough for BUCKET_FILL
+        entries per bucket at `limit` entries
+    :param field_ttl: whether to expire entries with HEXPIRE (redis 7.4+),
+        detected from the server version by default
+    Other keyword arguments are SimpleCache connection arguments. The local
+    tier, eviction policies, byte budgets, namespace generations and chunked
+    values aren't supported, and raise ValueError, nor are the methods
+    working on SimpleCache's key layout (reap, snapshots, chunk streams and
+    used_bytes), which raise NotImplementedError.
+    """
+    def __init__(self, limit=10000, expire=DEFAULT_EXPIRY, hashkeys=False,
+                 namespace="SimpleCache", buckets=None, field_ttl=None,
+                 **kwargs):
+        for option in ('local_cache_size', 'namespace_generations', 'chunk_threshold',
+                       'max_bytes'):
+            if kwargs.get(option):
+                raise ValueError("BucketedCache doesn't support {0}".format(option))
+        if kwargs.get('eviction_policy', 'random') != 'random':
+            raise ValueError("BucketedCache doesn't support eviction_policy")
+        SimpleCache.__init__(self, limit, expire, hashkeys=hashkeys,
+                             namespace=namespace, **kwargs)
+        if buckets is None:
+            buckets = int(math.ceil(limit / float(BUCKET_FILL))) if limit else 1024
+        self.buckets = max(1, buckets)
+        if field_ttl is None and self.connection is not None:
+            version = self.connection.info('server').get('redis_version', '0')
+            field_ttl = tuple(int(part) for part in str(version).split('.')[:2]) >= (7, 4)
+        self.field_ttl = bool(field_ttl)
+
+    reap = _unsupported('reap')
+    start_reaper = _unsupported('start_reaper')
+    cleanup_generations = _unsupported('cleanup_generations')
+    start_generation_cleanup = _unsupported('start_generation_cleanup')
+    store_chunks = _unsupported('store_chunks')
+    iter_chunks = _unsupported('iter_chunks')
+    get_stream = _unsupported('get_stream')
+    used_bytes = _unsupported('used_bytes')
+    export_snapshot = _unsupported('export_snapshot')
+    import_snapshot = _unsupported('import_snapshot')
+
+    def get_bucket_name(self, index):
+        return "SimpleCache-{0}-bucket:{1}".format(self.prefix, index)
+
+    def bucket(self, key):
+        """
+        Returns the name of the hash holding `key`.
+        """
+        return self.get_bucket_name(_bucket_of(to_unicode(key), self.buckets))
+
+    def _bucket_names(self):
+        return [self.get_bucket_name(i) for i in range(self.buckets)]
+
+    def _store_items(self, items):
+        if not items:
+            return 0
+        now = int(time.time())
+        bucket_limit = int(math.ceil((self.limit or 0) / float(self.buckets)))
+        keys, args = [], [bucket_limit, now, '1' if self.field_ttl else '0']
+        for key, value, expire in items:
+            key = to_unicode(key)
+            expire = self._expire_seconds(expire)
+            if not self.field_ttl:
+                deadline = now + expire if expire else 0
+                value = u'{0}:'.format(deadline).encode('ascii') + _to_bytes(value)
+            keys.append(self.bucket(key))
+            args.extend((key, value, expire))
+        evicted = self._run_script(BUCKET_STORE_SCRIPT, keys, args)
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.incr('stores', len(items))
+            metrics.incr('bytes_written', sum(_size(value) for value in args[4::3]))
+            metrics.incr('evictions', evicted or 0)
+        return len(items)
+
+    def _unwrap(self, value, now):
+        """
+        Returns the value of a field, or ExpiredKeyException if its embedded
+        deadline has passed.
+        """
+        if value is None or self.field_ttl:
+            return value
+        deadline, _, value = value.partition(b':')
+        if int(deadline) and int(deadline) <= now:
+            return ExpiredKeyException
+        return value
+
+    def _fetch(self, keys):
+        """
+        Reads `keys` with one HMGET per bucket, in a single round trip.
+        :return: list of values, None or ExpiredKeyException for every key
+        """
+        fields = {}
+        for key in keys:
+            fields.setdefault(self.bucket(key), []).append(key)
+        pipe = self.connection.pipeline(transaction=False)
+        for bucket, bucket_keys in fields.items():
+            pipe.hmget(bucket, bucket_keys)
+        found = {}
+        now = time.time()
+        for (bucket, bucket_keys), values in zip(fields.items(), self._timed(pipe.execute)):
+            for key, value in zip(bucket_keys, values):
+                found[key] = self._unwrap(value, now)
+        return [found[key] for key in keys]
+
+    def get(self, key):
+        return self._get(key)
+
+    def _get(self, key, join_chunks=True):
+        key = to_unicode(key)
+        if key:
+            metrics = self.metrics
+            value = self._unwrap(self._timed(self.connection.hget, self.bucket(key), key),
+                                 time.time())
+            if value is None or value is ExpiredKeyException:
+                if metrics is not None:
+                    metrics.incr('misses')
+                if value is None:
+                    raise CacheMissException
+                if metrics is not None:
+                    metrics.incr('expired')
+                raise ExpiredKeyException
+            if metrics is not None:
+                metrics.incr('hits')
+                metrics.incr('bytes_read', len(value))
+            return value
+
+    def mget(self, keys):
+        """
+        Method returns a dict of key/values for found keys.
+        :param keys: array of keys to look up in Redis
+        :return: dict of found key/values
+        """
+        if keys:
+            values = self._fetch([to_unicode(key) for key in keys])
+            found = dict((k, v) for k, v in zip(keys, values)
+                         if v is not None and v is not ExpiredKeyException)
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.incr('hits', len(found))
+                metrics.incr('misses', len(values) - len(found))
+                metrics.incr('bytes_read', sum(len(value) for value in found.values()))
+            return found
+
+    def invalidate(self, key):
+        """
+        Method removes (invalidates) an item from the cache.
+        :param key: key to remove from Redis
+        """
+        key = to_unicode(key)
+        self._timed(self.connection.hdel, self.bucket(key), key)
+
+    def isexpired(self, key):
+        """
+        Returns True if `key` is expired or missing, and its remaining ttl in
+        milliseconds otherwise (-1 for entries that never expire).
+        """
+        key = to_unicode(key)
+        if self.field_ttl:
+            ttl = self.connection.execute_command('HPTTL', self.bucket(key),
+                                                  'FIELDS', 1, key)[0]
+            return True if ttl == -2 else ttl
+        value = self.connection.hget(self.bucket(key), key)
+        if value is None:
+            return True
+        deadline = int(value.partition(b':')[0])
+        if not deadline:
+            return -1
+        ttl = int((deadline - time.time()) * 1000)
+        return ttl if ttl > 0 else True
+
+    def __contains__(self, key):
+        value = self._fetch([to_unicode(key)])[0]
+        return value is not None and value is not ExpiredKeyException
+
+    def __len__(self):
+        """
+        Number of stored entries, including expired entries not evicted yet
+        when expiry timestamps are embedded.
+        """
+        pipe = self.connection.pipeline(transaction=False)
+        for bucket in self._bucket_names():
+            pipe.hlen(bucket)
+        return sum(pipe.execute())
+
+    def __iter__(self):
+        for bucket in self._bucket_names():
+            for key in self.connection.hscan_iter(bucket):
+                yield to_unicode(key[0])
+
+    def keys(self):
+        return set(self)
+
+    def _delete_fields(self, match=None):
+        """
+        Deletes the fields matching the glob `match` (every field if None).
+        :return: number of deleted fields
+        """
+        deleted = 0
+        for bucket in self._bucket_names():
+            fields = [field for field, _ in self.connection.hscan_iter(bucket, match=match)]
+            if fields:
+                deleted += self.connection.hdel(bucket, *fields)
+        return deleted
+
+    def expire_all_in_set(self, chunk_size=1000, rate_limit=None,
+                          background=False):
+        """
+        Deletes every entry, as expired entries aren't kept apart from
+        missing ones.
+        :return: the number of entries before and the number deleted, or the
+            BulkProgress of the background thread
+        """
+        if background:
+            return self.flush(chunk_size, rate_limit, background)
+        size = len(self)
+        return size, self.flush(chunk_size, rate_limit).deleted
+
+    def expire_namespace(self, namespace):
+        expired = self._delete_fields(_glob_escape(to_unicode(namespace) + u':') + u'*')
+        return len(self), expired
+
+    def flush_namespace(self, space):
+        self._delete_fields(_glob_escape(to_unicode(space) + u':') + u'*')
+
+    def flush(self, chunk_size=1000, rate_limit=None, background=False):
+        """
+        Deletes every bucket, `chunk_size` buckets per round trip.
+        :return: BulkProgress, counting buckets as scanned and entries as
+            deleted
+        """
+        def work(progress):
+            started = time.time()
+            names = self._bucket_names()
+            for start in range(0, len(names), chunk_size):
+                chunk = names[start:start + chunk_size]
+                pipe = self.connection.pipeline(transaction=False)
+                for bucket in chunk:
+                    pipe.hlen(bucket)
+                pipe.delete(*chunk)
+                progress.deleted += sum(pipe.execute()[:-1])
+                progress.scanned += len(chunk)
+                if rate_limit:
+                    time.sleep(max(0, started + progress.scanned / float(rate_limit)
+                                   - time.time()))
+
+        progress = BulkProgress()
+        if background:
+            thread = threading.Thread(target=progress.run, args=(work,))
+            thread.daemon = True
+            thread.start()
+        else:
+            work(progress)
+            progress.finished.set()
+        return progress
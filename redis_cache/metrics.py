@@ -0,0 +1,280 @@
+"""
+Counters and latency histograms of caches and cache_it decorated functions.
+Every Metrics object is registered, so all of them can be exported at once
+in the Prometheus text format with prometheus_text(), and hooks can forward
+counter increments and observations to other monitoring systems.
+"""
+from bisect import bisect_left
+import threading
+import time
+import weakref
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Counters of SimpleCache(metrics=True) and of cache_it decorated functions
+CACHE_COUNTERS = ('hits', 'misses', 'expired', 'stores', 'evictions',
+                  'reclaimed', 'errors', 'bytes_read', 'bytes_written')
+FUNCTION_COUNTERS = ('hits', 'misses', 'expired', 'stores', 'errors',
+                     'computes')
+
+_registry = weakref.WeakValueDictionary()
+_registry_lock = threading.Lock()
+_hooks = []
+
+
+class CacheStats(dict):
+    """
+    Thread-safe counters, the base of Metrics.
+    """
+    def __init__(self, *names):
+        super(CacheStats, self).__init__((name, 0) for name in names)
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self[name] = self.get(name, 0) + amount
+
+
+class Histogram(object):
+    """
+    Counts observations in buckets of upper bounds `buckets`, plus an
+    overflow bucket.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the `q` quantile (inf
+        for the overflow bucket), or None without observations.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99)}
+
+    def merged(self, other):
+        """
+        Returns a Histogram with the observations of both, those of `other`
+        counted in the bucket of this one holding their bucket's upper bound.
+        """
+        merged = Histogram(self.buckets)
+        merged.counts = list(self.counts)
+        for bound, count in zip(other.buckets + (float('inf'),), other.counts):
+            merged.counts[bisect_left(self.buckets, bound)] += count
+        merged.sum = self.sum + other.sum
+        merged.count = self.count + other.count
+        return merged
+
+
+class MetricsHook(object):
+    """
+    Base class of hooks, called on every counter increment and histogram
+    observation of the Metrics objects they are added to (or of all of them
+    with add_hook). Hooks run in the caller's thread, so they must be fast.
+    """
+    def incr(self, metrics, name, amount):
+        pass
+
+    def observe(self, metrics, name, value):
+        pass
+
+
+def add_hook(hook):
+    """
+    Adds a MetricsHook called for every Metrics object.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+class _Timer(object):
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.time() - self.start)
+
+
+class Metrics(CacheStats):
+    """
+    Counters (this dict) and latency histograms of a cache or a decorated
+    function, labelled `kind="name"` in the Prometheus export, kind being
+    cache or function.
+    """
+    def __init__(self, kind, name, counters=(), buckets=DEFAULT_BUCKETS):
+        super(Metrics, self).__init__(*counters)
+        self.kind = kind
+        self.name = name
+        self.buckets = buckets
+        self.histograms = {}
+        self.hooks = []
+        with _registry_lock:
+            _registry[id(self)] = self
+
+    __hash__ = object.__hash__
+
+    def incr(self, name, amount=1):
+        super(Metrics, self).incr(name, amount)
+        if self.hooks or _hooks:
+            for hook in self.hooks:
+                hook.incr(self, name, amount)
+            for hook in _hooks:
+                hook.incr(self, name, amount)
+
+    def observe(self, name, value):
+        """
+        Records `value` (seconds) in the `name` histogram.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram(self.buckets))
+        histogram.observe(value)
+        if self.hooks or _hooks:
+            for hook in self.hooks:
+                hook.observe(self, name, value)
+            for hook in _hooks:
+                hook.observe(self, name, value)
+
+    def timer(self, name):
+        """
+        Returns a context manager observing the time spent in its block.
+        """
+        return _Timer(self, name)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters, with a `latency` dict holding the
+        count, sum, p50 and p99 of every histogram.
+        """
+        snapshot = dict(self)
+        snapshot['latency'] = dict((name, histogram.snapshot())
+                                   for name, histogram in self.histograms.items())
+        return snapshot
+
+    def __repr__(self):
+        return "Metrics({0!r}, {1!r}, {2})".format(
+            self.kind, self.name, dict.__repr__(self))
+
+
+class NullMetrics(dict):
+    """
+    Stands in for the Metrics of a decorated function whose instrumentation
+    is disabled: records nothing, and isn't exported.
+    """
+    histograms = {}
+
+    def __init__(self, kind, name):
+        super(NullMetrics, self).__init__()
+        self.kind = kind
+        self.name = name
+
+    def incr(self, name, amount=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+    def add_hook(self, hook):
+        raise ValueError("metrics of {0} are disabled".format(self.name))
+
+    def snapshot(self):
+        return {'latency': {}}
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(prefix='redis_cache'):
+    """
+    Returns every registered Metrics object in the Prometheus text format,
+    counters as `<prefix>_<name>_total` and histograms as
+    `<prefix>_<name>`. Metrics with the same labels, e.g. of two caches of
+    one namespace, are added up into a single series.
+    """
+    with _registry_lock:
+        all_metrics = sorted(_registry.values(), key=lambda m: (m.kind, m.name))
+    counters = {}
+    histograms = {}
+    for metrics in all_metrics:
+        labels = '{0}="{1}"'.format(metrics.kind, _label(metrics.name))
+        for name, value in dict(metrics).items():
+            series = counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+        for name, histogram in list(metrics.histograms.items()):
+            series = histograms.setdefault(name, {})
+            series[labels] = (series[labels].merged(histogram) if labels in series
+                              else histogram)
+
+    lines = []
+    for name in sorted(counters):
+        metric = '{0}_{1}_total'.format(prefix, name)
+        lines.append('# TYPE {0} counter'.format(metric))
+        for labels, value in sorted(counters[name].items()):
+            lines.append('{0}{{{1}}} {2}'.format(metric, labels, _number(value)))
+    for name in sorted(histograms):
+        metric = '{0}_{1}'.format(prefix, name)
+        lines.append('# TYPE {0} histogram'.format(metric))
+        for labels, histogram in sorted(histograms[name].items()):
+            cumulative = 0
+            bounds = histogram.buckets + (float('inf'),)
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    metric, labels, _number(bound), cumulative))
+            lines.append('{0}_sum{{{1}}} {2}'.format(metric, labels, _number(histogram.sum)))
+            lines.append('{0}_count{{{1}}} {2}'.format(metric, labels, histogram.count))
+    return '\n'.join(lines) + '\n'
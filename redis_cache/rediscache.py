@@ -1,14 +1,601 @@
 """
 A simple redis-cache interface for storing python objects.
 """
+from collections import OrderedDict
+from datetime import timedelta
 from functools import wraps
 import pickle
 import json
+import atexit
 import hashlib
+import marshal
 import redis
+from redis.exceptions import NoScriptError
+from .backends import get_backend, register_port
+from .metrics import CACHE_COUNTERS, FUNCTION_COUNTERS, CacheStats, Metrics, NullMetrics
+from .serializers import Codec
+from .snapshot import CHUNK, ENTRY, SnapshotReader, SnapshotWriter
 import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
 
 DEFAULT_EXPIRY = 60 * 60 * 24
+DEFAULT_LOCAL_EXPIRY = 5
+
+_MISSING = object()
+
+_GLOB_SPECIAL = re.compile(r'[*?[\]\\]')
+
+
+def _size(value):
+    """
+    Approximates the number of bytes redis stores for `value`, counting the
+    chunks of a chunk manifest like the scripts' size_of.
+    """
+    if isinstance(value, text_type):
+        return len(value.encode('utf-8'))
+    if not isinstance(value, bytes):
+        return len(str(value))
+    manifest = _chunk_manifest(value)
+    return len(value) + (manifest[1] if manifest is not None else 0)
+
+
+def _glob_escape(text):
+    """
+    Escapes `text` for use in a KEYS/SCAN/SSCAN MATCH pattern.
+    """
+    return _GLOB_SPECIAL.sub(lambda m: '\\' + m.group(0), text)
+
+try:
+    from queue import Empty, Queue, Full
+except ImportError:  # python 2
+    from Queue import Empty, Queue, Full
+
+try:
+    string_types, text_type = basestring, unicode
+except NameError:  # python 3
+    string_types, text_type = str, str
+
+
+class LuaScript(object):
+    """
+    A server-side script identified by its sha1, so callers can try EVALSHA
+    first and only send the full source with EVAL when redis doesn't know it.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def ported(self, function):
+        """
+        Decorator registering function(client, keys, args) as the Python
+        port of the script, which the in-process backends run in its place
+        (see backends.py), keys and args being bytes as in Lua.
+        """
+        register_port(self.sha, function)
+        return function
+
+
+EVICTION_POLICIES = ('random', 'lru', 'lfu', 'ttl-soonest')
+
+# Lua helper shared by the scripts below, mapping a key to the redis key
+# holding its value. With namespace generations enabled (gen_prefix not
+# empty), keys of the form `namespace:rest` are stored under
+# `namespace:<generation>@rest`, the generation being read from the
+# namespace's counter, so bumping the counter orphans the whole namespace.
+DATA_KEY_LUA = """
+local generations = {}
+local function data_key(prefix, gen_prefix, key)
+    if gen_prefix ~= '' then
+        local namespace, rest = string.match(key, '^([^:]*):(.*)$')
+        if namespace then
+            local generation = generations[namespace]
+            if not generation then
+                generation = redis.call('GET', gen_prefix .. namespace) or '0'
+                generations[namespace] = generation
+            end
+            return prefix .. namespace .. ':' .. generation .. '@' .. rest
+        end
+    end
+    return prefix .. key
+end
+"""
+
+# Lua helpers for values stored in chunks (see SimpleCache.store_chunks),
+# whose data key holds a manifest `\0chunks:<count>:<length>:<base>`, chunk
+# i being stored under `<base>:<i>`. Chunks are deleted along with their
+# manifest, and get its exact ttl when it is written.
+CHUNKS_LUA = """
+local function chunks_of(value)
+    if value and string.sub(value, 1, 8) == '\\0chunks:' then
+        local count, base = string.match(value, '^%zchunks:(%d+):%d+:(.*)$')
+        if base then
+            return base, tonumber(count)
+        end
+    end
+    return nil, 0
+end
+
+local function drop_chunks(key)
+    if redis.call('GETRANGE', key, 0, 7) == '\\0chunks:' then
+        local base, count = chunks_of(redis.call('GET', key))
+        for i = 0, count - 1 do
+            redis.call('DEL', base .. ':' .. i)
+        end
+    end
+end
+
+local function adopt_chunks(value, expire)
+    local base, count = chunks_of(value)
+    for i = 0, count - 1 do
+        if expire > 0 then
+            redis.call('EXPIRE', base .. ':' .. i, expire)
+        else
+            redis.call('PERSIST', base .. ':' .. i)
+        end
+    end
+end
+"""
+
+# Lua helpers for the byte budget (see SimpleCache max_bytes): the size of
+# every key's value is kept in the sizes hash, and their sum in the bytes
+# counter. The size of a chunked value includes its chunks.
+SIZES_LUA = """
+local function size_of(value)
+    local base = chunks_of(value)
+    if base then
+        return #value + tonumber(string.match(value, '^%zchunks:%d+:(%d+):'))
+    end
+    return #value
+end
+
+local function forget_size(sizes_name, bytes_name, key)
+    local size = tonumber(redis.call('HGET', sizes_name, key))
+    if size then
+        redis.call('HDEL', sizes_name, key)
+        redis.call('DECRBY', bytes_name, size)
+    end
+end
+"""
+
+
+# Python ports of the helpers above, for the ports of the scripts.
+def _port_data_key(client, prefix, gen_prefix):
+    generations = {}
+
+    def data_key(key):
+        if gen_prefix:
+            namespace, colon, rest = key.partition(b':')
+            if colon:
+                if namespace not in generations:
+                    generations[namespace] = client.get(gen_prefix + namespace) or b'0'
+                return prefix + namespace + b':' + generations[namespace] + b'@' + rest
+        return prefix + key
+    return data_key
+
+
+def _port_chunk_names(value):
+    manifest = _chunk_manifest(value)
+    if manifest is None:
+        return []
+    return [manifest[2] + b':' + str(i).encode('ascii') for i in range(manifest[0])]
+
+
+def _port_drop_chunks(client, key):
+    names = _port_chunk_names(client.get(key))
+    if names:
+        client.delete(*names)
+
+
+def _port_adopt_chunks(client, value, expire):
+    for name in _port_chunk_names(value):
+        if expire > 0:
+            client.expire(name, expire)
+        else:
+            client.persist(name)
+
+
+def _port_size_of(value):
+    manifest = _chunk_manifest(value)
+    return len(value) + (manifest[1] if manifest is not None else 0)
+
+
+def _port_forget_size(client, sizes_name, bytes_name, key):
+    size = client.hget(sizes_name, key)
+    if size is not None:
+        client.hdel(sizes_name, key)
+        client.decrby(bytes_name, int(size))
+
+# Evicts members of the key set until there is room for the new keys, then
+# writes the values, adds the keys to the set, updates their eviction scores
+# and publishes their invalidations, all in a single round trip. Running
+# server-side also makes eviction atomic, so concurrent writers can't
+# over-evict. Eviction is accounted once for the whole batch of keys.
+# With the random policy members are SPOPed; otherwise the lowest-scored
+# members of the scores sorted set are evicted (falling back to SPOP for
+# members the sorted set doesn't know about). With a byte budget, members
+# are then evicted `batch` at a time until the new values fit, and the
+# sizes of the values are recorded. A key repeated in the batch is counted
+# once, and keys of the batch are never picked as victims. Returns the number
+# of evicted keys.
+# KEYS: set name, scores sorted set name, sizes hash name, bytes counter name
+# ARGV: data key prefix, limit, eviction policy, current time, eviction batch
+#       size, invalidation channel ('' to skip), generation counter prefix
+#       ('' without namespace generations), byte budget (0 for none),
+#       followed by a (key, value, expire) triple per entry, expire being in
+#       seconds (<= 0 for none)
+STORE_SCRIPT = LuaScript(DATA_KEY_LUA + CHUNKS_LUA + SIZES_LUA + """
+if redis.replicate_commands then redis.replicate_commands() end
+local set_name, scores_name, sizes_name, bytes_name = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local prefix, limit, policy = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local now, batch, channel = tonumber(ARGV[4]), tonumber(ARGV[5]), ARGV[6]
+local gen_prefix, max_bytes = ARGV[7], tonumber(ARGV[8])
+
+local storing, incoming_keys = {}, {}
+for i = 9, #ARGV, 3 do
+    if not storing[ARGV[i]] then
+        incoming_keys[#incoming_keys + 1] = ARGV[i]
+    end
+    storing[ARGV[i]] = i
+end
+
+local function evict(n)
+    local evicted = 0
+    if policy ~= 'random' then
+        local victims = {}
+        local ranked = redis.call('ZRANGE', scores_name, 0, n + #incoming_keys - 1)
+        for _, member in ipairs(ranked) do
+            if #victims == n then break end
+            if not storing[member] then
+                local key = data_key(prefix, gen_prefix, member)
+                drop_chunks(key)
+                redis.call('DEL', key)
+                redis.call('SREM', set_name, member)
+                forget_size(sizes_name, bytes_name, member)
+                victims[#victims + 1] = member
+            end
+        end
+        if #victims > 0 then
+            redis.call('ZREM', scores_name, unpack(victims))
+        end
+        n = n - #victims
+        evicted = #victims
+    end
+    local kept = {}
+    while n > 0 do
+        local member = redis.call('SPOP', set_name)
+        if not member then break end
+        if storing[member] then
+            kept[#kept + 1] = member
+        else
+            local key = data_key(prefix, gen_prefix, member)
+            drop_chunks(key)
+            redis.call('DEL', key)
+            forget_size(sizes_name, bytes_name, member)
+            if policy ~= 'random' then
+                redis.call('ZREM', scores_name, member)
+            end
+            n = n - 1
+            evicted = evicted + 1
+        end
+    end
+    if #kept > 0 then
+        redis.call('SADD', set_name, unpack(kept))
+    end
+    return evicted
+end
+
+local evicted = 0
+if limit > 0 then
+    local new = 0
+    for _, key in ipairs(incoming_keys) do
+        if redis.call('SISMEMBER', set_name, key) == 0 then
+            new = new + 1
+        end
+    end
+    local excess = redis.call('SCARD', set_name) + new - limit
+    if new > 0 and excess > 0 then
+        evicted = evict(math.max(excess, batch))
+    end
+end
+
+if max_bytes > 0 then
+    local incoming = 0
+    for _, key in ipairs(incoming_keys) do
+        incoming = incoming + size_of(ARGV[storing[key] + 1])
+            - (tonumber(redis.call('HGET', sizes_name, key)) or 0)
+    end
+    while incoming > 0
+            and (tonumber(redis.call('GET', bytes_name)) or 0) + incoming > max_bytes do
+        local n = evict(batch)
+        if n == 0 then break end
+        evicted = evicted + n
+    end
+end
+
+for _, key in ipairs(incoming_keys) do
+    local i = storing[key]
+    local value, expire = ARGV[i + 1], tonumber(ARGV[i + 2])
+    local stored_key = data_key(prefix, gen_prefix, key)
+    drop_chunks(stored_key)
+    if expire > 0 then
+        redis.call('SETEX', stored_key, expire, value)
+    else
+        redis.call('SET', stored_key, value)
+    end
+    adopt_chunks(value, expire)
+    if max_bytes > 0 then
+        local size = size_of(value)
+        redis.call('INCRBY', bytes_name, size
+            - (tonumber(redis.call('HGET', sizes_name, key)) or 0))
+        redis.call('HSET', sizes_name, key, size)
+    end
+    redis.call('SADD', set_name, key)
+    if policy == 'lru' then
+        redis.call('ZADD', scores_name, now, key)
+    elseif policy == 'lfu' then
+        redis.call('ZINCRBY', scores_name, 1, key)
+    elseif policy == 'ttl-soonest' then
+        redis.call('ZADD', scores_name, expire > 0 and now + expire or '+inf', key)
+    end
+    if channel ~= '' then
+        redis.call('PUBLISH', channel, 'key|' .. key)
+    end
+end
+return evicted
+""")
+
+
+@STORE_SCRIPT.ported
+def _store_port(client, keys, args):
+    set_name, scores_name, sizes_name, bytes_name = keys
+    prefix, limit, policy = args[0], int(args[1]), args[2]
+    now, batch, channel = float(args[3]), int(args[4]), args[5]
+    gen_prefix, max_bytes = args[6], int(args[7])
+    storing = OrderedDict()  # a key repeated in the batch keeps its last value
+    for i in range(8, len(args), 3):
+        storing[args[i]] = args[i + 1], int(args[i + 2])
+    data_key = _port_data_key(client, prefix, gen_prefix)
+
+    def drop(member):
+        key = data_key(member)
+        _port_drop_chunks(client, key)
+        client.delete(key)
+        _port_forget_size(client, sizes_name, bytes_name, member)
+
+    def evict(n):
+        evicted = 0
+        if policy != b'random':
+            ranked = client.zrange(scores_name, 0, n + len(storing) - 1)
+            victims = [member for member in ranked if member not in storing][:n]
+            for member in victims:
+                drop(member)
+                client.srem(set_name, member)
+            if victims:
+                client.zrem(scores_name, *victims)
+            n -= len(victims)
+            evicted = len(victims)
+        kept = []
+        while n > 0:
+            member = client.spop(set_name)
+            if member is None:
+                break
+            if member in storing:
+                kept.append(member)
+                continue
+            drop(member)
+            if policy != b'random':
+                client.zrem(scores_name, member)
+            n -= 1
+            evicted += 1
+        if kept:
+            client.sadd(set_name, *kept)
+        return evicted
+
+    evicted = 0
+    if limit > 0:
+        new = sum(1 for key in storing if not client.sismember(set_name, key))
+        excess = client.scard(set_name) + new - limit
+        if new > 0 and excess > 0:
+            evicted = evict(max(excess, batch))
+
+    if max_bytes > 0:
+        incoming = sum(_port_size_of(value) - int(client.hget(sizes_name, key) or 0)
+                       for key, (value, _) in storing.items())
+        while incoming > 0 and int(client.get(bytes_name) or 0) + incoming > max_bytes:
+            n = evict(batch)
+            if n == 0:
+                break
+            evicted += n
+
+    for key, (value, expire) in storing.items():
+        stored_key = data_key(key)
+        _port_drop_chunks(client, stored_key)
+        client.set(stored_key, value, ex=expire if expire > 0 else None)
+        _port_adopt_chunks(client, value, expire)
+        if max_bytes > 0:
+            size = _port_size_of(value)
+            client.incrby(bytes_name, size - int(client.hget(sizes_name, key) or 0))
+            client.hset(sizes_name, key, size)
+        client.sadd(set_name, key)
+        if policy == b'lru':
+            client.zadd(scores_name, {key: now})
+        elif policy == b'lfu':
+            client.zincrby(scores_name, 1, key)
+        elif policy == b'ttl-soonest':
+            client.zadd(scores_name, {key: now + expire if expire > 0 else float('inf')})
+        if channel:
+            client.publish(channel, b'key|' + key)
+    return evicted
+
+# Reads the values of keys stored with namespace generations, updating their
+# eviction scores like SimpleCache._track_access.
+# KEYS: scores sorted set name
+# ARGV: data key prefix, generation counter prefix, eviction policy, current
+#       time, followed by the keys
+FETCH_SCRIPT = LuaScript(DATA_KEY_LUA + """
+local scores_name = KEYS[1]
+local prefix, gen_prefix, policy, now = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local values = {}
+for i = 5, #ARGV do
+    values[i - 4] = redis.call('GET', data_key(prefix, gen_prefix, ARGV[i]))
+    if policy == 'lru' then
+        redis.call('ZADD', scores_name, 'XX', now, ARGV[i])
+    elseif policy == 'lfu' then
+        redis.call('ZADD', scores_name, 'XX', 'INCR', 1, ARGV[i])
+    end
+end
+return values
+""")
+
+
+@FETCH_SCRIPT.ported
+def _fetch_port(client, keys, args):
+    prefix, gen_prefix, policy, now = args[:4]
+    data_key = _port_data_key(client, prefix, gen_prefix)
+    values = []
+    for key in args[4:]:
+        values.append(client.get(data_key(key)))
+        if policy == b'lru':
+            client.zadd(keys[0], {key: float(now)}, xx=True)
+        elif policy == b'lfu':
+            client.zadd(keys[0], {key: 1}, xx=True, incr=True)
+    return values
+
+# Deletes the values of keys (and their recorded sizes), optionally removing
+# them from the key set and the scores sorted set too, and publishes an
+# invalidation message. Values are UNLINKed, so large ones are freed in the
+# background, falling back to DEL on servers older than 4.0. Returns the
+# number of values deleted.
+# KEYS: set name, scores sorted set name, sizes hash name, bytes counter name
+# ARGV: data key prefix, generation counter prefix, '1' to unindex the keys,
+#       invalidation channel ('' to skip), invalidation message, followed by
+#       the keys
+DELETE_SCRIPT = LuaScript(DATA_KEY_LUA + CHUNKS_LUA + SIZES_LUA + """
+local set_name, scores_name, sizes_name, bytes_name = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local prefix, gen_prefix, unindex = ARGV[1], ARGV[2], ARGV[3]
+local channel, message = ARGV[4], ARGV[5]
+
+local function delete(key)
+    drop_chunks(key)
+    local deleted = redis.pcall('UNLINK', key)
+    if type(deleted) == 'table' and deleted.err then
+        deleted = redis.call('DEL', key)
+    end
+    return deleted
+end
+
+local deleted = 0
+for i = 6, #ARGV do
+    deleted = deleted + delete(data_key(prefix, gen_prefix, ARGV[i]))
+    forget_size(sizes_name, bytes_name, ARGV[i])
+    if unindex == '1' then
+        redis.call('SREM', set_name, ARGV[i])
+        redis.call('ZREM', scores_name, ARGV[i])
+    end
+end
+if channel ~= '' then
+    redis.call('PUBLISH', channel, message)
+end
+return deleted
+""")
+
+
+@DELETE_SCRIPT.ported
+def _delete_port(client, keys, args):
+    set_name, scores_name, sizes_name, bytes_name = keys
+    prefix, gen_prefix, unindex, channel, message = args[:5]
+    data_key = _port_data_key(client, prefix, gen_prefix)
+    deleted = 0
+    for key in args[5:]:
+        stored_key = data_key(key)
+        _port_drop_chunks(client, stored_key)
+        deleted += client.delete(stored_key)
+        _port_forget_size(client, sizes_name, bytes_name, key)
+        if unindex == b'1':
+            client.srem(set_name, key)
+            client.zrem(scores_name, key)
+    if channel:
+        client.publish(channel, message)
+    return deleted
+
+# Removes the keys whose value no longer exists (expired, or evicted by
+# redis' maxmemory policy) from the key set and the scores sorted set, and
+# forgets their sizes. Checking and removing server-side keeps a key stored
+# meanwhile from being unindexed. Returns the number of keys removed from
+# the set.
+# KEYS: set name, scores sorted set name, sizes hash name, bytes counter name
+# ARGV: data key prefix, generation counter prefix, followed by the keys
+REAP_SCRIPT = LuaScript(DATA_KEY_LUA + CHUNKS_LUA + SIZES_LUA + """
+local reclaimed = 0
+for i = 3, #ARGV do
+    if redis.call('EXISTS', data_key(ARGV[1], ARGV[2], ARGV[i])) == 0 then
+        reclaimed = reclaimed + redis.call('SREM', KEYS[1], ARGV[i])
+        redis.call('ZREM', KEYS[2], ARGV[i])
+        forget_size(KEYS[3], KEYS[4], ARGV[i])
+    end
+end
+return reclaimed
+""")
+
+
+@REAP_SCRIPT.ported
+def _reap_port(client, keys, args):
+    data_key = _port_data_key(client, args[0], args[1])
+    reclaimed = 0
+    for key in args[2:]:
+        if not client.exists(data_key(key)):
+            reclaimed += client.srem(keys[0], key)
+            client.zrem(keys[1], key)
+            _port_forget_size(client, keys[2], keys[3], key)
+    return reclaimed
+
+
+# Process-wide registry of connection pools, so every SimpleCache (and every
+# cache_it decorated function) talking to the same server shares one pool.
+# Only pools which answered a ping are registered, so later connects to the
+# same server skip the ping.
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def reset_connection_pools():
+    """
+    Forgets every registered pool, e.g. in a freshly forked child so it won't
+    share sockets with its parent. The parent's sockets are left alone as the
+    parent still owns them.
+    """
+    global _pools_pid
+    with _pools_lock:
+        _pools.clear()
+        _pools_pid = os.getpid()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_connection_pools)
+
+
+# Deletes a lock only if it is still held by the caller's token.
+# KEYS: lock key
+# ARGV: token
+RELEASE_LOCK_SCRIPT = LuaScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+@RELEASE_LOCK_SCRIPT.ported
+def _release_lock_port(client, keys, args):
+    if client.get(keys[0]) == args[0]:
+        return client.delete(keys[0])
+    return 0
 
 
 class RedisConnect(object):
@@ -16,31 +603,232 @@ class RedisConnect(object):
     A simple object to store and pass database connection information.
     This makes the Simple Cache class a little more flexible, for cases
     where redis connection configuration needs customizing.
+    Connections are served from a connection pool shared by every
+    RedisConnect with the same configuration in the process.
     """
-    def __init__(self, host=None, port=None, db=None, password=None):
+    def __init__(self, host=None, port=None, db=None, password=None,
+                 unix_socket_path=None, max_connections=None,
+                 socket_timeout=None, socket_connect_timeout=None,
+                 socket_keepalive=None):
         self.host = host if host else 'localhost'
         self.port = port if port else 6379
         self.db = db if db else 0
         self.password = password
+        self.unix_socket_path = unix_socket_path
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.socket_keepalive = socket_keepalive
+
+    def pool_key(self):
+        return (self.host, self.port, self.db, self.password,
+                self.unix_socket_path, self.max_connections,
+                self.socket_timeout, self.socket_connect_timeout,
+                self.socket_keepalive)
+
+    def create_pool(self):
+        kwargs = {'db': self.db, 'password': self.password}
+        if self.unix_socket_path:
+            kwargs['connection_class'] = redis.UnixDomainSocketConnection
+            kwargs['path'] = self.unix_socket_path
+        else:
+            kwargs['host'] = self.host
+            kwargs['port'] = self.port
+            if self.socket_connect_timeout is not None:
+                kwargs['socket_connect_timeout'] = self.socket_connect_timeout
+            if self.socket_keepalive is not None:
+                kwargs['socket_keepalive'] = self.socket_keepalive
+        if self.max_connections is not None:
+            kwargs['max_connections'] = self.max_connections
+        if self.socket_timeout is not None:
+            kwargs['socket_timeout'] = self.socket_timeout
+        return redis.ConnectionPool(**kwargs)
 
     def connect(self):
         """
         We cannot assume that connection will succeed, as such we use a ping()
-        method in the redis client library to validate ability to contact redis.
+        method in the redis client library to validate ability to contact redis
+        the first time a pool is created for this configuration.
         RedisNoConnException is raised if we fail to ping.
         :return: redis.StrictRedis Connection Object
         """
+        key = self.pool_key()
+        with _pools_lock:
+            if _pools_pid != os.getpid():  # forked without register_at_fork
+                _pools.clear()
+            pool = _pools.get(key)
+        if pool is not None:
+            return redis.StrictRedis(connection_pool=pool)
+
+        pool = self.create_pool()
+        connection = redis.StrictRedis(connection_pool=pool)
         try:
-            redis.StrictRedis(host=self.host, port=self.port, password=self.password).ping()
-        except redis.ConnectionError as e:
+            connection.ping()
+        except (redis.ConnectionError, redis.TimeoutError) as e:
+            pool.disconnect()
             raise RedisNoConnException("Failed to create connection to redis",
-                                       (self.host,
+                                       (self.unix_socket_path or self.host,
                                         self.port)
             )
-        return redis.StrictRedis(host=self.host,
-                                 port=self.port,
-                                 db=self.db,
-                                 password=self.password)
+        with _pools_lock:
+            pool = _pools.setdefault(key, pool)
+        return redis.StrictRedis(connection_pool=pool)
+
+
+# Values stored in chunks are replaced by a manifest starting with this
+# marker (0x00 is never the first byte of a pickle, json or Codec value).
+CHUNK_MANIFEST = b'\x00chunks:'
+# Seconds chunks live until their manifest is written and gives them its
+# ttl, so that the chunks of an interrupted write go away.
+CHUNK_PENDING_TTL = 60 * 60
+
+
+def _chunk_manifest(value):
+    """
+    Returns the (count, length, base key) of a chunk manifest, or None for
+    any other value.
+    """
+    if isinstance(value, bytes) and value[:8] == CHUNK_MANIFEST:
+        count, length, base = value[8:].split(b':', 2)
+        return int(count), int(length), base
+
+
+class ChunkReader(object):
+    """
+    Read-only file-like object over an iterable of chunks, e.g. to feed a
+    chunked value to pickle.load without joining its chunks first.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._pos = 0
+
+    def _fill(self):
+        while self._pos >= len(self._chunk):
+            try:
+                self._chunk = next(self._chunks)
+            except StopIteration:
+                return False
+            self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and self._fill():
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._pos + size)
+            parts.append(self._chunk[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(view) and self._fill():
+            end = min(len(self._chunk), self._pos + len(view) - filled)
+            view[filled:filled + end - self._pos] = memoryview(self._chunk)[self._pos:end]
+            filled += end - self._pos
+            self._pos = end
+        return filled
+
+    def readline(self, size=-1):
+        parts = []
+        while size != 0 and self._fill():
+            end = self._chunk.find(b'\n', self._pos) + 1 or len(self._chunk)
+            if size > 0:
+                end = min(end, self._pos + size)
+                size -= end - self._pos
+            parts.append(self._chunk[self._pos:end])
+            self._pos = end
+            if parts[-1].endswith(b'\n'):
+                break
+        return b''.join(parts)
+
+
+class _ChunkUpload(object):
+    """
+    Writes the chunks of a value under a fresh base key, `batch` chunks per
+    pipelined round trip, then returns their manifest. With a byte budget,
+    the upload stops once the value outgrows it: the chunks written so far
+    are deleted and there is no manifest.
+    """
+    def __init__(self, cache, key, batch=8):
+        self.cache = cache
+        self.key = key
+        self.base = (cache._data_key(key) + u'\x00' + uuid.uuid4().hex).encode('utf-8')
+        self.pipe = cache.connection.pipeline(transaction=False)
+        self.batch = batch
+        self.count = 0
+        self.length = 0
+        self.too_large = False
+
+    def _name(self, i):
+        return self.base + b':' + str(i).encode('ascii')
+
+    def add(self, chunk):
+        if self.too_large:
+            return
+        self.length += len(chunk)
+        if self.cache.max_bytes and self.length > self.cache.max_bytes:
+            self.too_large = True
+            self.pipe.reset()
+            if self.count:
+                self.cache._timed(self.cache.connection.delete,
+                                  *[self._name(i) for i in range(self.count)])
+            return
+        self.pipe.set(self._name(self.count), chunk, ex=CHUNK_PENDING_TTL)
+        self.count += 1
+        if self.count % self.batch == 0:
+            self.cache._timed(self.pipe.execute)
+
+    def manifest(self):
+        """
+        :return: bytes, the manifest, or None if the value outgrew max_bytes
+        """
+        if self.too_large:
+            logging.warning("redis-simple-cache: not storing %r, larger than max_bytes",
+                            [self.key])
+            return None
+        self.cache._timed(self.pipe.execute)
+        return (CHUNK_MANIFEST + '{0}:{1}:'.format(self.count, self.length).encode('ascii')
+                + self.base)
+
+
+class _ChunkWriter(object):
+    """
+    File-like object storing what is written to it under `key`, as a plain
+    value if it stays under the cache's chunk_threshold and in chunks
+    otherwise, so a large serialized value is never held in memory at once.
+    """
+    def __init__(self, cache, key, expire):
+        self.cache = cache
+        self.key = key
+        self.expire = expire
+        self.buffer = bytearray()
+        self.upload = None
+
+    def write(self, data):
+        self.buffer.extend(data)
+        size = self.cache.chunk_size
+        if self.upload is None and len(self.buffer) > max(self.cache.chunk_threshold, size):
+            self.upload = _ChunkUpload(self.cache, self.key)
+        if self.upload is not None:
+            while len(self.buffer) >= size:
+                self.upload.add(bytes(self.buffer[:size]))
+                del self.buffer[:size]
+        return len(data)
+
+    def close(self):
+        if self.upload is None:
+            value = bytes(self.buffer)
+        else:
+            if self.buffer:
+                self.upload.add(bytes(self.buffer))
+            value = self.upload.manifest()
+            if value is None:
+                return
+        self.cache._write_items([(self.key, value, self.expire)])
 
 
 class CacheMissException(Exception):
@@ -55,6 +843,13 @@ class RedisNoConnException(Exception):
     pass
 
 
+class CircuitOpenError(redis.ConnectionError):
+    """
+    Raised instead of calling redis while a cache's circuit breaker is open.
+    """
+    pass
+
+
 class DoNotCache(Exception):
     _result = None
 
@@ -67,7 +862,596 @@ class DoNotCache(Exception):
         return self._result
 
 
-class SimpleCache(object):
+class LocalCache(object):
+    """
+    A bounded, thread-safe, in-process LRU cache used as an L1 tier in front
+    of redis. Entries expire after `expire` seconds regardless of their ttl in
+    redis, so `expire` is an upper bound on how stale an L1 hit can be when an
+    invalidation message is lost.
+    Every entry may hold several representations of the same redis value
+    (e.g. the raw string and its unpickled object), so hot reads skip both the
+    network and deserialization.
+    """
+    def __init__(self, maxsize=1024, expire=DEFAULT_LOCAL_EXPIRY):
+        self.maxsize = maxsize
+        self.expire = expire
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, kind='raw'):
+        """
+        Returns the cached representation or _MISSING.
+        """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return _MISSING
+            if entry[0] < time.time():
+                return _MISSING
+            self._data[key] = entry  # re-insert as most recently used
+            return entry[1].get(kind, _MISSING)
+
+    def set(self, key, value, kind='raw'):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < now:
+                entry = (now + self.expire, {})
+            entry[1][kind] = value
+            self._data[key] = entry
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight(object):
+    """
+    Merges concurrent calls for the same key within a process: the first
+    caller runs the function while the others wait for, and share, its
+    result (or exception).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function):
+        """
+        Returns a (result, shared) pair, shared being True for callers which
+        waited for another thread's call.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'event': threading.Event()}
+        if not leader:
+            call['event'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+
+        try:
+            call['result'] = function()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['event'].set()
+        return call['result'], False
+
+
+class Refresher(object):
+    """
+    A bounded pool of daemon threads recomputing cache entries in the
+    background. Jobs are deduplicated by key, and dropped when the queue is
+    full, in which case the entry is simply refreshed by a later call.
+    """
+    def __init__(self, workers=4, queue_size=1000):
+        self.workers = workers
+        self._queue = Queue(queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def submit(self, key, function):
+        """
+        Queues function() unless a refresh of `key` is already pending.
+        :return: bool, whether the job was queued
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((key, function))
+            except Full:
+                return False
+            self._pending.add(key)
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        return True
+
+    def _work(self):
+        while True:
+            key, function = self._queue.get()
+            try:
+                function()
+            except Exception:
+                logging.exception("redis-simple-cache background refresh failed")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+_default_refresher = Refresher()
+
+
+WRITE_BEHIND_POLICIES = ('drop', 'block')
+
+
+class WriteBehind(object):
+    """
+    A bounded queue of stores, serialized and written by a daemon thread,
+    `batch_size` stores per round trip, so that callers don't wait for them.
+    When the queue is full, stores are dropped (policy 'drop') or wait for
+    room for up to `block_timeout` seconds (policy 'block'). Pending stores
+    are flushed at exit, for up to `exit_timeout` seconds.
+    """
+    def __init__(self, queue_size=10000, batch_size=500, policy='drop',
+                 block_timeout=None, exit_timeout=5):
+        if policy not in WRITE_BEHIND_POLICIES:
+            raise ValueError("policy must be one of {0}".format(
+                ', '.join(WRITE_BEHIND_POLICIES)))
+        self.batch_size = batch_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.exit_timeout = exit_timeout
+        self.stats = CacheStats('queued', 'written', 'dropped', 'errors')
+        self._queue = Queue(queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, cache, key, value, expire, dumps, stats=None, done=None):
+        """
+        Queues the store of dumps(value) (or of value, already serialized,
+        if dumps is None) under `key`, counting it in the `stats` of the
+        decorated function once written.
+        :param done: function called once the store is written or failed,
+            if it was queued
+        :return: bool, whether the store was queued
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush, self.exit_timeout)
+        entry = (cache, key, value, expire, dumps, stats, done)
+        try:
+            if self.policy == 'block':
+                self._queue.put(entry, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(entry)
+        except Full:
+            self.stats.incr('dropped')
+            return False
+        self.stats.incr('queued')
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Waits for the queued stores to be written.
+        :return: bool, whether they were all written before the timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        queue = self._queue
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks:
+                if deadline is None:
+                    queue.all_tasks_done.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _work(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception:
+                logging.exception("redis-simple-cache write-behind failed")
+            finally:
+                for entry in batch:
+                    if entry[6] is not None:
+                        try:
+                            entry[6]()
+                        except Exception:
+                            logging.exception("redis-simple-cache write-behind callback failed")
+                    self._queue.task_done()
+
+    def _write(self, batch):
+        """
+        Writes a batch of queued stores, one round trip per cache.
+        """
+        groups = OrderedDict()
+        for cache, key, value, expire, dumps, stats, _ in batch:
+            groups.setdefault(id(cache), (cache, []))[1].append(
+                (key, value, expire, dumps, stats))
+        for cache, entries in groups.values():
+            items, written = [], []
+            for key, value, expire, dumps, stats in entries:
+                try:
+                    if dumps is not None:
+                        value = cache._dumps(dumps, value)
+                    items.append((key, value, expire))
+                    written.append(stats)
+                except Exception:
+                    logging.exception("redis-simple-cache couldn't serialize %r", key)
+                    self.stats.incr('errors')
+                    _incr(stats, 'errors')
+            try:
+                cache._store_items(items)
+            except redis.RedisError as e:
+                logging.exception(e)
+                self.stats.incr('errors', len(written))
+                for stats in written:
+                    _incr(stats, 'errors')
+            else:
+                self.stats.incr('written', len(written))
+                for stats in written:
+                    _incr(stats, 'stores')
+
+
+def _incr(stats, name):
+    if stats is not None:
+        stats.incr(name)
+
+_default_write_behind = WriteBehind()
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive connection errors or
+    timeouts, so that caches stop calling redis and decorators call their
+    function directly. While open, the cache probes redis in the background
+    every `reset_timeout` seconds (the breaker is then half-open), and the
+    breaker closes again once a probe succeeds.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == 'closed'
+
+    def record_success(self):
+        # Only the half-open probe closes an open breaker: a round trip that
+        # started before it opened may still succeed afterwards.
+        if self.failures or self.state == 'half-open':
+            with self._lock:
+                if self.state != 'open':
+                    self.failures = 0
+                    self.state = 'closed'
+
+    def record_failure(self):
+        """
+        :return: bool, whether this failure opened the breaker
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or (
+                    self.state == 'closed' and self.failures >= self.failure_threshold):
+                opening = self.state == 'closed'
+                self.state = 'open'
+                if opening:
+                    self.opened += 1
+                return opening
+            return False
+
+    def half_open(self):
+        with self._lock:
+            self.state = 'half-open'
+
+    def __repr__(self):
+        return "CircuitBreaker(state={0}, failures={1})".format(self.state, self.failures)
+
+
+class CostPolicy(object):
+    """
+    Decides whether and for how long cache_it stores a result, from the time
+    it took to compute and its serialized size: results cheaper to recompute
+    than to fetch aren't worth a slot of the cache.
+    :param min_compute_time: results computed faster (in seconds) aren't
+        cached
+    :param min_cost_per_byte: results computed in less seconds per byte
+        aren't cached
+    :param scale_ttl: scale the ttl by the result's cost per byte relative
+        to `reference_cost_per_byte`, within [min_ttl, max_ttl]. max_ttl
+        defaults to the decorator's expire, so that only cheap results
+        expire sooner. With the ttl-soonest eviction policy, this also
+        makes cheap results evicted first.
+    """
+    def __init__(self, min_compute_time=0, min_cost_per_byte=0,
+                 scale_ttl=False, reference_cost_per_byte=1e-6, min_ttl=1,
+                 max_ttl=None):
+        self.min_compute_time = min_compute_time
+        self.min_cost_per_byte = min_cost_per_byte
+        self.scale_ttl = scale_ttl
+        self.reference_cost_per_byte = reference_cost_per_byte
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+
+    def ttl(self, compute_time, size, expire):
+        """
+        :param expire: ttl of the decorator in seconds, 0 for none
+        :return: ttl to store the result with in seconds (0 for none), or
+            None not to store it
+        """
+        cost = compute_time / float(max(size, 1))
+        if compute_time < self.min_compute_time or cost < self.min_cost_per_byte:
+            return None
+        if not self.scale_ttl or not expire:
+            return expire
+        max_ttl = self.max_ttl or expire
+        ttl = expire * cost / self.reference_cost_per_byte
+        return int(max(self.min_ttl, min(max_ttl, ttl)))
+
+
+class BulkProgress(object):
+    """
+    Progress of a bulk operation (see SimpleCache.flush), updated as it runs.
+    `scanned` counts the keys read from the index (SSCAN may return a key
+    more than once) and `deleted` the values actually deleted.
+    """
+    def __init__(self):
+        self.scanned = 0
+        self.deleted = 0
+        self.error = None
+        self.finished = threading.Event()
+
+    def run(self, work):
+        try:
+            work(self)
+        except Exception as e:
+            self.error = e
+            logging.exception("redis-simple-cache bulk operation failed")
+        finally:
+            self.finished.set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the operation to finish.
+        :return: bool, whether it finished
+        """
+        return self.finished.wait(timeout)
+
+    def __repr__(self):
+        return "BulkProgress(scanned={0}, deleted={1}, finished={2})".format(
+            self.scanned, self.deleted, self.finished.is_set())
+
+
+class BaseCache(object):
+    """
+    Key naming and helpers shared by SimpleCache and its asyncio counterpart,
+    so both read and write the same redis layout.
+    """
+    local_cache = None
+    publish_invalidations = True
+    namespace_generations = False
+    metrics = None
+    max_bytes = None
+    circuit_breaker = None
+
+    def available(self, key=None):
+        """
+        Whether the cache should be used: it has a connection and its circuit
+        breaker (if any) is closed. Decorators call their function directly
+        otherwise.
+        :param key: the key about to be used, for caches whose availability
+            depends on it (see ShardedCache)
+        """
+        return self.connection is not None and (
+            self.circuit_breaker is None or self.circuit_breaker.closed)
+
+    def make_key(self, key):
+        return "SimpleCache-{0}:{1}".format(self.prefix, key)
+
+    def namespace_key(self, namespace):
+        return self.make_key(namespace + ':*')
+
+    def get_set_name(self):
+        return "SimpleCache-{0}-keys".format(self.prefix)
+
+    def get_scores_name(self):
+        return "SimpleCache-{0}-scores".format(self.prefix)
+
+    def get_sizes_name(self):
+        return "SimpleCache-{0}-sizes".format(self.prefix)
+
+    def get_bytes_name(self):
+        return "SimpleCache-{0}-bytes".format(self.prefix)
+
+    def _index_names(self):
+        return [self.get_set_name(), self.get_scores_name(),
+                self.get_sizes_name(), self.get_bytes_name()]
+
+    def make_lock_key(self, key):
+        return "SimpleCache-{0}-lock:{1}".format(self.prefix, key)
+
+    def get_channel_name(self):
+        return "SimpleCache-{0}-invalidations".format(self.prefix)
+
+    def get_generation_name(self, namespace):
+        return "SimpleCache-{0}-gen:{1}".format(self.prefix, namespace)
+
+    def _generation_prefix(self):
+        return self.get_generation_name('') if self.namespace_generations else ''
+
+    def _generation_key(self, key, generation):
+        """
+        Returns the redis key of a `namespace:rest` key in `generation`.
+        """
+        namespace, rest = key.split(u':', 1)
+        return self.make_key(u'{0}:{1}@{2}'.format(
+            namespace, to_unicode(generation or 0), rest))
+
+    def _invalidate_local(self, op, arg=''):
+        if self.local_cache is None:
+            return
+        if op == 'key':
+            self.local_cache.delete(arg)
+        elif op == 'prefix':
+            self.local_cache.delete_prefix(arg)
+        else:
+            self.local_cache.clear()
+
+    def _invalidation_message(self, op, arg=''):
+        """
+        Drops the local L1 copies and returns the (channel, message) pair to
+        publish for every process, or (u'', u'') if publishing is disabled.
+        Messages are formatted as `op|arg`, op being one of key, prefix or
+        all. This process receives its own message too, which drops any copy
+        re-read by another thread before the write was executed.
+        """
+        self._invalidate_local(op, arg)
+        if not self.publish_invalidations:
+            return u'', u''
+        return self.get_channel_name(), u"{0}|{1}".format(op, arg)
+
+    def _publish_invalidation(self, pipe, op, arg=''):
+        """
+        Queues the invalidation message on `pipe`, so no extra round trip is
+        needed.
+        """
+        channel, message = self._invalidation_message(op, arg)
+        if channel:
+            pipe.publish(channel, message)
+
+    def _track_access(self, pipe, keys):
+        """
+        Queues the score updates on `pipe` for keys that were just read.
+        ZADD XX only touches keys which are still indexed.
+        """
+        scores_name = self.get_scores_name()
+        if self.eviction_policy == 'lru':
+            now = '%.6f' % time.time()
+            args = []
+            for key in keys:
+                args.extend((now, key))
+            pipe.execute_command('ZADD', scores_name, 'XX', *args)
+        elif self.eviction_policy == 'lfu':
+            for key in keys:
+                pipe.execute_command('ZADD', scores_name, 'XX', 'INCR', 1, key)
+
+    def _store_script_args(self, items):
+        """
+        Returns the (keys, args) pair for running STORE_SCRIPT on a list of
+        (key, value, expire) items.
+        """
+        args = [self.make_key(''), self.limit or 0, self.eviction_policy,
+                '%.6f' % time.time(), self.eviction_batch,
+                self.get_channel_name() if self.publish_invalidations else '',
+                self._generation_prefix(), self.max_bytes or 0]
+        for key, value, expire in items:
+            key = to_unicode(key)
+            self._invalidate_local('key', key)
+            args.extend((key, value, self._expire_seconds(expire)))
+        return self._index_names(), args
+
+    def _fetch_script_args(self, keys):
+        """
+        Returns the (keys, args) pair for running FETCH_SCRIPT on `keys`.
+        """
+        args = [self.make_key(''), self._generation_prefix(),
+                self.eviction_policy, '%.6f' % time.time()]
+        return [self.get_scores_name()], args + list(keys)
+
+    def _delete_script_args(self, keys, unindex, op, arg=''):
+        """
+        Returns the (keys, args) pair for running DELETE_SCRIPT on `keys`,
+        publishing the `op` invalidation (none if op is None).
+        """
+        channel, message = u'', u''
+        if op is not None:
+            channel, message = self._invalidation_message(op, arg)
+        args = [self.make_key(''), self._generation_prefix(),
+                '1' if unindex else '0', channel, message]
+        return self._index_names(), args + list(keys)
+
+    def _reap_script_args(self, keys):
+        """
+        Returns the (keys, args) pair for running REAP_SCRIPT on `keys`.
+        """
+        args = [self.make_key(''), self._generation_prefix()]
+        return self._index_names(), args + list(keys)
+
+    def _dumps(self, dumps, value):
+        if self.metrics is None:
+            return dumps(value)
+        with self.metrics.timer('serialize_seconds'):
+            return dumps(value)
+
+    def _loads(self, loads, data):
+        if self.metrics is None:
+            return loads(data)
+        with self.metrics.timer('deserialize_seconds'):
+            return loads(data)
+
+    def _expire_seconds(self, expire):
+        """
+        Normalizes an expire value (None for the cache default, int seconds
+        or timedelta) to int seconds, 0 meaning the key never expires.
+        """
+        if expire is None:
+            expire = self.expire
+        if isinstance(expire, timedelta):
+            expire = int(expire.total_seconds())
+        if expire is None or expire <= 0:
+            return 0
+        return int(expire)
+
+    def get_hash(self, args):
+        if self.hashkeys:
+            if isinstance(args, text_type):
+                args = args.encode('utf-8')
+            key = hashlib.md5(args).hexdigest()
+        else:
+            key = pickle.dumps(args)
+        return key
+
+
+class SimpleCache(BaseCache):
     def __init__(self,
                  limit=10000,
                  expire=DEFAULT_EXPIRY,
@@ -76,7 +1460,27 @@ class SimpleCache(object):
                  port=None,
                  db=None,
                  password=None,
-                 namespace="SimpleCache"):
+                 namespace="SimpleCache",
+                 local_cache_size=0,
+                 local_cache_expire=DEFAULT_LOCAL_EXPIRY,
+                 publish_invalidations=True,
+                 eviction_policy='random',
+                 eviction_batch=1,
+                 unix_socket_path=None,
+                 max_connections=None,
+                 socket_timeout=None,
+                 socket_connect_timeout=None,
+                 socket_keepalive=None,
+                 codec=None,
+                 namespace_generations=False,
+                 metrics=False,
+                 chunk_threshold=None,
+                 chunk_size=1 << 20,
+                 max_bytes=None,
+                 timeout=None,
+                 circuit_breaker=None,
+                 reconnect_interval=None,
+                 backend=None):
 
         self.limit = limit  # No of json encoded strings to cache
         self.expire = expire  # Time to keys to expire in seconds
@@ -85,57 +1489,339 @@ class SimpleCache(object):
         self.port = port
         self.db = db
 
-        try:
-            self.connection = RedisConnect(host=self.host,
+        # `timeout` is the default of the pool's socket and connect timeouts,
+        # so that a slow server can't stall callers for the default ones.
+        if timeout is not None:
+            if socket_timeout is None:
+                socket_timeout = timeout
+            if socket_connect_timeout is None:
+                socket_connect_timeout = timeout
+
+        # Stops calling redis after repeated connection errors or timeouts,
+        # until a background probe succeeds (see CircuitBreaker).
+        if circuit_breaker is True:
+            circuit_breaker = CircuitBreaker()
+        self.circuit_breaker = circuit_breaker or None
+        self._recovering = False
+        self._recovery_lock = threading.Lock()
+
+        # Where the data lives: redis by default, else the process' own
+        # memory ('memory'), a database in shared memory used by every
+        # process of the host ('shared') or a backend object, see
+        # backends.py. Backends stand in for the redis connection.
+        self.backend = backend
+        if backend is not None and backend != 'redis':
+            self._connector = None
+            self.connection = get_backend(backend)
+        else:
+            self._connector = RedisConnect(host=self.host,
                                            port=self.port,
                                            db=self.db,
-                                           password=password).connect()
-        except RedisNoConnException, e:
-            self.connection = None
-            pass
+                                           password=password,
+                                           unix_socket_path=unix_socket_path,
+                                           max_connections=max_connections,
+                                           socket_timeout=socket_timeout,
+                                           socket_connect_timeout=socket_connect_timeout,
+                                           socket_keepalive=socket_keepalive)
+            try:
+                self.connection = self._connector.connect()
+            except RedisNoConnException as e:
+                self.connection = None
+                # Keep retrying in the background rather than leaving caching
+                # off for the life of the process
+                if reconnect_interval is None and self.circuit_breaker is not None:
+                    reconnect_interval = self.circuit_breaker.reset_timeout
+                if reconnect_interval:
+                    self._start_recovery(reconnect_interval)
 
         # Should we hash keys? There is a very small risk of collision invloved.
         self.hashkeys = hashkeys
 
-    def make_key(self, key):
-        return "SimpleCache-{0}:{1}".format(self.prefix, key)
+        # Serializer of store_encoded/get_decoded, see serializers.Codec
+        self.codec = codec or Codec()
+
+        # Store `namespace:key` keys under a per namespace generation, making
+        # expire_namespace and flush_namespace O(1) counter increments. The
+        # entries of older generations are left to expire or to
+        # cleanup_generations().
+        self.namespace_generations = namespace_generations
+
+        # Counters and latency histograms (see metrics.Metrics), off by
+        # default so that uninstrumented caches only pay for `is None` checks.
+        if metrics:
+            self.metrics = Metrics('cache', namespace, CACHE_COUNTERS)
+
+        # Values longer than chunk_threshold bytes are written as chunks of
+        # chunk_size bytes under a small manifest value, so that no single
+        # huge value blocks redis, and can be read back as a stream.
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+
+        # Which keys to drop once the limit is reached. Every policy but
+        # random keeps a score per key in a sorted set, and evicts the lowest
+        # scored keys `eviction_batch` at a time.
+        if eviction_policy not in EVICTION_POLICIES:
+            raise ValueError("eviction_policy must be one of {0}".format(
+                ', '.join(EVICTION_POLICIES)))
+        self.eviction_policy = eviction_policy
+        self.eviction_batch = eviction_batch
+
+        # Budget of the values' bytes (as stored, chunks included), on top of
+        # `limit`. Stores evict in the eviction policy's order until new
+        # values fit. Every cache writing to the namespace must set it, for
+        # sizes to be tracked.
+        self.max_bytes = max_bytes
+
+        # Optional in-process L1 tier. Writers publish invalidations on a
+        # pub/sub channel so that L1 copies in other processes are dropped.
+        self.publish_invalidations = publish_invalidations
+        self.local_cache = None
+        if local_cache_size > 0:
+            self.local_cache = LocalCache(local_cache_size, local_cache_expire)
+            if self.connection is not None:
+                self._start_listener()
+
+    def _start_listener(self):
+        listener = threading.Thread(target=self._listen_invalidations)
+        listener.daemon = True
+        listener.start()
+
+    def _start_recovery(self, interval):
+        """
+        Probes redis every `interval` seconds in a daemon thread until it
+        answers, then closes the circuit breaker, or sets the connection if
+        the cache was created without one.
+        """
+        with self._recovery_lock:
+            if self._recovering:
+                return
+            self._recovering = True
+
+        def run():
+            breaker = self.circuit_breaker
+            while True:
+                time.sleep(interval)
+                if breaker is not None:
+                    breaker.half_open()
+                try:
+                    if self.connection is None:
+                        connection = self._connector.connect()
+                    else:
+                        connection = self.connection
+                        connection.ping()
+                except (RedisNoConnException, redis.RedisError):
+                    if breaker is not None:
+                        breaker.record_failure()
+                    continue
+                reconnected = self.connection is None
+                self.connection = connection
+                if breaker is not None:
+                    breaker.record_success()
+                with self._recovery_lock:
+                    self._recovering = False
+                if reconnected and self.local_cache is not None:
+                    self._start_listener()
+                return
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+    def _run_script(self, script, keys, args):
+        """
+        Runs a LuaScript with EVALSHA, falling back to EVAL (which also caches
+        the script server-side) if redis doesn't have it yet.
+        """
+        try:
+            return self._timed(self.connection.evalsha, script.sha, len(keys),
+                               *(keys + args))
+        except NoScriptError:
+            return self._timed(self.connection.eval, script.source, len(keys),
+                               *(keys + args))
 
-    def namespace_key(self, namespace):
-        return self.make_key(namespace + ':*')
+    def _timed(self, function, *args):
+        """
+        Calls `function`, a redis round trip, recording its latency and
+        errors if metrics are enabled, and its outcome in the circuit
+        breaker, if any. Raises CircuitOpenError while the breaker is open.
+        """
+        metrics = self.metrics
+        breaker = self.circuit_breaker
+        if metrics is None and breaker is None:
+            return function(*args)
+        if breaker is not None and not breaker.closed:
+            raise CircuitOpenError("redis-simple-cache circuit breaker is open")
+        start = time.time()
+        try:
+            result = function(*args)
+        except NoScriptError:
+            raise
+        except redis.RedisError as e:
+            if metrics is not None:
+                metrics.incr('errors')
+            self._record_failure(e)
+            raise
+        finally:
+            if metrics is not None:
+                metrics.observe('redis_seconds', time.time() - start)
+        if breaker is not None:
+            breaker.record_success()
+        return result
+
+    def _record_failure(self, error):
+        """
+        Records a failed redis round trip in the circuit breaker, if any,
+        starting the background probe when it opens.
+        """
+        breaker = self.circuit_breaker
+        if (breaker is not None and isinstance(error, (redis.ConnectionError, redis.TimeoutError))
+                and not isinstance(error, CircuitOpenError) and breaker.record_failure()):
+            logging.warning("redis-simple-cache circuit breaker opened: %s", error)
+            self._start_recovery(breaker.reset_timeout)
 
-    def get_set_name(self):
-        return "SimpleCache-{0}-keys".format(self.prefix)
+    def _acquire_lock(self, key, token, timeout):
+        """
+        Takes the lock of `key` for `timeout` seconds unless it is held.
+        :return: bool, whether the lock was taken
+        """
+        return self._timed(lambda: self.connection.set(self.make_lock_key(key), token, nx=True,
+                                                       px=int(timeout * 1000)))
+
+    def _release_lock(self, key, token):
+        """
+        Releases the lock of `key` if it is still held with `token`.
+        """
+        self._run_script(RELEASE_LOCK_SCRIPT, [self.make_lock_key(key)], [token])
+
+    def _listen_invalidations(self):
+        """
+        Runs in a daemon thread for caches with an L1 tier, dropping local
+        entries invalidated by other processes. The L1 is cleared whenever the
+        subscription is (re)established, as messages may have been missed.
+        Subscribing goes through the circuit breaker, and a broken
+        subscription counts as a failure.
+        """
+        while True:
+            subscribed = False
+            try:
+                pubsub = self.connection.pubsub()
+                self._timed(pubsub.subscribe, self.get_channel_name())
+                subscribed = True
+                self.local_cache.clear()
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    data = message['data']
+                    if isinstance(data, bytes):
+                        data = data.decode('utf-8')
+                    op, arg = data.split(u'|', 1)
+                    self._invalidate_local(op, arg)
+            except redis.RedisError as e:
+                if subscribed:  # failures of the subscribe were recorded by _timed
+                    self._record_failure(e)
+                self.local_cache.clear()
+                time.sleep(1)
 
     def store(self, key, value, expire=None):
         """
         Method stores a value after checking for space constraints and
-        freeing up space if required.
+        freeing up space if required. Eviction and the write itself run in a
+        single server-side script, i.e. a single round trip.
         :param key: key by which to reference datum being stored in Redis
         :param value: actual value being stored under this key
         :param expire: time-to-live (ttl) for this datum
         """
-        key = to_unicode(key)
-        value = to_unicode(value)
-        set_name = self.get_set_name()
-
-        while self.connection.scard(set_name) >= self.limit:
-            del_key = self.connection.spop(set_name)
-            self.connection.delete(self.make_key(del_key))
-
-        pipe = self.connection.pipeline()
-        if expire is None:
-            expire = self.expire
-
-        if (isinstance(expire, int) and expire <= 0) or (expire is None):
-            pipe.set(self.make_key(key), value)
-        else:
-            pipe.setex(self.make_key(key), expire, value)
+        self._store_items([(key, value, expire)])
 
-        pipe.sadd(set_name, key)
-        pipe.execute()
-
-
-    def expire_all_in_set(self):
+    def store_chunks(self, key, chunks, expire=None):
+        """
+        Stores a value given as an iterable of byte strings (or memoryviews),
+        each of them written to its own redis key with pipelining, then
+        stores a manifest of the chunks under `key`. The chunks get the ttl
+        of the manifest and are deleted with it, atomically, by the store,
+        eviction and invalidation scripts.
+        :param key: key by which to reference datum being stored in Redis
+        :param chunks: iterable of byte strings
+        :param expire: time-to-live (ttl) for this datum
+        :return: int, 1 if the value was stored, 0 if it is larger than
+            max_bytes
+        """
+        upload = _ChunkUpload(self, key)
+        for chunk in chunks:
+            upload.add(chunk)
+            if upload.too_large:
+                break
+        manifest = upload.manifest()
+        if manifest is None:
+            return 0
+        return self._write_items([(key, manifest, expire)])
+
+    def _store_items(self, items):
+        """
+        Stores a list of (key, value, expire) items in a single round trip,
+        but for the values longer than chunk_threshold, which are stored with
+        store_chunks.
+        :return: int, number of values written (not those over max_bytes)
+        """
+        stored = 0
+        if self.chunk_threshold is not None:
+            small = []
+            for key, value, expire in items:
+                if isinstance(value, (bytes, bytearray)) and len(value) > self.chunk_threshold:
+                    view = memoryview(value)
+                    stored += self.store_chunks(key, (view[i:i + self.chunk_size] for i
+                                                      in range(0, len(view), self.chunk_size)),
+                                                expire)
+                else:
+                    small.append((key, value, expire))
+            items = small
+        return stored + self._write_items(items)
+
+    def _write_items(self, items):
+        """
+        Writes a list of (key, value, expire) items, unchunked, in a single
+        round trip.
+        :return: int, number of values written (not those over max_bytes)
+        """
+        if self.max_bytes:
+            too_large = [key for key, value, _ in items if _size(value) > self.max_bytes]
+            if too_large:
+                logging.warning("redis-simple-cache: not storing %r, larger than max_bytes",
+                                too_large)
+                items = [item for item in items if _size(item[1]) <= self.max_bytes]
+        if items:
+            evicted = self._run_script(STORE_SCRIPT, *self._store_script_args(items))
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.incr('stores', len(items))
+                metrics.incr('bytes_written', sum(_size(value) for _, value, _ in items))
+                metrics.incr('evictions', evicted or 0)
+        return len(items)
+
+    def store_many(self, mapping, expire=None, chunk_size=1000):
+        """
+        Method stores many values, one round trip per `chunk_size` values,
+        freeing up space once per chunk if required.
+        :param mapping: dict (or iterable of pairs) of keys and values
+        :param expire: time-to-live (ttl) for these data
+        :param chunk_size: number of values per round trip
+        :return: int, number of values stored, not counting those larger than
+            max_bytes
+        """
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        stored = 0
+        items = []
+        for key, value in mapping:
+            items.append((key, value, expire))
+            if len(items) >= chunk_size:
+                stored += self._store_items(items)
+                items = []
+        return stored + self._store_items(items)
+
+
+    def expire_all_in_set(self, chunk_size=1000, rate_limit=None,
+                          background=False):
         """
         Method expires all keys in the namespace of this object.
         At times there is  a need to invalidate cache in bulk, because a
@@ -144,16 +1830,111 @@ class SimpleCache(object):
         Method returns a tuple where first value is total number of keys in
         the set of this object's namespace and second value is a number of
         keys successfully expired.
+        The set is read with SSCAN and values are deleted `chunk_size` at a
+        time, so neither the client nor the server handle the whole set at
+        once.
+        :param chunk_size: number of keys per round trip
+        :param rate_limit: maximum number of keys per second, if set
+        :param background: run in a daemon thread and return its BulkProgress
         :return: int, int
         """
-        all_members = self.keys()
-        keys  = [self.make_key(k) for k in all_members]
+        progress = self._bulk_delete(False, chunk_size, rate_limit, background)
+        if background:
+            return progress
+        return len(self), progress.deleted
 
-        with self.connection.pipeline() as pipe:
-            pipe.delete(*keys)
-            pipe.execute()
+    def _bulk_delete(self, unindex, chunk_size, rate_limit, background):
+        """
+        Deletes the values of every key in the set, chunk by chunk, removing
+        the keys from the set too if `unindex`, and publishes an `all`
+        invalidation once done.
+        :return: BulkProgress
+        """
+        def delete(members):
+            return self._run_script(DELETE_SCRIPT, *self._delete_script_args(
+                members, unindex, None))
+
+        def done():
+            with self.connection.pipeline() as pipe:
+                self._publish_invalidation(pipe, 'all')
+                pipe.execute()
+
+        return self._scan_index(delete, chunk_size, rate_limit, background, done)
+
+    def reap(self, chunk_size=1000, rate_limit=None, background=False):
+        """
+        Removes the keys whose value no longer exists from the key set, so
+        that len() and the limit count live keys only, and eviction doesn't
+        pick dead keys. Keys are otherwise only unindexed when a get or mget
+        misses them. The set is read with SSCAN, and every chunk is checked
+        and pruned by a script in a single round trip.
+        :param chunk_size: number of keys per round trip
+        :param rate_limit: maximum number of keys per second, if set
+        :param background: run in a daemon thread
+        :return: BulkProgress, whose `deleted` is the number of reclaimed keys
+        """
+        return self._scan_index(self._reap, chunk_size, rate_limit, background)
+
+    def _reap(self, keys):
+        reclaimed = self._run_script(REAP_SCRIPT, *self._reap_script_args(keys))
+        if self.metrics is not None:
+            self.metrics.incr('reclaimed', reclaimed)
+        return reclaimed
+
+    def start_reaper(self, interval=60, chunk_size=1000, rate_limit=10000):
+        """
+        Runs reap() every `interval` seconds in a daemon thread. The
+        BulkProgress of the latest run is kept in `last_reap`.
+        :return: the started thread
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.last_reap = self.reap(chunk_size, rate_limit)
+                except redis.RedisError:
+                    logging.exception("redis-simple-cache reaper failed")
+
+        self.last_reap = None
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
 
-        return len(self), len(all_members)
+    def _scan_index(self, handle, chunk_size, rate_limit, background, done=None):
+        """
+        Calls handle(keys) on every chunk of the key set, read with SSCAN, at
+        most `rate_limit` keys per second, then done() if given. The results
+        of handle are added up in the progress' `deleted`.
+        :return: BulkProgress
+        """
+        def work(progress):
+            started = time.time()
+            set_name = self.get_set_name()
+            cursor = 0
+            while True:
+                cursor, members = self.connection.sscan(set_name, cursor,
+                                                        count=chunk_size)
+                if members:
+                    progress.deleted += handle([to_unicode(m) for m in members])
+                    progress.scanned += len(members)
+                if int(cursor) == 0:
+                    break
+                if rate_limit:
+                    time.sleep(max(0, started + progress.scanned / float(rate_limit)
+                                   - time.time()))
+            if done is not None:
+                done()
+
+        progress = BulkProgress()
+        if background:
+            thread = threading.Thread(target=progress.run, args=(work,))
+            thread.daemon = True
+            thread.start()
+        else:
+            work(progress)
+            progress.finished.set()
+        return progress
 
     def expire_namespace(self, namespace):
         """
@@ -164,15 +1945,138 @@ class SimpleCache(object):
         Method returns a tuple where first value is total number of keys in
         the set of this object's namespace and second value is a number of
         keys successfully expired.
+        With namespace generations, the namespace's generation is incremented
+        instead, which is O(1), and the second value is None as the expired
+        keys aren't counted. Otherwise the keys of the namespace are read
+        from the key set with SSCAN, which doesn't block the server like
+        KEYS, and their values deleted by the delete script, which forgets
+        their sizes too.
         :return: int, int
         """
-        namespace = self.namespace_key(namespace)
-        all_members = list(self.connection.keys(namespace))
-        with self.connection.pipeline() as pipe:
-            pipe.delete(*all_members)
-            pipe.execute()
+        namespace = to_unicode(namespace)
+        if self.namespace_generations:
+            expired = None
+            with self.connection.pipeline() as pipe:
+                pipe.incr(self.get_generation_name(namespace))
+                self._publish_invalidation(pipe, 'prefix', namespace + ':')
+                pipe.execute()
+        else:
+            expired = self._scan_namespace(namespace, lambda members: self._run_script(
+                DELETE_SCRIPT, *self._delete_script_args(members, False, None)))
+            with self.connection.pipeline() as pipe:
+                self._publish_invalidation(pipe, 'prefix', namespace + ':')
+                pipe.execute()
+
+        return len(self), expired
+
+    def _delete_matching(self, pattern, count=1000):
+        """
+        Deletes the keys matching `pattern`, `count` at a time.
+        :return: int, number of keys deleted
+        """
+        deleted = 0
+        batch = []
+        for key in self.connection.scan_iter(match=pattern, count=count):
+            batch.append(key)
+            if len(batch) >= count:
+                deleted += self.connection.delete(*batch)
+                batch = []
+        if batch:
+            deleted += self.connection.delete(*batch)
+        return deleted
+
+    def _scan_namespace(self, namespace, handle, count=1000):
+        """
+        Calls handle(keys) on the keys of `namespace` in the key set, read
+        with SSCAN, `count` at a time.
+        :return: int, sum of the results of handle
+        """
+        members = self.connection.sscan_iter(
+            self.get_set_name(), match=_glob_escape(namespace) + ':*', count=count)
+        total = 0
+        batch = []
+        for member in members:
+            batch.append(to_unicode(member))
+            if len(batch) >= count:
+                total += handle(batch)
+                batch = []
+        if batch:
+            total += handle(batch)
+        return total
+
+    def _unindex_namespace(self, namespace, count=1000):
+        """
+        Removes the keys of `namespace` from the key set and the scores
+        sorted set, `count` at a time.
+        """
+        self._scan_namespace(namespace, self._unindex, count)
 
-        return len(self), len(all_members)
+    def _unindex(self, members):
+        # Only unindexes keys whose value is gone, forgetting their sizes
+        return self._run_script(REAP_SCRIPT, *self._reap_script_args(members))
+
+    def cleanup_generations(self, count=1000):
+        """
+        Deletes the entries left behind by expire_namespace and
+        flush_namespace under namespace generations, using SCAN so the server
+        isn't blocked. Entries also go away on their own as they expire.
+        :param count: number of keys to scan and delete per round trip
+        :return: int, number of entries deleted
+        """
+        prefix = self.make_key('')
+        generations = {}
+        deleted = 0
+        batch = []
+        for key in self.connection.scan_iter(match=_glob_escape(prefix) + '*',
+                                              count=count):
+            parts = to_unicode(key)[len(prefix):].split(u':', 1)
+            if len(parts) < 2 or u'@' not in parts[1]:
+                continue
+            namespace = parts[0]
+            generation = parts[1].split(u'@', 1)[0]
+            if not generation.isdigit():
+                continue
+            if namespace not in generations:
+                generations[namespace] = int(self.connection.get(
+                    self.get_generation_name(namespace)) or 0)
+            if int(generation) < generations[namespace]:
+                batch.append(key)
+                if len(batch) >= count:
+                    deleted += self.connection.delete(*batch)
+                    batch = []
+        if batch:
+            deleted += self.connection.delete(*batch)
+        return deleted
+
+    def start_generation_cleanup(self, interval=300, count=1000):
+        """
+        Runs cleanup_generations() every `interval` seconds in a daemon
+        thread.
+        :return: the started thread
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.cleanup_generations(count)
+                except redis.RedisError:
+                    logging.exception("redis-simple-cache generation cleanup failed")
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _data_key(self, key):
+        """
+        Returns the redis key holding the value of `key`.
+        """
+        key = to_unicode(key)
+        if self.namespace_generations and u':' in key:
+            namespace = key.split(u':', 1)[0]
+            return self._generation_key(
+                key, self.connection.get(self.get_generation_name(namespace)))
+        return self.make_key(key)
 
     def isexpired(self, key):
         """
@@ -183,7 +2087,7 @@ class SimpleCache(object):
         """
         ttl = self.connection.pttl("SimpleCache-{0}".format(key))
         if ttl == -2: # not exist
-            ttl = self.connection.pttl(self.make_key(key))
+            ttl = self.connection.pttl(self._data_key(key))
         elif ttl == -1:
             return True
         if not ttl is None:
@@ -192,24 +2096,165 @@ class SimpleCache(object):
             return self.connection.pttl("{0}:{1}".format(self.prefix, key))
 
     def store_json(self, key, value, expire=None):
-        self.store(key, json.dumps(value), expire)
+        self.store(key, self._dumps(json.dumps, value), expire)
 
     def store_pickle(self, key, value, expire=None):
-        self.store(key, pickle.dumps(value), expire)
+        if self.chunk_threshold is None:
+            self.store(key, self._dumps(pickle.dumps, value), expire)
+        else:
+            # Streams the pickle into chunks instead of building it whole
+            writer = _ChunkWriter(self, key, expire)
+            self._dumps(lambda value: pickle.dump(value, writer), value)
+            writer.close()
+
+    def store_encoded(self, key, value, expire=None, codec=None):
+        """
+        Stores a value encoded by `codec` (defaults to the cache's codec).
+        """
+        self.store(key, self._dumps((codec or self.codec).dumps, value), expire)
+
+    def store_many_encoded(self, mapping, expire=None, chunk_size=1000,
+                           codec=None):
+        codec = codec or self.codec
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        return self.store_many(((k, self._dumps(codec.dumps, v)) for k, v in mapping),
+                               expire, chunk_size)
+
+    def store_many_json(self, mapping, expire=None, chunk_size=1000):
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        return self.store_many(((k, self._dumps(json.dumps, v)) for k, v in mapping),
+                               expire, chunk_size)
+
+    def store_many_pickle(self, mapping, expire=None, chunk_size=1000):
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        return self.store_many(((k, self._dumps(pickle.dumps, v)) for k, v in mapping),
+                               expire, chunk_size)
 
     def get(self, key):
+        return self._get(key)
+
+    def _get(self, key, join_chunks=True):
+        """
+        Fetches a value, joining the chunks of chunked values unless
+        `join_chunks` is False, in which case their manifest is returned.
+        """
         key = to_unicode(key)
         if key:  # No need to validate membership, which is an O(1) operation, but seems we can do without.
-            value = self.connection.get(self.make_key(key))
+            metrics = self.metrics
+            if self.local_cache is not None:
+                value = self.local_cache.get(key)
+                if value is not _MISSING:
+                    if metrics is not None:
+                        metrics.incr('hits')
+                    return value
+            if self.namespace_generations:
+                value = self._run_script(FETCH_SCRIPT,
+                                         *self._fetch_script_args([key]))[0]
+            elif self.eviction_policy in ('lru', 'lfu'):
+                pipe = self.connection.pipeline(transaction=False)
+                pipe.get(self.make_key(key))
+                self._track_access(pipe, [key])
+                value = self._timed(pipe.execute)[0]
+            else:
+                value = self._timed(self.connection.get, self.make_key(key))
             if value is None:  # expired key
+                if metrics is not None:
+                    metrics.incr('misses')
                 if not key in self:  # If key does not exist at all, it is a straight miss.
                     raise CacheMissException
 
-                self.connection.srem(self.get_set_name(), key)
+                self._reap([key])
+                if metrics is not None:
+                    metrics.incr('expired')
                 raise ExpiredKeyException
             else:
+                if metrics is not None:
+                    metrics.incr('hits')
+                    metrics.incr('bytes_read', len(value))
+                manifest = _chunk_manifest(value)
+                if manifest is not None:
+                    if not join_chunks:
+                        return value
+                    value = self._join_chunks(manifest)
+                if self.local_cache is not None:
+                    self.local_cache.set(key, value)
                 return value
 
+    def _iter_chunks(self, manifest, batch=8):
+        """
+        Yields the chunks of a parsed manifest, fetching `batch` chunks per
+        round trip.
+        """
+        count, length, base = manifest
+        for start in range(0, count, batch):
+            names = [base + b':' + str(i).encode('ascii')
+                     for i in range(start, min(count, start + batch))]
+            chunks = self._timed(self.connection.mget, names)
+            if None in chunks:  # expired or invalidated meanwhile
+                raise ExpiredKeyException
+            if self.metrics is not None:
+                self.metrics.incr('bytes_read', sum(len(chunk) for chunk in chunks))
+            for chunk in chunks:
+                yield chunk
+
+    def _join_chunks(self, manifest):
+        value = bytearray(manifest[1])
+        view = memoryview(value)
+        position = 0
+        for chunk in self._iter_chunks(manifest):
+            view[position:position + len(chunk)] = chunk
+            position += len(chunk)
+        if position != len(value):
+            raise ExpiredKeyException
+        return bytes(value)
+
+    def iter_chunks(self, key):
+        """
+        Yields a value as byte strings without ever joining them, chunk by
+        chunk for a chunked value and as a single string otherwise. Raises
+        ExpiredKeyException if the value is invalidated while it is read.
+        :param key: key being looked-up in Redis
+        """
+        value = self._get(key, join_chunks=False)
+        manifest = _chunk_manifest(value)
+        if manifest is None:
+            yield value
+        else:
+            for chunk in self._iter_chunks(manifest):
+                yield chunk
+
+    def get_stream(self, key):
+        """
+        Returns a read-only file-like object over a value, fetching its
+        chunks as they are read, e.g. pickle.load(cache.get_stream(key)).
+        """
+        return ChunkReader(self.iter_chunks(key))
+
+    def _get_decoded(self, key, kind, loads, load=None):
+        """
+        Fetches and decodes a value, keeping the decoded object in the L1 tier
+        (if enabled) so that hot reads skip deserialization too. Chunked
+        values are decoded from a stream of their chunks with `load`, if
+        given, instead of being joined first.
+        """
+        key = to_unicode(key)
+        if self.local_cache is not None:
+            value = self.local_cache.get(key, kind)
+            if value is not _MISSING:
+                return value
+        data = self._get(key, join_chunks=load is None)
+        manifest = _chunk_manifest(data) if load is not None else None
+        if manifest is None:
+            value = self._loads(loads, data)
+        else:
+            value = self._loads(load, ChunkReader(self._iter_chunks(manifest)))
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, kind)
+        return value
+
     def mget(self, keys):
         """
         Method returns a dict of key/values for found keys.
@@ -218,22 +2263,45 @@ class SimpleCache(object):
         """
         if keys:
             cache_keys = [self.make_key(to_unicode(key)) for key in keys]
-            values = self.connection.mget(cache_keys)
-
-            if None in values:
-                pipe = self.connection.pipeline()
-                for cache_key, value in zip(cache_keys, values):
-                    if value is None:  # non-existant or expired key
-                        pipe.srem(self.get_set_name(), cache_key)
-                pipe.execute()
-
-            return {k: v for (k, v) in zip(keys, values) if v is not None}
+            if self.namespace_generations:
+                values = self._run_script(FETCH_SCRIPT, *self._fetch_script_args(
+                    [to_unicode(key) for key in keys]))
+            elif self.eviction_policy in ('lru', 'lfu'):
+                pipe = self.connection.pipeline(transaction=False)
+                pipe.mget(cache_keys)
+                self._track_access(pipe, [to_unicode(key) for key in keys])
+                values = self._timed(pipe.execute)[0]
+            else:
+                values = self._timed(self.connection.mget, cache_keys)
+
+            metrics = self.metrics
+            if metrics is not None:
+                found = [value for value in values if value is not None]
+                metrics.incr('hits', len(found))
+                metrics.incr('misses', len(values) - len(found))
+                metrics.incr('bytes_read', sum(len(value) for value in found))
+
+            missing = [to_unicode(k) for k, v in zip(keys, values) if v is None]
+            if missing:  # non-existant or expired keys
+                self._reap(missing)
+
+            found = {}
+            for key, value in zip(keys, values):
+                if value is not None:
+                    manifest = _chunk_manifest(value)
+                    if manifest is not None:
+                        try:
+                            value = self._join_chunks(manifest)
+                        except ExpiredKeyException:
+                            continue
+                    found[key] = value
+            return found
 
     def get_json(self, key):
-        return json.loads(self.get(key))
+        return self._get_decoded(key, 'json', json.loads)
 
     def get_pickle(self, key):
-        return pickle.loads(self.get(key))
+        return self._get_decoded(key, 'pickle', pickle.loads, pickle.load)
 
     def mget_json(self, keys):
         """
@@ -245,7 +2313,36 @@ class SimpleCache(object):
         d = self.mget(keys)
         if d:
             for key in d.keys():
-                d[key] = json.loads(d[key]) if d[key] else None
+                d[key] = self._loads(json.loads, d[key]) if d[key] else None
+            return d
+
+    def get_decoded(self, key, codec=None):
+        """
+        Returns a value decoded by `codec` (defaults to the cache's codec),
+        whatever format and compression it was written with.
+        """
+        codec = codec or self.codec
+        return self._get_decoded(key, codec, codec.loads)
+
+    def mget_decoded(self, keys, codec=None):
+        codec = codec or self.codec
+        d = self.mget(keys)
+        if d:
+            for key in d.keys():
+                d[key] = self._loads(codec.loads, d[key])
+            return d
+
+    def mget_pickle(self, keys):
+        """
+        Method returns a dict of key/values for found keys with each value
+        unpickled.
+        :param keys: array of keys to look up in Redis
+        :return: dict of found key/values with values unpickled
+        """
+        d = self.mget(keys)
+        if d:
+            for key in d.keys():
+                d[key] = self._loads(pickle.loads, d[key])
             return d
 
     def invalidate(self, key):
@@ -254,10 +2351,8 @@ class SimpleCache(object):
         :param key: key to remove from Redis
         """
         key = to_unicode(key)
-        pipe = self.connection.pipeline()
-        pipe.srem(self.get_set_name(), key)
-        pipe.delete(self.make_key(key))
-        pipe.execute()
+        self._run_script(DELETE_SCRIPT,
+                         *self._delete_script_args([key], True, 'key', key))
 
     def __contains__(self, key):
         return self.connection.sismember(self.get_set_name(), key)
@@ -273,42 +2368,428 @@ class SimpleCache(object):
     def __len__(self):
         return self.connection.scard(self.get_set_name())
 
+    def used_bytes(self):
+        """
+        Returns the bytes of values counted against max_bytes. Values that
+        expire are only uncounted once reaped or missed by a get.
+        """
+        return int(self.connection.get(self.get_bytes_name()) or 0)
+
     def keys(self):
         return self.connection.smembers(self.get_set_name())
 
 
-    def flush(self):
-        keys = list(self.keys())
-        keys.append(self.get_set_name())
+    def _data_keys(self, keys, generations):
+        """
+        Returns the redis keys holding the values of `keys`, like _data_key,
+        reading the generations missing from the `generations` dict in a
+        single round trip.
+        """
+        if not self.namespace_generations:
+            return [self.make_key(key) for key in keys]
+        missing = list(set(key.split(u':', 1)[0] for key in keys if u':' in key)
+                       - set(generations))
+        if missing:
+            counters = self.connection.mget([self.get_generation_name(namespace)
+                                             for namespace in missing])
+            generations.update(zip(missing, counters))
+        return [self._generation_key(key, generations[key.split(u':', 1)[0]])
+                if u':' in key else self.make_key(key) for key in keys]
+
+    def export_snapshot(self, fileobj, chunk_size=1000):
+        """
+        Writes the entries of the key set to a binary file object in the
+        snapshot format (see snapshot.py), with their remaining ttl and
+        eviction score, for import_snapshot to warm up another redis. The
+        set is read with SSCAN and values are DUMPed `chunk_size` keys per
+        round trip, so memory use doesn't grow with the number of keys.
+        Entries may be written twice if the set changes meanwhile.
+        :return: int, number of exported entries
+        """
+        writer = SnapshotWriter(fileobj)
+        generations = {}
+        exported = 0
+        cursor = 0
+        while True:
+            cursor, members = self.connection.sscan(self.get_set_name(), cursor,
+                                                    count=chunk_size)
+            if members:
+                exported += self._export_chunk(writer, [to_unicode(m) for m in members],
+                                               generations)
+            if int(cursor) == 0:
+                break
+        return exported
+
+    def _export_chunk(self, writer, keys, generations):
+        data_keys = self._data_keys(keys, generations)
+        scored = self.eviction_policy != 'random'
+        pipe = self.connection.pipeline(transaction=False)
+        for key, data_key in zip(keys, data_keys):
+            pipe.dump(data_key)
+            pipe.pttl(data_key)
+            pipe.getrange(data_key, 0, 7)
+            if scored:
+                pipe.zscore(self.get_scores_name(), key)
+        results = self._timed(pipe.execute)
+        step = 4 if scored else 3
+        exported = 0
+        for i, key in enumerate(keys):
+            payload, pttl, head = results[i * step:i * step + 3]
+            if payload is None or pttl == -2:  # expired meanwhile
+                continue
+            if head == CHUNK_MANIFEST:
+                self._export_chunks(writer, data_keys[i])
+            writer.write(ENTRY, key, pttl, results[i * step + 3] if scored else None,
+                         payload)
+            exported += 1
+        return exported
+
+    def _export_chunks(self, writer, data_key, batch=8):
+        manifest = _chunk_manifest(self.connection.get(data_key))
+        if manifest is None:
+            return
+        count, _, base = manifest
+        for start in range(0, count, batch):
+            pipe = self.connection.pipeline(transaction=False)
+            indexes = [str(i) for i in range(start, min(count, start + batch))]
+            for index in indexes:
+                pipe.dump(base + b':' + index.encode('ascii'))
+                pipe.pttl(base + b':' + index.encode('ascii'))
+            results = self._timed(pipe.execute)
+            for index, payload, pttl in zip(indexes, results[::2], results[1::2]):
+                if payload is not None:
+                    writer.write(CHUNK, index, pttl, None, payload)
+
+    def import_snapshot(self, fileobj, chunk_size=1000, replace=True):
+        """
+        Restores the entries of a snapshot written by export_snapshot,
+        reading it record by record and RESTOREing `chunk_size` keys per
+        pipelined round trip. Entries keep the expiry time they had when
+        exported (entries which expired since are skipped), and their
+        eviction scores. Neither `limit` nor `max_bytes` are applied, the
+        next stores evict down to them. Needs a redis with the same or a
+        newer RDB version than the exporting one. Chunked values get their
+        chunks under keys of this cache, whatever cache exported them.
+        :param replace: overwrite entries already in redis
+        :return: int, number of imported entries
+        """
+        reader = SnapshotReader(fileobj)
+        elapsed = int((time.time() - reader.created) * 1000)
+        generations = {}
+        imported = 0
+        batch = []
+        for record in reader:
+            batch.append(record)
+            # Chunks precede their entry, batches end on an entry
+            if len(batch) >= chunk_size and record[0] == ENTRY:
+                imported += self._import_chunk(batch, elapsed, replace, generations)
+                batch = []
+        if batch:
+            imported += self._import_chunk(batch, elapsed, replace, generations)
         with self.connection.pipeline() as pipe:
-            pipe.delete(*keys)
+            self._publish_invalidation(pipe, 'all')
             pipe.execute()
+        return imported
+
+    def _import_chunk(self, records, elapsed, replace, generations):
+        entries = [record for record in records if record[0] == ENTRY]
+        data_keys = iter(self._data_keys([record[1] for record in entries], generations))
+        pipe = self.connection.pipeline(transaction=False)
+        restored = []
+        chunks = []  # (index, pttl, payload) records of the next entry
+        for kind, key, pttl, score, payload in records:
+            if pttl >= 0:
+                pttl -= elapsed
+                if pttl <= 0:  # expired since the export
+                    if kind == ENTRY:
+                        next(data_keys)
+                        chunks = []
+                    continue
+            if kind == CHUNK:
+                chunks.append((key, pttl, payload))
+                continue
+            name = next(data_keys)
+            base, chunk_names = None, []
+            if chunks:
+                # Chunks get a fresh base key next to the entry's data key,
+                # which the manifest is pointed at once restored.
+                base = (to_unicode(name) + u'\x00' + uuid.uuid4().hex).encode('utf-8')
+                for index, chunk_pttl, chunk in chunks:
+                    chunk_names.append(base + b':' + index.encode('ascii'))
+                    pipe.restore(chunk_names[-1], max(chunk_pttl, 0), chunk)
+                chunks = []
+            pipe.restore(name, max(pttl, 0), payload, replace=replace)
+            restored.append((len(pipe) - 1, key, score, name, pttl, base, chunk_names))
+        results = self._timed(lambda: pipe.execute(raise_on_error=False))
+        imported = 0
+        rebased = []
+        pipe = self.connection.pipeline(transaction=False)
+        for index, key, score, name, pttl, base, chunk_names in restored:
+            result = results[index]
+            if isinstance(result, Exception):
+                if replace or 'BUSYKEY' not in str(result):
+                    logging.warning("redis-simple-cache couldn't restore %r: %s", key, result)
+                if chunk_names:
+                    pipe.delete(*chunk_names)
+                continue
+            if base is not None:
+                rebased.append((name, pttl, base))
+            pipe.sadd(self.get_set_name(), key)
+            if score is not None:
+                pipe.zadd(self.get_scores_name(), {key: score})
+            imported += 1
+        if rebased:
+            manifests = self._timed(self.connection.mget, [name for name, _, _ in rebased])
+            for (name, pttl, base), value in zip(rebased, manifests):
+                manifest = _chunk_manifest(value)
+                if manifest is not None:
+                    value = (CHUNK_MANIFEST + '{0}:{1}:'.format(*manifest[:2]).encode('ascii')
+                             + base)
+                    pipe.set(name, value, px=pttl if pttl > 0 else None)
+        self._timed(pipe.execute)
+        return imported
+
+    def flush(self, chunk_size=1000, rate_limit=None, background=False):
+        """
+        Removes every key of this cache, reading the set with SSCAN and
+        deleting `chunk_size` keys per round trip.
+        :param chunk_size: number of keys per round trip
+        :param rate_limit: maximum number of keys per second, if set
+        :param background: run in a daemon thread instead of waiting for it
+        :return: BulkProgress
+        """
+        return self._bulk_delete(True, chunk_size, rate_limit, background)
 
     def flush_namespace(self, space):
-        namespace = self.namespace_key(space)
-        setname = self.get_set_name()
-        keys = list(self.connection.keys(namespace))
+        """
+        Removes every key of the namespace `space`. With namespace generations
+        the values are orphaned by incrementing the generation, otherwise they
+        are found with SCAN and deleted. Either way the index is cleaned with
+        SSCAN, so the server is never blocked.
+        """
+        space = to_unicode(space)
         with self.connection.pipeline() as pipe:
-            pipe.delete(*keys)
-            pipe.srem(setname, *space)
+            if self.namespace_generations:
+                pipe.incr(self.get_generation_name(space))
+            self._publish_invalidation(pipe, 'prefix', space + ':')
             pipe.execute()
+        if not self.namespace_generations:
+            self._delete_matching(_glob_escape(self.make_key(space + ':')) + '*')
+        self._unindex_namespace(space)
 
-    def get_hash(self, args):
-        if self.hashkeys:
-            key = hashlib.md5(args).hexdigest()
+
+
+def _canonical_text(value, out):
+    out.append(u's%d:' % len(value))
+    out.append(value)
+
+
+def _canonical_bytes(value, out):
+    if bytes is str:  # python 2 str, keyed like the equivalent ascii unicode
+        _canonical_text(value.decode('latin-1'), out)
+    else:
+        out.append(u'b%d:' % len(value))
+        out.append(value.decode('latin-1'))
+
+
+def _canonical_int(value, out):
+    out.append(u'i%d;' % value)
+
+
+def _canonical_float(value, out):
+    out.append(u'f%r;' % value)
+
+
+def _canonical_sequence(value, out):
+    out.append(u'(' if type(value) is tuple else u'[')
+    for item in value:
+        _canonical(item, out)
+    out.append(u')')
+
+
+def _canonical_dict(value, out):
+    out.append(u'{')
+    for item in sorted(canonical_key(k) + u'=' + canonical_key(v)
+                       for k, v in value.items()):
+        out.append(u'%d:' % len(item))
+        out.append(item)
+    out.append(u'}')
+
+
+_canonical_fast_paths = {
+    type(None): lambda value, out: out.append(u'N'),
+    bool: lambda value, out: out.append(u'T' if value else u'F'),
+    int: _canonical_int,
+    float: _canonical_float,
+    text_type: _canonical_text,
+    bytes: _canonical_bytes,
+    tuple: _canonical_sequence,
+    list: _canonical_sequence,
+    dict: _canonical_dict,
+}
+try:
+    _canonical_fast_paths[long] = _canonical_int
+except NameError:  # python 3
+    pass
+
+# Types whose repr is deterministic and tells them apart from each other.
+# On python 2, str and unicode are left out, as the repr of 'a' and u'a'
+# differ while their canonical keys are the same.
+_repr_safe_types = frozenset(t for t in _canonical_fast_paths
+                             if t not in (tuple, list, dict)
+                             and not (bytes is str and t in (str, text_type)))
+# Keyword argument names are str, so only need checking on python 2.
+_kwargs_repr_safe = str in _repr_safe_types
+
+
+def _is_repr_safe(sequence):
+    for item in sequence:
+        item_type = type(item)
+        if item_type not in _repr_safe_types and not (
+                (item_type is tuple or item_type is list) and _is_repr_safe(item)):
+            return False
+    return True
+
+
+def _canonical(value, out):
+    fast_path = _canonical_fast_paths.get(type(value))
+    if fast_path is not None:
+        fast_path(value, out)
+    else:
+        # Anything else is keyed by its pickle, which is deterministic for
+        # most objects but e.g. not for sets, or dicts in attributes.
+        out.append(u'p%s;' % hashlib.sha1(
+            pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest())
+
+
+def canonical_key(value):
+    """
+    Returns a deterministic text representation of `value`, with fast paths
+    for primitives, tuples, lists and dicts (whose items are sorted).
+    Values of different types (e.g. 1, 1.0, '1' and True) get distinct keys.
+    """
+    value_type = type(value)
+    if (value_type is tuple or value_type is list) and _is_repr_safe(value):
+        # Fast path: the (C implemented) repr of sequences of primitives.
+        # No other representation starts with r.
+        return u'r' + repr(value)
+    return _canonical_join(value)
+
+
+def _canonical_join(value):
+    out = []
+    _canonical(value, out)
+    return u''.join(out)
+
+
+KEY_HASHES = {
+    'md5': lambda data: hashlib.md5(data).hexdigest(),
+    'sha1': lambda data: hashlib.sha1(data).hexdigest(),
+}
+if hasattr(hashlib, 'blake2b'):
+    KEY_HASHES['blake2b'] = lambda data: hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class KeyBuilder(object):
+    """
+    Builds the cache keys of a decorated function's calls, in the form
+    `namespace:function name:arguments key`, the prefix being computed once.
+    The arguments key is canonical_key of the positional arguments and sorted
+    keyword arguments, or whatever key_func(*args, **kwargs) returns, hashed
+    with one of KEY_HASHES if `hash` is set. Arguments taking canonical_key's
+    repr fast path are hashed from their marshal (version 2, which has no
+    back-references) instead, which is several times cheaper than their repr.
+    """
+    def __init__(self, function, namespace=None, hash=None, key_func=None):
+        if hash is not None and hash not in KEY_HASHES:
+            raise ValueError("Unknown key hash {0}, use one of {1}".format(
+                hash, ', '.join(sorted(KEY_HASHES))))
+        self.prefix = u'{0}:'.format(function.__name__)
+        if namespace:
+            self.prefix = u'{0}:{1}'.format(namespace, self.prefix)
+        self.hash = KEY_HASHES.get(hash)
+        self.key_func = key_func
+
+    def __call__(self, args, kwargs):
+        if self.key_func is not None:
+            key = self.key_func(*args, **kwargs)
+            if not isinstance(key, text_type):
+                key = to_unicode(key) if isinstance(key, bytes) else u'{0}'.format(key)
         else:
-            key = pickle.dumps(args)
-        return key
+            # Checks the arguments flatly rather than their nesting below
+            if kwargs:
+                fast = (_is_repr_safe(args) and _is_repr_safe(kwargs.values())
+                        and (_kwargs_repr_safe or _is_repr_safe(kwargs)))
+                args = (args, sorted(kwargs.items()))
+            else:
+                fast = _is_repr_safe(args)
+            if not fast:
+                key = _canonical_join(args)
+            elif self.hash is not None:
+                # No canonical key starts with m
+                return self.prefix + self.hash(b'm' + marshal.dumps(args, 2))
+            else:
+                return self.prefix + u'r' + repr(args)
+        if self.hash is not None:
+            key = self.hash(key.encode('utf-8'))
+        return self.prefix + key
+
+
+def _key_builder(cache, function, namespace, key_hash, key_func):
+    """
+    Returns the KeyBuilder of a decorated function, hashing keys with md5 if
+    no key_hash is given and the cache has hashkeys set.
+    """
+    if key_hash is None and cache.hashkeys:
+        key_hash = 'md5'
+    return KeyBuilder(function, namespace, key_hash, key_func)
 
 
 def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
-             use_json=False, namespace=None):
+             use_json=False, namespace=None, single_flight=False,
+             lock_timeout=10, soft_expire=None, early_refresh=0,
+             refresher=None, codec=None, key_hash=None, key_func=None,
+             write_behind=None, cost_policy=None, metrics=True):
     """
     Arguments and function result must be pickleable.
     :param limit: maximum number of keys to maintain in the set
     :param expire: period after which an entry in cache is considered expired
     :param cache: SimpleCache object, if created separately
-    :return: decorated function
+    :param single_flight: on a miss, let only one caller compute the result:
+        concurrent calls in the process are merged, and a redis lock makes
+        other processes wait for the result
+    :param lock_timeout: seconds after which waiting processes give up on
+        the lock and compute the result themselves
+    :param soft_expire: seconds after which an entry is stale: it is still
+        returned until `expire`, while a background thread recomputes it
+    :param early_refresh: XFetch beta, > 0 to refresh entries in the
+        background before they go stale, with a probability growing with the
+        time the result took to compute (1 is a sensible value)
+    :param refresher: Refresher running background refreshes, defaults to a
+        pool shared by every decorated function
+    :param codec: serializers.Codec storing results, e.g. to use msgpack or
+        compression
+    :param key_hash: name of the KEY_HASHES function hashing argument keys,
+        e.g. blake2b (defaults to md5 if the cache hashes keys)
+    :param key_func: function taking the decorated function's arguments and
+        returning their key, instead of the canonical representation
+    :param write_behind: True or a WriteBehind, to serialize and store
+        results in a background thread instead of before returning them
+        (results must then not be mutated by callers). True uses a queue
+        shared by every decorated function
+    :param cost_policy: CostPolicy skipping cheap results, or scaling their
+        ttl by their compute time per byte
+    :param metrics: False to skip counting and timing calls, `stats` then
+        staying empty
+    :return: decorated function, with a `stats` attribute (metrics.Metrics)
+        counting hits, misses (expired ones being counted as expired too),
+        stores, errors, computes, dropped (write-behind stores dropped as
+        the queue was full), result_bytes (serialized size of computed
+        results, with a cost policy), skipped, shortened and extended (the
+        cost policy's decisions), merged (calls served by another thread),
+        lock_waits (calls served by another process), stale hits and
+        background refreshes, and timing computes, and a
+        `cache_key(*args, **kwargs)` method
     """
     cache_ = cache  ## Since python 2.x doesn't have the nonlocal keyword, we need to do this
     expire_ = expire  ## Same here.
@@ -321,65 +2802,341 @@ def cache_it(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
             # the expire value of the passed cache object
             expire = None
 
+        key_builder = _key_builder(cache, function, namespace, key_hash, key_func)
+        if codec is not None:
+            fetcher = lambda key: cache.get_decoded(key, codec)
+            storer = lambda key, value, expire: cache.store_encoded(key, value, expire, codec)
+            dumps = codec.dumps
+        else:
+            fetcher = cache.get_json if use_json else cache.get_pickle
+            storer = cache.store_json if use_json else cache.store_pickle
+            dumps = json.dumps if use_json else pickle.dumps
+        if metrics:
+            stats = Metrics('function', _function_name(function),
+                            FUNCTION_COUNTERS + ('dropped', 'result_bytes', 'skipped',
+                                                 'shortened', 'extended', 'merged',
+                                                 'lock_waits', 'lock_timeouts',
+                                                 'stale', 'refreshes'))
+        else:
+            stats = NullMetrics('function', _function_name(function))
+        writer = _default_write_behind if write_behind is True else write_behind or None
+        flights = SingleFlight()
+        # Entries with a refresh time are stored as [result, refresh_at,
+        # compute_time] envelopes.
+        use_envelope = soft_expire is not None or early_refresh > 0
+        refresh_pool = refresher or _default_refresher
+        timed = metrics or use_envelope or cost_policy is not None
+
+        def compute(cache_key, args, kwargs, release=None):
+            """
+            Computes and stores the result. `release` (releasing the lock of
+            the key) is called once the result is stored, by the write-behind
+            queue if it is queued there.
+            """
+            released_by_writer = False
+            try:
+                stats.incr('computes')
+                start = time.time() if timed else None
+                try:
+                    result = function(*args, **kwargs)
+                except DoNotCache as e:
+                    if metrics:
+                        stats.observe('compute_seconds', time.time() - start)
+                    result = e.result
+                else:
+                    end = time.time() if timed else None
+                    if metrics:
+                        stats.observe('compute_seconds', end - start)
+                    value = result
+                    if use_envelope:
+                        ttl = soft_expire
+                        if ttl is None:
+                            ttl = cache._expire_seconds(expire) or float('inf')
+                        value = [result, end + ttl, end - start]
+                    store_expire, data = expire, None
+                    if cost_policy is not None:
+                        data = cache._dumps(dumps, value)
+                        stats.incr('result_bytes', len(data))
+                        base = cache._expire_seconds(expire)
+                        store_expire = cost_policy.ttl(end - start, len(data), base)
+                        if store_expire is None:
+                            stats.incr('skipped')
+                            return result
+                        if store_expire != base:
+                            stats.incr('shortened' if store_expire < base else 'extended')
+                    if writer is not None:
+                        if data is None:
+                            queued = writer.submit(cache, cache_key, value, store_expire,
+                                                   dumps, stats, release)
+                        else:
+                            queued = writer.submit(cache, cache_key, data, store_expire,
+                                                   None, stats, release)
+                        released_by_writer = queued
+                        if not queued:
+                            stats.incr('dropped')
+                        return result
+                    try:
+                        if data is None:
+                            storer(cache_key, value, store_expire)
+                        else:
+                            cache.store(cache_key, data, store_expire)
+                        stats.incr('stores')
+                    except redis.RedisError as e:
+                        stats.incr('errors')
+                        logging.exception(e)
+                return result
+            finally:
+                if release is not None and not released_by_writer:
+                    release()
+
+        def open_envelope(cache_key, envelope, args, kwargs):
+            """
+            Returns the result of an envelope, scheduling a background refresh
+            if it is stale, or (XFetch) if `now - compute_time * beta *
+            log(rand)` is past its refresh time.
+            """
+            result, refresh_at, compute_time = envelope
+            now = time.time()
+            if now >= refresh_at:
+                stats.incr('stale')
+            elif not (early_refresh > 0 and now - compute_time * early_refresh *
+                      math.log(1.0 - random.random()) >= refresh_at):
+                return result
+
+            def refresh():
+                stats.incr('refreshes')
+                compute(cache_key, args, kwargs)
+            refresh_pool.submit(cache.make_key(cache_key), refresh)
+            return result
+
+        def compute_locked(cache_key, args, kwargs):
+            """
+            Computes the result while holding a redis lock, or waits with
+            bounded exponential backoff for the process holding it to store
+            the result. Waiters take over if the lock is released without a
+            result, or once lock_timeout is reached. With write_behind, the
+            lock is held until the queued store is written. The cache is read
+            again once the lock is taken, as its previous holder may have
+            stored the result since the miss.
+            """
+            token = uuid.uuid4().hex
+            deadline = time.time() + lock_timeout
+            delay = 0.01
+            while True:
+                try:
+                    acquired = cache._acquire_lock(cache_key, token, lock_timeout)
+                except redis.RedisError as e:
+                    logging.exception(e)
+                    return compute(cache_key, args, kwargs)
+                if acquired:
+                    def release():
+                        try:
+                            cache._release_lock(cache_key, token)
+                        except redis.RedisError as e:
+                            logging.exception(e)
+                    try:
+                        result = fetcher(cache_key)
+                    except (ExpiredKeyException, CacheMissException):
+                        return compute(cache_key, args, kwargs, release)
+                    except redis.RedisError as e:
+                        logging.exception(e)
+                        return compute(cache_key, args, kwargs, release)
+                    release()
+                    stats.incr('lock_waits')
+                    return result[0] if use_envelope else result
+                if time.time() >= deadline:
+                    stats.incr('lock_timeouts')
+                    return compute(cache_key, args, kwargs)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.25)
+                try:
+                    result = fetcher(cache_key)
+                except (ExpiredKeyException, CacheMissException):
+                    continue
+                except redis.RedisError as e:
+                    logging.exception(e)
+                    return compute(cache_key, args, kwargs)
+                stats.incr('lock_waits')
+                return result[0] if use_envelope else result
+
         @wraps(function)
         def func(*args, **kwargs):
+            cache_key = key_builder(args, kwargs)
+
             ## Handle cases where caching is down or otherwise not available.
-            if cache.connection is None:
+            if not cache.available(cache_key):
                 result = function(*args, **kwargs)
                 return result
 
-            serializer = json if use_json else pickle
-            fetcher = cache.get_json if use_json else cache.get_pickle
-            storer = cache.store_json if use_json else cache.store_pickle
-
-            ## Key will be either a md5 hash or just pickle object,
-            ## in the form of `function name`:`key`
-            key = cache.get_hash(serializer.dumps([args, kwargs]))
-            cache_key = '{func_name}:{key}'.format(func_name=function.__name__,
-                                                   key=key)
-
-            if namespace:
-                cache_key = '{namespace}:{key}'.format(namespace=namespace,
-                                                       key=cache_key)
-
             try:
-                return fetcher(cache_key)
-            except (ExpiredKeyException, CacheMissException) as e:
-                ## Add some sort of cache miss handing here.
+                result = fetcher(cache_key)
+                stats.incr('hits')
+                if use_envelope:
+                    return open_envelope(cache_key, result, args, kwargs)
+                return result
+            except ExpiredKeyException:
+                stats.incr('expired')
+            except CacheMissException:
                 pass
             except:
+                stats.incr('errors')
                 logging.exception("Unknown redis-simple-cache error. Please check your Redis free space.")
-
-            try:
-                result = function(*args, **kwargs)
-            except DoNotCache as e:
-                result = e.result
-            else:
-                try:
-                    storer(cache_key, result, expire)
-                except redis.ConnectionError as e:
-                    logging.exception(e)
-
+            stats.incr('misses')
+
+            if not single_flight:
+                return compute(cache_key, args, kwargs)
+            result, shared = flights.do(
+                cache_key, lambda: compute_locked(cache_key, args, kwargs))
+            if shared:
+                stats.incr('merged')
             return result
+        func.stats = stats
+        func.cache_key = lambda *args, **kwargs: key_builder(args, kwargs)
         return func
     return decorator
 
 
 
-def cache_it_json(limit=10000, expire=DEFAULT_EXPIRY, cache=None, namespace=None):
+def cache_it_json(limit=10000, expire=DEFAULT_EXPIRY, cache=None, namespace=None,
+                  **kwargs):
     """
     Arguments and function result must be able to convert to JSON.
     :param limit: maximum number of keys to maintain in the set
     :param expire: period after which an entry in cache is considered expired
     :param cache: SimpleCache object, if created separately
+    Other keyword arguments are passed to cache_it.
     :return: decorated function
     """
     return cache_it(limit=limit, expire=expire, use_json=True,
-                    cache=cache, namespace=None)
+                    cache=cache, namespace=None, **kwargs)
+
+
+def cache_it_batch(limit=10000, expire=DEFAULT_EXPIRY, cache=None,
+                   use_json=False, namespace=None, codec=None, key_hash=None,
+                   key_func=None, metrics=True):
+    """
+    Decorator for functions taking a list of ids as first argument, such as
+    `load_users(ids)`, caching the result of every id separately. Cached ids
+    are fetched with a single mget, the function is only called with the
+    missing ids, and new results are stored in a single round trip.
+    The function must return either a list of results in the order of the
+    ids it was called with, or a dict of id to result (ids missing from the
+    dict are not cached and returned as None).
+    The decorated function returns a list of results in the order of `ids`.
+    Ids, other arguments and results must be pickleable.
+    :param limit: maximum number of keys to maintain in the set
+    :param expire: period after which an entry in cache is considered
+        expired, or a callable taking (id, result) returning it
+    :param cache: SimpleCache object, if created separately
+    :param codec: serializers.Codec storing results
+    :param key_hash: name of the KEY_HASHES function hashing keys
+    :param key_func: function taking an id and the other arguments of the
+        decorated function, returning the key of that id
+    :param metrics: False to skip counting and timing calls, `stats` then
+        staying empty
+    :return: decorated function, with a `stats` attribute (metrics.Metrics)
+        counting hits, misses and stores per id, and errors
+    """
+    cache_ = cache
+    expire_ = expire
+    def decorator(function):
+        cache, expire = cache_, expire_
+        if cache is None:
+            # A per-id expire is applied by the stores, not the cache
+            cache = SimpleCache(limit, DEFAULT_EXPIRY if callable(expire) else expire,
+                                hashkeys=True, namespace=function.__module__)
+        elif expire == DEFAULT_EXPIRY:
+            expire = None
+
+        if codec is not None:
+            dumps = codec.dumps
+            fetcher = lambda keys: cache.mget_decoded(keys, codec)
+        else:
+            dumps = (json if use_json else pickle).dumps
+            fetcher = cache.mget_json if use_json else cache.mget_pickle
+        if metrics:
+            stats = Metrics('function', _function_name(function),
+                            ('hits', 'misses', 'stores', 'errors'))
+        else:
+            stats = NullMetrics('function', _function_name(function))
+        key_builder = _key_builder(cache, function, namespace, key_hash, key_func)
+
+        @wraps(function)
+        def func(ids, *args, **kwargs):
+            ids = list(ids)
+            if not cache.available():
+                return _batch_results(ids, function(ids, *args, **kwargs))
+
+            keys = dict((id_, key_builder((id_,) + args, kwargs)) for id_ in ids)
+            results = {}
+            try:
+                found = fetcher(list(set(keys.values()))) or {}
+            except redis.RedisError as e:
+                stats.incr('errors')
+                logging.exception(e)
+                found = {}
+            for id_ in ids:
+                if keys[id_] in found:
+                    results[id_] = found[keys[id_]]
+            stats.incr('hits', len(results))
+
+            missing = []
+            seen = set(results)
+            for id_ in ids:
+                if id_ not in seen:
+                    seen.add(id_)
+                    missing.append(id_)
+            if not missing:
+                return [results[id_] for id_ in ids]
+            stats.incr('misses', len(missing))
+
+            start = time.time() if metrics else None
+            try:
+                computed = function(missing, *args, **kwargs)
+            except DoNotCache as e:
+                if metrics:
+                    stats.observe('compute_seconds', time.time() - start)
+                computed = _batch_results(missing, e.result)
+            else:
+                if metrics:
+                    stats.observe('compute_seconds', time.time() - start)
+                computed = _batch_results(missing, computed)
+                items = []
+                for id_, result in zip(missing, computed):
+                    if result is None:
+                        continue
+                    ttl = expire(id_, result) if callable(expire) else expire
+                    items.append((keys[id_], dumps(result), ttl))
+                try:
+                    stats.incr('stores', cache._store_items(items))
+                except redis.RedisError as e:
+                    stats.incr('errors')
+                    logging.exception(e)
+            results.update(zip(missing, computed))
+            return [results[id_] for id_ in ids]
+        func.stats = stats
+        func.cache_key = lambda *args, **kwargs: key_builder(args, kwargs)
+        return func
+    return decorator
+
+
+def _function_name(function):
+    return "{0}.{1}".format(function.__module__, function.__name__)
+
+
+def _batch_results(ids, results):
+    """
+    Returns the results of a batch function call with `ids` as a list ordered
+    like `ids`, whether the function returned a list or a dict of id to
+    result.
+    """
+    if not isinstance(results, dict):
+        results = dict(zip(ids, results))
+    return [results.get(id_) for id_ in ids]
 
 
 def to_unicode(obj, encoding='utf-8'):
-    if isinstance(obj, basestring):
-        if not isinstance(obj, unicode):
-            obj = unicode(obj, encoding)
+    if isinstance(obj, (string_types, bytes)):
+        if not isinstance(obj, text_type):
+            obj = obj.decode(encoding)
     return obj
@@ -0,0 +1,120 @@
+"""
+Serializers for cached values.
+Encoded values start with a one byte header holding the format id (low 3
+bits) and the compression id (bits 3-4), so readers can decode any entry
+whatever the settings of its writer, and formats can be migrated live.
+Headers are always in the 0x01-0x1f range, which neither pickle nor json
+output starts with, so entries written without a header are still decoded
+with the `legacy` loader.
+"""
+import json
+import marshal
+import pickle
+import zlib
+
+_formats = {}
+_formats_by_id = {}
+_compressions = {}
+_compressions_by_id = {}
+
+
+def register_format(name, format_id, dumps, loads):
+    """
+    Registers a serialization format.
+    :param format_id: int from 1 to 7, stored in the header of every value
+    :param dumps: function encoding a value to bytes
+    :param loads: function decoding bytes to a value
+    """
+    if not 1 <= format_id <= 7:
+        raise ValueError("format_id must be between 1 and 7")
+    _formats[name] = _formats_by_id[format_id] = (format_id, dumps, loads)
+
+
+def register_compression(name, compression_id, compress, decompress):
+    """
+    Registers a compression algorithm.
+    :param compression_id: int from 1 to 3, stored in the header of every value
+    """
+    if not 1 <= compression_id <= 3:
+        raise ValueError("compression_id must be between 1 and 3")
+    _compressions[name] = _compressions_by_id[compression_id] = \
+        (compression_id, compress, decompress)
+
+
+def formats():
+    return sorted(_formats)
+
+
+def compressions():
+    return sorted(_compressions)
+
+
+register_format('pickle', 1,
+                lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                pickle.loads)
+register_format('marshal', 2, marshal.dumps, marshal.loads)
+register_format('json', 3,
+                lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8'),
+                lambda data: json.loads(data.decode('utf-8')))
+register_compression('zlib', 1, zlib.compress, zlib.decompress)
+
+try:
+    import msgpack
+except ImportError:
+    pass
+else:
+    register_format('msgpack', 4,
+                    lambda value: msgpack.packb(value, use_bin_type=True),
+                    lambda data: msgpack.unpackb(data, raw=False))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register_compression('lz4', 2, lz4.frame.compress, lz4.frame.decompress)
+
+
+class Codec(object):
+    """
+    Encodes values with a registered format, compressing the ones larger than
+    `compress_threshold` bytes (when it saves space) if `compression` is set.
+    Decodes values written with any registered format and compression.
+    """
+    def __init__(self, format='pickle', compression=None,
+                 compress_threshold=1024, legacy=pickle.loads):
+        if format not in _formats:
+            raise ValueError("Unknown format {0}, use one of {1}".format(
+                format, ', '.join(formats())))
+        if compression is not None and compression not in _compressions:
+            raise ValueError("Unknown compression {0}, use one of {1}".format(
+                compression, ', '.join(compressions())))
+        self.format = format
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.legacy = legacy
+
+    def dumps(self, value):
+        format_id, dumps, _ = _formats[self.format]
+        data = dumps(value)
+        header = format_id
+        if self.compression is not None and len(data) > self.compress_threshold:
+            compression_id, compress, _ = _compressions[self.compression]
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                header |= compression_id << 3
+        return bytes(bytearray([header])) + data
+
+    def loads(self, data):
+        header = bytearray(data[:1])[0] if isinstance(data, bytes) and data else 0
+        if not 0x01 <= header <= 0x1f:
+            return self.legacy(data)
+        data = bytes(data[1:])
+        if header >> 3:
+            data = _compressions_by_id[header >> 3][2](data)
+        return _formats_by_id[header & 0x07][2](data)
+
+    def __repr__(self):
+        return "Codec({0!r}, compression={1!r}, compress_threshold={2!r})".format(
+            self.format, self.compression, self.compress_threshold)
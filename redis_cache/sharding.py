@@ -0,0 +1,376 @@
+"""
+Client-side sharding of a cache over several redis nodes.
+Keys are routed with ketama-style consistent hashing, so adding or removing
+one of N nodes only remaps about 1/N of the keys. Every node is a plain
+SimpleCache with its own key set, holding its share of `limit`.
+"""
+from bisect import bisect_left
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import hashlib
+import math
+import struct
+import threading
+
+from .rediscache import (BaseCache, DEFAULT_EXPIRY, SimpleCache,
+                         string_types, text_type, to_unicode)
+
+
+def _points(data):
+    """
+    Returns the four 32 bit ring points of `data`'s md5 digest.
+    """
+    digest = hashlib.md5(data.encode('utf-8')).digest()
+    return struct.unpack('<4I', digest)
+
+
+def _ring_key(key):
+    key = to_unicode(key)
+    return key if isinstance(key, text_type) else text_type(key)
+
+
+class HashRing(object):
+    """
+    Ketama consistent hash ring: every node gets `replicas` points on a 32
+    bit ring (four per md5 digest of `name-i`), and a key belongs to the
+    node owning the first point at or after the key's hash.
+    """
+    def __init__(self, nodes=(), replicas=160):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        self._nodes = set()
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        ring = list(zip(self._points, self._owners))
+        for i in range(int(math.ceil(self.replicas / 4.0))):
+            for point in _points(u'{0}-{1}'.format(node, i)):
+                ring.append((point, node))
+        self._rebuild(ring)
+
+    def remove_node(self, node):
+        self._nodes.discard(node)
+        self._rebuild([(point, owner) for point, owner
+                       in zip(self._points, self._owners) if owner != node])
+
+    def _rebuild(self, ring):
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._owners = [owner for _, owner in ring]
+
+    def get_node(self, key):
+        if not self._points:
+            raise KeyError("The ring has no nodes")
+        index = bisect_left(self._points, _points(key)[0])
+        if index == len(self._points):
+            index = 0
+        return self._owners[index]
+
+    @property
+    def nodes(self):
+        return set(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+def _node_config(node):
+    """
+    Returns the (name, SimpleCache kwargs) of a node given as "host",
+    "host:port", "host:port/db", a (host, port) tuple or a dict of
+    SimpleCache connection kwargs (with an optional name). The port
+    defaults to 6379.
+    """
+    if isinstance(node, string_types):
+        address, _, db = node.partition('/')
+        host, colon, port = address.rpartition(':')
+        if not colon:
+            host = port
+        config = {'host': host or 'localhost', 'port': int(port) if colon and port else 6379}
+        if db:
+            config['db'] = int(db)
+    elif isinstance(node, (tuple, list)):
+        config = {'host': node[0], 'port': int(node[1])}
+    else:
+        config = dict(node)
+    name = config.pop('name', None)
+    if name is None:
+        name = u'{0}:{1}'.format(config.get('host') or 'localhost',
+                                 config.get('port') or 6379)
+        if config.get('db'):
+            name += u'/{0}'.format(config['db'])
+    return name, config
+
+
+class ShardedCache(BaseCache):
+    """
+    SimpleCache API over several redis nodes. Single key operations go to
+    the key's node, multi key and bulk operations are split by node and run
+    in parallel threads. `limit` (and max_bytes) is shared equally between
+    nodes, and len() sums the sizes of every node. Can be passed to cache_it
+    and cache_it_batch like a SimpleCache.
+    :param nodes: list of "host:port" strings, (host, port) tuples or dicts
+        of connection kwargs
+    :param replicas: number of points of every node on the hash ring
+    Other keyword arguments are passed to the SimpleCache of every node.
+    """
+    def __init__(self, nodes, limit=10000, expire=DEFAULT_EXPIRY,
+                 hashkeys=False, namespace="SimpleCache", replicas=160,
+                 **kwargs):
+        self.limit = limit
+        self.expire = expire
+        self.hashkeys = hashkeys
+        self.prefix = namespace
+        self.cache_kwargs = kwargs
+        self.ring = HashRing(replicas=replicas)
+        self.shards = OrderedDict()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        """
+        Adds a node, which takes over about 1/N of the keys. Entries of the
+        remapped keys are left on their previous node until they expire or
+        are evicted.
+        """
+        name, config = _node_config(node)
+        config.update(self.cache_kwargs)
+        self.shards[name] = SimpleCache(self.limit, self.expire,
+                                        hashkeys=self.hashkeys,
+                                        namespace=self.prefix, **config)
+        self.ring.add_node(name)
+        self._update_limits()
+        return name
+
+    def remove_node(self, name):
+        del self.shards[name]
+        self.ring.remove_node(name)
+        self._update_limits()
+
+    def _update_limits(self):
+        if self.limit and self.shards:
+            shard_limit = int(math.ceil(self.limit / float(len(self.shards))))
+            for shard in self.shards.values():
+                shard.limit = shard_limit
+        max_bytes = self.cache_kwargs.get('max_bytes')
+        if max_bytes and self.shards:
+            shard_bytes = int(math.ceil(max_bytes / float(len(self.shards))))
+            for shard in self.shards.values():
+                shard.max_bytes = shard_bytes
+
+    def used_bytes(self):
+        return sum(self._all('used_bytes'))
+
+    def shard(self, key):
+        """
+        Returns the SimpleCache of the node owning `key`.
+        """
+        return self.shards[self.ring.get_node(_ring_key(key))]
+
+    @property
+    def connection(self):
+        """
+        None if every node is unreachable, like a SimpleCache without
+        connection.
+        """
+        for shard in self.shards.values():
+            if shard.connection is not None:
+                return self
+        return None
+
+    def available(self, key=None):
+        """
+        Whether the node of `key` is available, or any node without a key.
+        Multi key operations skip unavailable nodes: their keys are missed
+        and not stored, so decorators compute them.
+        """
+        if key is not None:
+            return self.shard(key).available()
+        return any(shard.available() for shard in self.shards.values())
+
+    def _map(self, function, calls):
+        """
+        Runs function(shard, *args) for every (shard, args) of `calls` in
+        parallel.
+        :return: list of results
+        """
+        if len(calls) <= 1:
+            return [function(shard, *args) for shard, args in calls]
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(max(len(self.shards), 2))
+            pool = self._pool
+        return pool.map(lambda call: function(call[0], *call[1]), calls)
+
+    def _all(self, method, *args):
+        return self._map(lambda shard, *a: getattr(shard, method)(*a),
+                         [(shard, args) for shard in self.shards.values()])
+
+    def _group(self, items, key=lambda item: item, available=False):
+        """
+        Groups items by the shard of their key, leaving out the items of
+        unavailable shards if `available`.
+        :return: list of (shard, [items])
+        """
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(self.ring.get_node(_ring_key(key(item))), []).append(item)
+        return [(self.shards[name], group) for name, group in groups.items()
+                if not available or self.shards[name].available()]
+
+    # Single key operations
+
+    def store(self, key, value, expire=None):
+        self.shard(key).store(key, value, expire)
+
+    def store_json(self, key, value, expire=None):
+        self.shard(key).store_json(key, value, expire)
+
+    def store_pickle(self, key, value, expire=None):
+        self.shard(key).store_pickle(key, value, expire)
+
+    def store_encoded(self, key, value, expire=None, codec=None):
+        self.shard(key).store_encoded(key, value, expire, codec)
+
+    def store_chunks(self, key, chunks, expire=None):
+        self.shard(key).store_chunks(key, chunks, expire)
+
+    def get(self, key):
+        return self.shard(key).get(key)
+
+    def iter_chunks(self, key):
+        return self.shard(key).iter_chunks(key)
+
+    def get_stream(self, key):
+        return self.shard(key).get_stream(key)
+
+    def get_json(self, key):
+        return self.shard(key).get_json(key)
+
+    def get_pickle(self, key):
+        return self.shard(key).get_pickle(key)
+
+    def get_decoded(self, key, codec=None):
+        return self.shard(key).get_decoded(key, codec)
+
+    def invalidate(self, key):
+        self.shard(key).invalidate(key)
+
+    def isexpired(self, key):
+        return self.shard(key).isexpired(key)
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+    def _acquire_lock(self, key, token, timeout):
+        return self.shard(key)._acquire_lock(key, token, timeout)
+
+    def _release_lock(self, key, token):
+        self.shard(key)._release_lock(key, token)
+
+    # Multi key operations, split by node
+
+    def _mget(self, method, keys, *args):
+        found = {}
+        calls = [(shard, (group,) + args) for shard, group
+                 in self._group(keys, available=True)]
+        for result in self._map(lambda shard, *a: getattr(shard, method)(*a), calls):
+            found.update(result or {})
+        return found
+
+    def mget(self, keys):
+        return self._mget('mget', keys)
+
+    def mget_json(self, keys):
+        return self._mget('mget_json', keys)
+
+    def mget_pickle(self, keys):
+        return self._mget('mget_pickle', keys)
+
+    def mget_decoded(self, keys, codec=None):
+        return self._mget('mget_decoded', keys, codec)
+
+    def _store_items(self, items):
+        return sum(self._map(lambda shard, group: shard._store_items(group),
+                             [(shard, (group,)) for shard, group in self._group(
+                                 items, key=lambda item: item[0], available=True)]))
+
+    def _store_many(self, method, mapping, *args):
+        if isinstance(mapping, dict):
+            mapping = mapping.items()
+        calls = [(shard, (group,) + args) for shard, group
+                 in self._group(mapping, key=lambda item: item[0], available=True)]
+        return sum(self._map(lambda shard, *a: getattr(shard, method)(*a), calls))
+
+    def store_many(self, mapping, expire=None, chunk_size=1000):
+        return self._store_many('store_many', mapping, expire, chunk_size)
+
+    def store_many_json(self, mapping, expire=None, chunk_size=1000):
+        return self._store_many('store_many_json', mapping, expire, chunk_size)
+
+    def store_many_pickle(self, mapping, expire=None, chunk_size=1000):
+        return self._store_many('store_many_pickle', mapping, expire, chunk_size)
+
+    def store_many_encoded(self, mapping, expire=None, chunk_size=1000,
+                           codec=None):
+        return self._store_many('store_many_encoded', mapping, expire,
+                                chunk_size, codec)
+
+    # Operations on every node
+
+    def __len__(self):
+        return sum(self._all('__len__'))
+
+    def keys(self):
+        keys = set()
+        for shard_keys in self._all('keys'):
+            keys.update(shard_keys)
+        return keys
+
+    def __iter__(self):
+        for shard in self.shards.values():
+            for key in shard:
+                yield key
+
+    def expire_all_in_set(self, chunk_size=1000, rate_limit=None):
+        results = self._all('expire_all_in_set', chunk_size, rate_limit)
+        return sum(size for size, _ in results), sum(expired for _, expired in results)
+
+    def reap(self, chunk_size=1000, rate_limit=None):
+        """
+        Reaps the key set of every node in parallel.
+        :return: list of the BulkProgress of every node
+        """
+        return self._all('reap', chunk_size, rate_limit)
+
+    def expire_namespace(self, namespace):
+        results = self._all('expire_namespace', namespace)
+        expired = [count for _, count in results]
+        return (sum(size for size, _ in results),
+                None if None in expired else sum(expired))
+
+    def flush(self, chunk_size=1000, rate_limit=None):
+        """
+        Flushes every node in parallel.
+        :return: list of the BulkProgress of every node
+        """
+        return self._all('flush', chunk_size, rate_limit)
+
+    def flush_namespace(self, space):
+        self._all('flush_namespace', space)
+
+    def close(self):
+        """
+        Stops the threads running parallel operations.
+        """
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
@@ -0,0 +1,131 @@
+"""
+Streaming file format of SimpleCache.export_snapshot and import_snapshot, and
+a command line tool to warm up a fresh redis with a namespace exported from
+another one:
+
+    python -m redis_cache export --namespace users users.snap.gz
+    python -m redis_cache import --namespace users --host new-redis users.snap.gz
+
+A snapshot is a header (magic and export time) followed by a record per redis
+key: its kind (a cache entry or a chunk of a chunked value), key, remaining
+ttl in milliseconds (-1 for none), eviction score (NaN for none) and value as
+serialized by DUMP. Files whose name ends in .gz are gzipped.
+"""
+from __future__ import print_function
+import argparse
+import gzip
+import struct
+import sys
+import time
+
+MAGIC = b'RSCSNAP1'
+HEADER = struct.Struct('>8sd')
+RECORD = struct.Struct('>cIqdI')
+
+# Record kinds: an entry of the key set (by cache key), or a chunk of a
+# chunked value (by its index in the value), written before the entry
+# referencing it so imports can store it under a key of their own cache.
+ENTRY = b'k'
+CHUNK = b'c'
+
+text_type = type(u'')
+
+
+def _read(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated snapshot")
+    return data
+
+
+class SnapshotWriter(object):
+    def __init__(self, fileobj, created=None):
+        self.fileobj = fileobj
+        self.records = 0
+        fileobj.write(HEADER.pack(MAGIC, created or time.time()))
+
+    def write(self, kind, key, pttl, score, payload):
+        if isinstance(key, text_type):
+            key = key.encode('utf-8')
+        self.fileobj.write(RECORD.pack(kind, len(key), pttl,
+                                       float('nan') if score is None else score,
+                                       len(payload)))
+        self.fileobj.write(key)
+        self.fileobj.write(payload)
+        self.records += 1
+
+
+class SnapshotReader(object):
+    """
+    Iterates over the (kind, key, pttl, score, payload) records of a
+    snapshot, reading one record at a time.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        magic, self.created = HEADER.unpack(_read(fileobj, HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("Not a redis-simple-cache snapshot")
+
+    def __iter__(self):
+        while True:
+            head = self.fileobj.read(RECORD.size)
+            if not head:
+                return
+            if len(head) != RECORD.size:
+                raise ValueError("Truncated snapshot")
+            kind, key_size, pttl, score, size = RECORD.unpack(head)
+            key = _read(self.fileobj, key_size).decode('utf-8')
+            payload = _read(self.fileobj, size)
+            yield kind, key, pttl, None if score != score else score, payload
+
+
+def _open(path, mode):
+    if path == '-':
+        stream = sys.stdout if 'w' in mode else sys.stdin
+        return getattr(stream, 'buffer', stream)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def main(argv=None):
+    from .rediscache import EVICTION_POLICIES, SimpleCache
+
+    parser = argparse.ArgumentParser(
+        description="Exports or imports the entries of a redis-simple-cache namespace")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', help="snapshot file, - for stdout/stdin, gzipped if it ends in .gz")
+    parser.add_argument('--namespace', required=True)
+    parser.add_argument('--namespace-generations', action='store_true',
+                        help="the namespace is used with namespace_generations=True")
+    parser.add_argument('--eviction-policy', choices=EVICTION_POLICIES, default='random',
+                        help="the eviction_policy the namespace is used with")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--password')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="keys per round trip")
+    parser.add_argument('--keep-existing', action='store_true',
+                        help="don't overwrite entries already in redis when importing")
+    args = parser.parse_args(argv)
+
+    cache = SimpleCache(namespace=args.namespace, host=args.host, port=args.port,
+                        db=args.db, password=args.password,
+                        namespace_generations=args.namespace_generations,
+                        eviction_policy=args.eviction_policy)
+    if cache.connection is None:
+        raise SystemExit("Can't connect to redis at {0}:{1}".format(args.host, args.port))
+    started = time.time()
+    fileobj = _open(args.file, 'wb' if args.command == 'export' else 'rb')
+    try:
+        if args.command == 'export':
+            count = cache.export_snapshot(fileobj, args.chunk_size)
+        else:
+            count = cache.import_snapshot(fileobj, args.chunk_size,
+                                          replace=not args.keep_existing)
+    finally:
+        if args.file != '-':
+            fileobj.close()
+    print("{0}ed {1} entries in {2:.1f}s".format(args.command, count, time.time() - started),
+          file=sys.stderr)
@@ -0,0 +1,12 @@
+#AsyncSimpleCache Tests
+#~~~~~~~~~~~~~~~~~~~~~~
+# The tests are in _test_aio.py, whose `async def`s python 2 can't parse,
+# so that test discovery still works there.
+import sys
+from unittest import main
+
+if sys.version_info >= (3, 8):
+    from redis_cache._test_aio import AsyncSimpleCacheTest
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+#Backend Tests
+#~~~~~~~~~~~~~
+from unittest import TestCase, main
+import os
+import tempfile
+import time
+
+import redis
+
+from redis_cache.backends import MemoryBackend, SharedMemoryBackend, get_backend
+from redis_cache.buckets import BUCKET_STORE_SCRIPT
+from redis_cache.rediscache import (DELETE_SCRIPT, FETCH_SCRIPT, REAP_SCRIPT,
+                                    RELEASE_LOCK_SCRIPT, STORE_SCRIPT)
+
+
+class MemoryBackendTest(TestCase):
+
+    def make_backend(self):
+        return MemoryBackend()
+
+    def setUp(self):
+        self.b = self.make_backend()
+
+    def test_strings_and_expiry(self):
+        self.assertTrue(self.b.set("a", u"\xe9t\xe9"))
+        self.assertEqual(self.b.get("a"), u"\xe9t\xe9".encode('utf-8'))
+        self.assertEqual(self.b.set("a", "other", nx=True), None)
+        self.assertEqual(self.b.incrby("n", 5), 5)
+        self.b.set("short", "lived", px=100)
+        self.assertTrue(0 < self.b.pttl("short") <= 100)
+        self.assertEqual(self.b.pttl("n"), -1)
+        time.sleep(0.2)
+        self.assertEqual(self.b.get("short"), None)
+        self.assertEqual(self.b.pttl("short"), -2)
+        self.assertRaises(redis.ResponseError, self.b.sadd, "a", "member")
+
+    def test_scan_while_deleting(self):
+        self.b.sadd("set", *range(500))
+        seen, cursor = set(), None
+        while cursor != 0:
+            cursor, members = self.b.sscan("set", cursor or 0, count=37)
+            seen.update(members)
+            self.b.srem("set", *members)
+        self.assertEqual(len(seen), 500)
+        self.assertEqual(self.b.exists("set"), 0)
+
+    def test_glob(self):
+        for name in ("ns:a*b", "ns:axb", "ns:c", "other"):
+            self.b.set(name, "1")
+        self.assertEqual(sorted(self.b.keys("ns:*")), [b"ns:a*b", b"ns:axb", b"ns:c"])
+        self.assertEqual(self.b.keys("ns:a\\*b"), [b"ns:a*b"])
+        self.assertEqual(sorted(self.b.keys("ns:[^c]*")), [b"ns:a*b", b"ns:axb"])
+
+    def test_sorted_set(self):
+        self.b.zadd("z", {"a": 2, "b": 1, "c": float('inf')})
+        self.assertEqual(self.b.zrange("z", 0, 1), [b"b", b"a"])
+        self.assertEqual(self.b.execute_command('ZADD', "z", 'XX', 'INCR', 5, "b"), 6.0)
+        self.assertEqual(self.b.execute_command('ZADD', "z", 'XX', 1, "missing"), 0)
+        self.assertEqual(self.b.zrange("z", -2, -1, withscores=True),
+                         [(b"b", 6.0), (b"c", float('inf'))])
+
+    def test_dump_restore(self):
+        self.b.hset("h", mapping={"f": "v", "g": "w"})
+        self.b.expire("h", 60)
+        payload = self.b.dump("h")
+        self.b.restore("copy", 0, payload)
+        self.assertEqual(self.b.hgetall("copy"), {b"f": b"v", b"g": b"w"})
+        self.assertRaises(redis.ResponseError, self.b.restore, "copy", 0, payload)
+        self.assertTrue(self.b.restore("copy", 1000, payload, replace=True))
+        self.assertTrue(0 < self.b.pttl("copy") <= 1000)
+
+    def test_pipeline_and_scripts(self):
+        with self.b.pipeline() as pipe:
+            pipe.set("lock", "token").sadd("lock", "x").incr("count")
+            self.assertRaises(redis.ResponseError, pipe.execute)
+        self.assertEqual(self.b.get("count"), b"1")
+        self.assertEqual(self.b.evalsha(RELEASE_LOCK_SCRIPT.sha, 1, "lock", "other"), 0)
+        self.assertEqual(self.b.eval(RELEASE_LOCK_SCRIPT.source, 1, "lock", "token"), 1)
+        self.assertRaises(redis.exceptions.NoScriptError, self.b.evalsha, "0" * 40, 0)
+        self.assertRaises(redis.ResponseError, self.b.eval, "return 1", 0)
+
+    def test_pubsub(self):
+        pubsub = self.b.pubsub()
+        pubsub.subscribe("channel")
+        self.assertEqual(pubsub.get_message(timeout=1)['type'], 'subscribe')
+        self.b.publish("channel", "hello")
+        self.assertEqual(pubsub.get_message(timeout=1)['data'], b"hello")
+        pubsub.close()
+
+
+class SharedMemoryBackendTest(MemoryBackendTest):
+
+    def make_backend(self):
+        return SharedMemoryBackend(os.path.join(tempfile.mkdtemp(), 'test.sqlite3'))
+
+    def test_shared_between_processes(self):
+        self.b.set("before", "fork")
+        pid = os.fork()
+        if pid == 0:
+            ok = self.b.get("before") == b"fork" and self.b.sadd("set", "child") == 1
+            os._exit(0 if ok else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.b.smembers("set"), set([b"child"]))
+        other = SharedMemoryBackend(self.b.path)
+        self.assertEqual(other.get("before"), b"fork")
+
+    def test_reads_skip_the_write_lock(self):
+        self.b.set("a", "b")
+        self.b.set("short", "lived", px=50)
+        time.sleep(0.1)
+        other = SharedMemoryBackend(self.b.path, timeout=0.05)
+        with self.b.atomic():
+            self.b.set("c", "d")
+            self.assertEqual(other.get("a"), b"b")
+            self.assertEqual(other.mget(["a", "c", "short"]), [b"b", None, None])
+            self.assertRaises(redis.TimeoutError, other.set, "e", "f")
+        expiring = "SELECT count(*) FROM entries WHERE expires IS NOT NULL"
+        with other.atomic(write=False):
+            self.assertEqual(other._db.execute(expiring).fetchone()[0], 1)
+            self.assertRaises(RuntimeError, other.set, "e", "f")
+        other.set("e", "f")
+        with other.atomic(write=False):
+            self.assertEqual(other._db.execute(expiring).fetchone()[0], 0)
+
+
+class PortParityTest(TestCase):
+    """
+    Runs every script on redis and, as its Python port, on a MemoryBackend,
+    checking that both reply and leave the keys alike.
+    """
+    index = ["parity:set", "parity:scores", "parity:sizes", "parity:bytes"]
+
+    def setUp(self):
+        self.redis = redis.StrictRedis()
+        self.memory = MemoryBackend()
+        self.clean()
+
+    def tearDown(self):
+        self.clean()
+
+    def clean(self):
+        names = list(self.redis.scan_iter("parity:*"))
+        if names:
+            self.redis.delete(*names)
+
+    def state(self, client):
+        state = {}
+        for name in client.scan_iter("parity:*"):
+            kind = client.type(name)
+            if kind == b"string":
+                value = client.get(name)
+            elif kind == b"set":
+                value = client.smembers(name)
+            elif kind == b"hash":
+                value = client.hgetall(name)
+            else:
+                value = client.zrange(name, 0, -1, withscores=True)
+            state[name] = (kind, value, client.ttl(name))
+        return state
+
+    def call(self, command, *args):
+        for client in (self.redis, self.memory):
+            getattr(client, command)(*args)
+
+    def run_script(self, script, keys, args):
+        replies = [client.eval(script.source, len(keys), *(keys + args))
+                   for client in (self.redis, self.memory)]
+        self.assertEqual(replies[0], replies[1])
+        self.assertEqual(self.state(self.redis), self.state(self.memory))
+        return replies[0]
+
+    def store(self, policy, now, *entries, **options):
+        args = ["parity:", options.get('limit', 0), policy, now, 1, "parity:channel",
+                options.get('gen_prefix', ""), options.get('max_bytes', 0)]
+        for entry in entries:
+            args.extend(entry)
+        return self.run_script(STORE_SCRIPT, self.index, args)
+
+    def test_store_and_evict(self):
+        for policy in ('lru', 'lfu', 'ttl-soonest'):
+            self.clean()
+            self.memory.flushall()
+            self.store(policy, 100, ("a", "1", 60), ("b", "22", 0), limit=2, max_bytes=10)
+            self.assertEqual(self.store(policy, 101, ("c", "333", 30), limit=2, max_bytes=10), 1)
+            self.assertEqual(self.store(policy, 102, ("d", "4444444", 0), limit=2, max_bytes=10), 1)
+            self.store(policy, 103, ("e", "x" * 20, 0), limit=2, max_bytes=10)
+            self.store(policy, 104, ("d", "4", 0), ("f", "5", 0), ("d", "6", 0),
+                       limit=2, max_bytes=10)
+
+    def test_chunks_and_generations(self):
+        self.call('set', "parity:gen:ns", "3")
+        self.call('set', "parity:chunk:0", "abc")
+        self.call('set', "parity:chunk:1", "de")
+        manifest = "\0chunks:2:5:parity:chunk"
+        self.store('random', 100, ("ns:k", manifest, 60), ("other", "v", 0),
+                   gen_prefix="parity:gen:", max_bytes=1000)
+        self.assertEqual(self.run_script(FETCH_SCRIPT, ["parity:scores"],
+                                         ["parity:", "parity:gen:", "lru", 100,
+                                          "ns:k", "ns:missing", "other"])[1], None)
+        self.store('random', 101, ("ns:k", "small", 0), gen_prefix="parity:gen:",
+                   max_bytes=1000)
+
+    def test_fetch_delete_and_reap(self):
+        for policy in ('lru', 'lfu'):
+            self.store(policy, 100, ("a", "1", 0), ("b", "2", 0), ("c", "3", 0), max_bytes=100)
+            self.run_script(FETCH_SCRIPT, ["parity:scores"],
+                            ["parity:", "", policy, 200, "a", "missing", "c"])
+        self.run_script(DELETE_SCRIPT, self.index,
+                        ["parity:", "", "1", "parity:channel", "key|a", "a", "missing"])
+        self.run_script(DELETE_SCRIPT, self.index, ["parity:", "", "0", "", "", "b"])
+        self.call('delete', "parity:c")
+        self.assertEqual(self.run_script(REAP_SCRIPT, self.index,
+                                         ["parity:", "", "b", "c", "missing"]), 2)
+
+    def test_release_lock_and_buckets(self):
+        self.call('set', "parity:lock", "token")
+        self.assertEqual(self.run_script(RELEASE_LOCK_SCRIPT, ["parity:lock"], ["other"]), 0)
+        self.assertEqual(self.run_script(RELEASE_LOCK_SCRIPT, ["parity:lock"], ["token"]), 1)
+        buckets = ["parity:bucket:0", "parity:bucket:1"]
+        self.run_script(BUCKET_STORE_SCRIPT, buckets,
+                        [2, 100, 0, "a", "150:x", 50, "b", "0:y", 0])
+        self.run_script(BUCKET_STORE_SCRIPT, buckets[:1], [2, 100, 0, "c", "90:z", 60])
+        self.assertEqual(self.run_script(BUCKET_STORE_SCRIPT, buckets[:1],
+                                         [2, 120, 0, "d", "0:w", 0]), 1)
+
+
+class GetBackendTest(TestCase):
+
+    def test_names(self):
+        self.assertTrue(get_backend('memory') is get_backend('memory'))
+        backend = MemoryBackend()
+        self.assertTrue(get_backend(backend) is backend)
+        self.assertRaises(ValueError, get_backend, 'memcached')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#BucketedCache Tests
+#~~~~~~~~~~~~~~~~~~~
+from unittest import TestCase, main
+import os
+import tempfile
+import time
+
+from redis_cache.backends import SharedMemoryBackend
+from redis_cache.buckets import BucketedCache, _bucket_of
+from redis_cache.rediscache import CacheMissException, ExpiredKeyException, cache_it
+
+
+class BucketOfTest(TestCase):
+
+    def test_spread(self):
+        counts = [0] * 16
+        for i in range(16000):
+            counts[_bucket_of(u'key:%d' % i, 16)] += 1
+        for count in counts:
+            self.assertTrue(800 < count < 1200, counts)
+
+
+class BucketedCacheTest(TestCase):
+    backend = None
+
+    def setUp(self):
+        self.c = BucketedCache(100, namespace="bucketed", field_ttl=False,
+                               backend=self.backend)
+        self.c.flush()
+
+    def tearDown(self):
+        self.c.flush()
+
+    def test_store_retrieve(self):
+        self.c.store("foo", "bar")
+        self.c.store_pickle("pickled", {"a": 1})
+        self.assertEqual(self.c.get("foo"), b"bar")
+        self.assertEqual(self.c.get_pickle("pickled"), {"a": 1})
+        self.assertTrue("foo" in self.c)
+        self.assertEqual(self.c.mget(["foo", "missing"]), {"foo": b"bar"})
+        self.c.invalidate("foo")
+        self.assertRaises(CacheMissException, self.c.get, "foo")
+        self.assertEqual(len(self.c), 1)
+
+    def test_embedded_expiry(self):
+        self.c.store("short", "lived", expire=1)
+        self.c.store("forever", "young", expire=0)
+        self.assertTrue(0 < self.c.isexpired("short") <= 1000)
+        self.assertEqual(self.c.isexpired("forever"), -1)
+        time.sleep(2)
+        self.assertRaises(ExpiredKeyException, self.c.get, "short")
+        self.assertEqual(self.c.mget(["short", "forever"]), {"forever": b"young"})
+
+    def test_limit(self):
+        self.c.store_many(dict(("k%d" % i, i) for i in range(500)))
+        self.assertTrue(len(self.c) <= 100)
+
+    def test_expire_all_in_set(self):
+        self.c.store_many({"a": 1, "b": 2, "c": 3})
+        self.assertEqual(self.c.expire_all_in_set(), (3, 3))
+        self.assertEqual(len(self.c), 0)
+
+    def test_unsupported(self):
+        for option in ({'eviction_policy': 'lru'}, {'max_bytes': 1000},
+                       {'chunk_threshold': 100}):
+            self.assertRaises(ValueError, BucketedCache, 100, backend=self.backend,
+                              field_ttl=False, **option)
+        self.assertRaises(NotImplementedError, self.c.reap)
+        self.assertRaises(NotImplementedError, self.c.used_bytes)
+        self.assertRaises(NotImplementedError, self.c.export_snapshot, None)
+        self.assertRaises(NotImplementedError, self.c.get_stream, "foo")
+
+    def test_decorator(self):
+        @cache_it(cache=self.c)
+        def add(a, b):
+            return a + b
+        self.assertEqual(add(1, 2), add(1, 2))
+        self.assertEqual(add.stats['hits'], 1)
+
+
+class MemoryBucketedCacheTest(BucketedCacheTest):
+    backend = 'memory'
+
+
+class SharedMemoryBucketedCacheTest(BucketedCacheTest):
+    backend = SharedMemoryBackend(os.path.join(tempfile.mkdtemp(), 'test.sqlite3'))
+
+
+if __name__ == '__main__':
+    main()
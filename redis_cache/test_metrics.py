@@ -0,0 +1,92 @@
+#Metrics Tests
+#~~~~~~~~~~~~~
+from unittest import TestCase, main
+
+from redis_cache.metrics import (Histogram, Metrics, MetricsHook, NullMetrics,
+                                 add_hook, prometheus_text, remove_hook)
+
+
+class RecordingHook(MetricsHook):
+    def __init__(self):
+        self.events = []
+
+    def incr(self, metrics, name, amount):
+        self.events.append(('incr', metrics.name, name, amount))
+
+    def observe(self, metrics, name, value):
+        self.events.append(('observe', metrics.name, name))
+
+
+class MetricsTest(TestCase):
+
+    def test_histogram_quantiles(self):
+        histogram = Histogram((0.001, 0.01, 0.1))
+        self.assertEqual(histogram.quantile(0.5), None)
+        for value in [0.0005] * 98 + [0.05, 1]:
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.quantile(0.5), 0.001)
+        self.assertEqual(histogram.quantile(0.99), 0.1)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    def test_counters_and_timers(self):
+        metrics = Metrics('cache', 'test', ('hits', 'misses'))
+        metrics.incr('hits', 2)
+        with metrics.timer('redis_seconds'):
+            pass
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['hits'], 2)
+        self.assertEqual(snapshot['misses'], 0)
+        self.assertEqual(snapshot['latency']['redis_seconds']['count'], 1)
+
+    def test_hooks(self):
+        metrics = Metrics('function', 'hooked')
+        local, shared = RecordingHook(), RecordingHook()
+        metrics.add_hook(local)
+        add_hook(shared)
+        try:
+            metrics.incr('hits')
+            metrics.observe('compute_seconds', 0.5)
+        finally:
+            remove_hook(shared)
+        expected = [('incr', 'hooked', 'hits', 1),
+                    ('observe', 'hooked', 'compute_seconds')]
+        self.assertEqual(local.events, expected)
+        self.assertEqual(shared.events, expected)
+
+    def test_prometheus_text(self):
+        metrics = Metrics('cache', 'prom"ns', ('hits',))
+        metrics.incr('hits', 3)
+        metrics.observe('redis_seconds', 0.002)
+        text = prometheus_text()
+        self.assertTrue('# TYPE redis_cache_hits_total counter' in text)
+        self.assertTrue('redis_cache_hits_total{cache="prom\\"ns"} 3' in text)
+        self.assertTrue('redis_cache_redis_seconds_bucket{cache="prom\\"ns",le="0.0025"} 1' in text)
+        self.assertTrue('redis_cache_redis_seconds_bucket{cache="prom\\"ns",le="+Inf"} 1' in text)
+        self.assertTrue('redis_cache_redis_seconds_count{cache="prom\\"ns"} 1' in text)
+
+    def test_prometheus_same_labels(self):
+        first = Metrics('cache', 'shared', ('hits',))
+        second = Metrics('cache', 'shared', ('hits',), buckets=(0.001, 1.0))
+        first.incr('hits', 2)
+        second.incr('hits', 3)
+        first.observe('redis_seconds', 0.002)
+        second.observe('redis_seconds', 0.5)
+        lines = prometheus_text().splitlines()
+        self.assertEqual(lines.count('redis_cache_hits_total{cache="shared"} 5'), 1)
+        self.assertEqual(len([l for l in lines if l.startswith(
+            'redis_cache_redis_seconds_count{cache="shared"}')]), 1)
+        self.assertTrue('redis_cache_redis_seconds_bucket{cache="shared",le="0.0025"} 1' in lines)
+        self.assertTrue('redis_cache_redis_seconds_bucket{cache="shared",le="1.0"} 2' in lines)
+
+    def test_null_metrics(self):
+        metrics = NullMetrics('function', 'off')
+        metrics.incr('hits')
+        with metrics.timer('compute_seconds'):
+            pass
+        self.assertEqual(metrics, {})
+        self.assertFalse('function="off"' in prometheus_text())
+
+
+if __name__ == '__main__':
+    main()
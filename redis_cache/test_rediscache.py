@@ -1,10 +1,20 @@
 #SimpleCache Tests
 #~~~~~~~~~~~~~~~~~~~
 from datetime import timedelta
-from rediscache import SimpleCache, RedisConnect, cache_it, cache_it_json, CacheMissException, ExpiredKeyException, DoNotCache
+from redis_cache.rediscache import SimpleCache, LocalCache, RedisConnect, cache_it, cache_it_json, cache_it_batch, canonical_key, KeyBuilder, CacheMissException, ExpiredKeyException, DoNotCache, WriteBehind, CircuitBreaker, CircuitOpenError, CostPolicy
+from redis_cache.backends import SharedMemoryBackend
 from unittest import TestCase, main
+import os
+import pickle
+import socket
+import tempfile
 import time
 
+import redis
+
+SHARED_BACKEND = SharedMemoryBackend(os.path.join(tempfile.mkdtemp(), 'test.sqlite3'))
+
+
 class ComplexNumber(object):  # used in pickle test
     def __init__(self, real, imag):
         self.real = real
@@ -14,14 +24,28 @@ class ComplexNumber(object):  # used in pickle test
         return self.real == other.real and self.imag == other.imag
 
 
-class SimpleCacheTest(TestCase):
+class BackendTestCase(TestCase):
+    # Backend of the caches under test, None for redis. The tests run again
+    # against the other backends in the subclasses at the end of the module.
+    backend = None
+
+    def cache(self, *args, **kwargs):
+        kwargs.setdefault('backend', self.backend)
+        return SimpleCache(*args, **kwargs)
+
+    def require_redis(self):
+        if self.backend is not None:
+            self.skipTest("needs redis")
+
+
+class SimpleCacheTest(BackendTestCase):
 
     def setUp(self):
-        self.c = SimpleCache(10)  # Cache that has a maximum limit of 10 keys
+        self.c = self.cache(10)  # Cache that has a maximum limit of 10 keys
         self.assertIsNotNone(self.c.connection)
-        self.redis = RedisConnect().connect()
+        self.redis = self.c.connection
     def test_expire(self):
-        quick_c = SimpleCache()
+        quick_c = self.cache()
 
         quick_c.store("foo", "bar", expire=1)
         time.sleep(1.1)
@@ -50,7 +74,7 @@ class SimpleCacheTest(TestCase):
     def test_store_retrieve(self):
         self.c.store("foo", "bar")
         foo = self.c.get("foo")
-        self.assertEqual(foo, "bar")
+        self.assertEqual(foo, b"bar")
 
     def test_json(self):
         payload = {"example": "data"}
@@ -62,6 +86,26 @@ class SimpleCacheTest(TestCase):
         self.c.store_pickle("pickle", payload)
         self.assertEqual(self.c.get_pickle("pickle"), payload)
 
+    def test_encoded(self):
+        from redis_cache.serializers import Codec
+        self.c.store_encoded("plain", ComplexNumber(3, 4))
+        self.c.store_encoded("json", {"example": "data"}, codec=Codec('json', 'zlib', 0))
+        self.c.store_pickle("legacy", ComplexNumber(1, 2))
+        self.assertEqual(self.c.get_decoded("plain"), ComplexNumber(3, 4))
+        self.assertEqual(self.c.get_decoded("json"), {"example": "data"})
+        self.assertEqual(self.c.get_decoded("legacy"), ComplexNumber(1, 2))
+        self.assertEqual(self.c.mget_decoded(["plain", "json"]),
+                         {"plain": ComplexNumber(3, 4), "json": {"example": "data"}})
+
+    def test_decorator_codec(self):
+        from redis_cache.serializers import Codec
+
+        @cache_it(cache=self.c, codec=Codec('json', 'zlib', 10))
+        def squares(n):
+            return [i * i for i in range(n)]
+        self.assertEqual(squares(100), squares(100))
+        self.assertEqual(squares.stats['hits'], 1)
+
     def test_decorator(self):
         self.redis.flushall()
         mutable = []
@@ -138,6 +182,278 @@ class SimpleCacheTest(TestCase):
         keys_after = len(self.c.keys())
         self.assertEqual(keys_before, keys_after)
 
+    def test_decorator_single_flight(self):
+        import threading
+        calls = []
+
+        @cache_it(cache=self.c, single_flight=True)
+        def slow_double(n):
+            calls.append(n)
+            time.sleep(0.2)
+            return n * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow_double(21)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(slow_double.stats['merged'], 4)
+        self.assertEqual(slow_double(21), 42)
+        self.assertEqual(slow_double.stats['hits'], 1)
+
+    def test_decorator_single_flight_waits_for_lock(self):
+        import threading
+        calls = []
+
+        @cache_it(cache=self.c, single_flight=True, lock_timeout=5)
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        cache_key = double.cache_key(4)
+        # Another process holds the lock and stores the result a bit later.
+        self.redis.set(self.c.make_lock_key(cache_key), "other", px=5000)
+        timer = threading.Timer(0.2, self.c.store_pickle, (cache_key, 8))
+        timer.start()
+        self.assertEqual(double(4), 8)
+        timer.join()
+        self.assertEqual(calls, [])
+        self.assertEqual(double.stats['lock_waits'], 1)
+        self.redis.delete(self.c.make_lock_key(cache_key))
+
+    def test_decorator_single_flight_rechecks_after_lock(self):
+        calls = []
+
+        @cache_it(cache=self.c, single_flight=True)
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        acquire_lock = self.c._acquire_lock
+
+        def acquire_after_other_process(key, token, timeout):
+            # Another process stored the result and released the lock
+            # between the miss and this acquisition.
+            self.c.store_pickle(key, 8)
+            return acquire_lock(key, token, timeout)
+        self.c._acquire_lock = acquire_after_other_process
+        try:
+            self.assertEqual(double(4), 8)
+        finally:
+            del self.c._acquire_lock
+        self.assertEqual(calls, [])
+        self.assertEqual(double.stats['lock_waits'], 1)
+        self.assertFalse(self.c.connection.exists(self.c.make_lock_key(double.cache_key(4))))
+
+    def test_decorator_stale_while_revalidate(self):
+        calls = []
+
+        @cache_it(cache=self.c, expire=10, soft_expire=1)
+        def count():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(count(), 1)
+        self.assertEqual(count(), 1)
+        time.sleep(1.1)
+        self.assertEqual(count(), 1)  # stale value, refreshed in the background
+        time.sleep(0.2)
+        self.assertEqual(count(), 2)
+        self.assertEqual(count.stats['stale'], 1)
+        self.assertEqual(count.stats['refreshes'], 1)
+
+    def test_decorator_early_refresh(self):
+        calls = []
+
+        @cache_it_json(cache=self.c, early_refresh=1e9)
+        def count():
+            calls.append(1)
+            time.sleep(0.01)
+            return len(calls)
+
+        self.assertEqual(count(), 1)
+        self.assertEqual(count(), 1)
+        time.sleep(0.2)
+        self.assertEqual(count.stats['stale'], 0)
+        self.assertEqual(count.stats['refreshes'], 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_decorator_write_behind(self):
+        writer = WriteBehind(queue_size=100, batch_size=10)
+
+        @cache_it(cache=self.c, write_behind=writer)
+        def square(n):
+            return n * n
+
+        self.assertEqual([square(i) for i in range(5)], [0, 1, 4, 9, 16])
+        self.assertTrue(writer.flush(5))
+        self.assertEqual(writer.stats['written'], 5)
+        self.assertEqual(square.stats['stores'], 5)
+        self.assertEqual([square(i) for i in range(5)], [0, 1, 4, 9, 16])
+        self.assertEqual(square.stats['hits'], 5)
+
+    def test_decorator_write_behind_single_flight(self):
+        class SlowWriter(WriteBehind):
+            def _write(self, batch):
+                time.sleep(0.3)
+                WriteBehind._write(self, batch)
+
+        writer = SlowWriter()
+        calls = []
+
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        first = cache_it(cache=self.c, single_flight=True, write_behind=writer)(double)
+        # Stands in for another process, with its own single flight
+        second = cache_it(cache=self.c, single_flight=True)(double)
+        self.assertEqual(first(4), 8)
+        self.assertEqual(second(4), 8)
+        self.assertEqual(calls, [4])
+        self.assertEqual(second.stats['lock_waits'], 1)
+        self.assertTrue(writer.flush(5))
+
+    def test_decorator_cost_policy(self):
+        @cache_it(cache=self.c, expire=60,
+                  cost_policy=CostPolicy(min_compute_time=0.05, scale_ttl=True,
+                                         reference_cost_per_byte=1, min_ttl=5))
+        def slow(n, delay):
+            time.sleep(delay)
+            return n
+
+        self.assertEqual(slow(1, 0), 1)
+        self.assertEqual(slow(1, 0), 1)
+        self.assertEqual(slow.stats['skipped'], 2)
+        self.assertEqual(slow.stats['stores'], 0)
+        self.assertEqual(slow(2, 0.1), 2)
+        self.assertEqual(slow(2, 0.1), 2)
+        self.assertEqual(slow.stats['hits'], 1)
+        self.assertEqual(slow.stats['shortened'], 1)
+        self.assertTrue(0 < max(self.c.isexpired(key) for key in self.c.keys()) <= 5000)
+
+    def test_circuit_breaker(self):
+        c = self.cache(10, namespace="breaker",
+                        circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+        connection = c.connection
+        calls = []
+
+        @cache_it(cache=c)
+        def count():
+            calls.append(1)
+            return len(calls)
+
+        c.connection = redis.StrictRedis(port=1, socket_connect_timeout=0.1)
+        self.assertEqual(count(), 1)  # the get and the store fail
+        self.assertEqual(c.circuit_breaker.state, 'open')
+        self.assertFalse(c.available())
+        self.assertRaises(CircuitOpenError, c.store, "key", "value")
+        self.assertEqual(count(), 2)  # bypasses redis
+        c.connection = connection
+        time.sleep(0.5)
+        self.assertTrue(c.available())
+        self.assertEqual(count(), 3)
+        self.assertEqual(count(), 3)
+
+    def test_circuit_breaker_covers_locks(self):
+        c = self.cache(10, namespace="breaker-lock",
+                       circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+        c.connection = redis.StrictRedis(port=1, socket_connect_timeout=0.1)
+        self.assertRaises(redis.ConnectionError, c._acquire_lock, "key", "token", 1)
+        self.assertEqual(c.circuit_breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, c._acquire_lock, "key", "token", 1)
+
+    def test_decorator_timeout(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)  # accepts connections but never answers
+        c = self.cache(10, namespace="slow", timeout=0.05)
+        options = {}
+        try:  # redis-py 4+ retries timeouts by default
+            from redis.backoff import NoBackoff
+            from redis.retry import Retry
+            options['retry'] = Retry(NoBackoff(), 0)
+        except ImportError:
+            pass
+        c.connection = redis.StrictRedis(host='127.0.0.1', port=server.getsockname()[1],
+                                         socket_timeout=0.05, socket_connect_timeout=0.05,
+                                         **options)
+
+        @cache_it(cache=c)
+        def double(n):
+            return n * 2
+
+        @cache_it(cache=c, single_flight=True)
+        def triple(n):
+            return n * 3
+
+        @cache_it_batch(cache=c)
+        def quadruple(ids):
+            return [i * 4 for i in ids]
+
+        try:
+            self.assertEqual(double(2), 4)
+            self.assertEqual(triple(2), 6)
+            self.assertEqual(quadruple([1, 2]), [4, 8])
+            self.assertTrue(double.stats['errors'] >= 2)
+        finally:
+            server.close()
+
+    def test_decorator_batch(self):
+        calls = []
+
+        @cache_it_batch(cache=self.c)
+        def load(ids, factor=1):
+            calls.append(list(ids))
+            return [i * factor for i in ids]
+
+        self.assertEqual(load([1, 2, 3]), [1, 2, 3])
+        self.assertEqual(load([3, 4, 1, 4]), [3, 4, 1, 4])
+        self.assertEqual(load([1, 2], factor=10), [10, 20])
+        self.assertEqual(calls, [[1, 2, 3], [4], [1, 2]])
+        self.assertEqual(load.stats['hits'], 2)
+        self.assertEqual(load.stats['misses'], 6)
+
+    def test_decorator_batch_dict_and_ttl(self):
+        @cache_it_batch(cache=self.c, expire=lambda id_, result: 1 if id_ == "short" else 100)
+        def load(ids):
+            return dict((id_, id_.upper()) for id_ in ids if id_ != "none")
+
+        self.assertEqual(load(["short", "long", "none"]), ["SHORT", "LONG", None])
+        time.sleep(1.1)
+        self.assertEqual(load(["short", "long"]), ["SHORT", "LONG"])
+        self.assertEqual(load.stats['misses'], 4)
+
+    def test_decorator_batch_default_cache(self):
+        self.require_redis()
+
+        @cache_it_batch(expire=lambda id_, result: 100 if id_ == "short" else None)
+        def load(ids):
+            return [id_.upper() for id_ in ids]
+
+        self.assertEqual(load(["short", "long", "short"]), ["SHORT", "LONG", "SHORT"])
+        self.assertEqual(load(["long", "short"]), ["LONG", "SHORT"])
+        self.assertEqual(load.stats['misses'], 2)
+        self.assertEqual(load.stats['hits'], 2)
+
+    def test_decorator_key_func(self):
+        calls = []
+
+        @cache_it(cache=self.c, key_func=lambda user_id, verbose=False: user_id)
+        def load(user_id, verbose=False):
+            calls.append(user_id)
+            return user_id
+        load(1)
+        load(1, verbose=True)
+        self.assertEqual(calls, [1])
+        self.c.invalidate(load.cache_key(1))
+        load(1)
+        self.assertEqual(calls, [1, 1])
+
     def test_decorator_json(self):
         import random
 
@@ -172,6 +488,115 @@ class SimpleCacheTest(TestCase):
             self.failUnless(len(self.c) <= 10)
             self.failUnless(len(self.c.keys()) <= 10)
 
+    def test_cache_limit_concurrent_stores(self):
+        import threading
+
+        def store_many(n):
+            for i in range(50):
+                self.c.store("bar%d-%d" % (n, i), "foobar")
+        threads = [threading.Thread(target=store_many, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.c), 10)
+        self.assertEqual(len(self.redis.keys(self.c.make_key("bar*"))), 10)
+
+    def test_store_without_script_cached(self):
+        self.redis.script_flush()
+        self.c.store("foo", "bar")
+        self.c.store("foo", "baz")
+        self.assertEqual(self.c.get("foo"), b"baz")
+        self.assertEqual(len(self.c), 1)
+
+    def test_lru_eviction(self):
+        c = self.cache(10, namespace="lru", eviction_policy="lru")
+        for i in range(10):
+            c.store("foo%d" % i, "foobar")
+        c.get("foo0")
+        for i in range(10, 19):
+            c.store("foo%d" % i, "foobar")
+        self.assertEqual(c.get("foo0"), b"foobar")
+        self.assertRaises(CacheMissException, c.get, "foo1")
+        self.assertEqual(len(c), 10)
+        c.flush()
+
+    def test_lfu_eviction(self):
+        c = self.cache(10, namespace="lfu", eviction_policy="lfu")
+        for i in range(10):
+            c.store("foo%d" % i, "foobar")
+        c.mget(["foo3", "foo4"])
+        c.get("foo3")
+        for i in range(10, 30):
+            c.store("foo%d" % i, "foobar")
+        self.assertEqual(c.mget(["foo3", "foo4"]), {"foo3": b"foobar", "foo4": b"foobar"})
+        self.assertEqual(len(c), 10)
+        c.flush()
+
+    def test_ttl_soonest_eviction(self):
+        c = self.cache(2, namespace="ttl", eviction_policy="ttl-soonest",
+                        eviction_batch=2)
+        c.store("long", "foobar", expire=100)
+        c.store("short", "foobar", expire=10)
+        c.store("new", "foobar", expire=50)
+        self.assertRaises(CacheMissException, c.get, "short")
+        self.assertRaises(CacheMissException, c.get, "long")
+        self.assertEqual(len(c), 1)
+        c.flush()
+
+    def test_max_bytes(self):
+        c = self.cache(0, namespace="budget", max_bytes=1000, eviction_policy='lru')
+        for i in range(10):
+            c.store("k%d" % i, "x" * 200)
+        self.assertEqual(c.used_bytes(), 1000)
+        self.assertEqual(len(c), 5)
+        self.assertRaises(CacheMissException, c.get, "k0")
+        c.invalidate("k9")
+        self.assertEqual(c.used_bytes(), 800)
+        c.store("big", "x" * 2000)
+        self.assertFalse("big" in c)
+        self.assertEqual(c.store_many({"small": "x", "big": "x" * 2000}), 1)
+        c.flush()
+        self.assertEqual(c.used_bytes(), 0)
+        c.store("text", u"\xe9" * 100)
+        self.assertEqual(c.used_bytes(), 200)
+        c.store("ns:a", "x" * 100)
+        self.assertEqual(c.expire_namespace("ns"), (2, 1))
+        self.assertEqual(c.used_bytes(), 200)
+        c.flush()
+
+    def test_max_bytes_chunked(self):
+        c = self.cache(0, namespace="budget-chunked", max_bytes=1000,
+                       chunk_threshold=100, chunk_size=100)
+        c.store("fits", b"x" * 500)
+        self.assertEqual(c.used_bytes(), 500 + len(c.connection.get(c.make_key("fits"))))
+        c.store("big", os.urandom(5000))
+        c.store_pickle("report", os.urandom(5000))
+        self.assertFalse("big" in c or "report" in c)
+        self.assertEqual(c.get("fits"), b"x" * 500)
+        chunks = list(c.connection.scan_iter(b"SimpleCache-budget-chunked:*\x00*"))
+        self.assertEqual(len(chunks), 5)
+        c.flush()
+        self.assertEqual(c.used_bytes(), 0)
+
+    def test_shared_connection_pool(self):
+        self.require_redis()
+        c1 = self.cache(10, namespace="pool1")
+        c2 = self.cache(10, namespace="pool2")
+        self.assertTrue(c1.connection.connection_pool is c2.connection.connection_pool)
+        c3 = self.cache(10, namespace="pool3", db=1)
+        self.assertFalse(c1.connection.connection_pool is c3.connection.connection_pool)
+
+    def test_connection_pool_after_fork(self):
+        self.require_redis()
+        import os
+        pool = self.c.connection.connection_pool
+        pid = os.fork()
+        if pid == 0:
+            child_pool = RedisConnect().connect().connection_pool
+            os._exit(0 if child_pool is not pool else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
     def test_flush(self):
         connection = self.c.connection
         connection.set("will_not_be_deleted", '42')
@@ -184,12 +609,12 @@ class SimpleCacheTest(TestCase):
         self.assertTrue(len_before > 0)
         self.assertEqual(len_after, 0)
         self.assertTrue(len_keys_before > 0)
-        self.assertEqual(len_keys_after, '42')
-        self.assertEqual(connection.get("will_not_be_deleted"), '42')
+        self.assertEqual(len_keys_after, b'42')
+        self.assertEqual(connection.get("will_not_be_deleted"), b'42')
         connection.delete("will_not_be_deleted")
 
     def test_flush_namespace(self):
-    	self.redis.flushall()
+        self.redis.flushall()
         self.c.store("foo:one", "bir")
         self.c.store("foo:two", "bor")
         self.c.store("fii", "bur")
@@ -197,14 +622,14 @@ class SimpleCacheTest(TestCase):
         self.c.flush_namespace('foo')
         len_keys_after = len(self.c.keys())
         self.assertEqual((len_keys_before - len_keys_after), 2)
-        self.assertEqual(self.c.get('fii'), 'bur')
+        self.assertEqual(self.c.get('fii'), b'bur')
         self.assertRaises(CacheMissException, self.c.get, "foo:one")
         self.assertRaises(CacheMissException, self.c.get, "foo:two")
         self.c.flush()
 
     def test_flush_multiple(self):
-        c1 = SimpleCache(10, namespace=__name__)
-        c2 = SimpleCache(10)
+        c1 = self.cache(10, namespace=__name__)
+        c2 = self.cache(10)
         c1.store("foo", "bar")
         c2.store("foo", "bar")
         c1.flush()
@@ -224,6 +649,58 @@ class SimpleCacheTest(TestCase):
         self.assertTrue(self.c.isexpired("fuu"))
         self.assertTrue(self.c.isexpired("fii"))
 
+    def test_expire_all_in_set_counts_deleted(self):
+        self.c.store("foo", "bir")
+        self.c.store("fuu", "bor")
+        self.c.connection.delete(self.c.make_key("fuu"))
+        self.assertEqual(self.c.expire_all_in_set(), (2, 1))
+
+    def test_flush_in_chunks(self):
+        c = self.cache(100, namespace="chunks")
+        c.store_many(dict(("k%d" % i, i) for i in range(50)))
+        progress = c.flush(chunk_size=10, background=True)
+        self.assertTrue(progress.wait(5))
+        self.assertEqual(progress.deleted, 50)
+        self.assertEqual(len(c), 0)
+        c.store_many(dict(("k%d" % i, i) for i in range(50)))
+        self.assertEqual(c.expire_all_in_set(chunk_size=10, rate_limit=1000), (50, 50))
+        self.assertRaises(ExpiredKeyException, c.get, "k1")
+        c.flush()
+
+    def test_chunked_values(self):
+        c = self.cache(10, namespace="chunked", chunk_threshold=1000, chunk_size=100)
+        value = os.urandom(1050)
+        c.store("big", value)
+        c.store("small", b"tiny")
+        self.assertEqual(c.get("big"), value)
+        self.assertEqual(b"".join(c.iter_chunks("big")), value)
+        self.assertEqual(len(list(c.iter_chunks("big"))), 11)
+        self.assertEqual(c.get_stream("big").read(), value)
+        self.assertEqual(c.mget(["big", "small"]), {"big": value, "small": b"tiny"})
+        report = {"rows": [list(range(20)) for _ in range(50)]}
+        c.store_pickle("report", report)
+        self.assertEqual(c.get_pickle("report"), report)
+        self.assertEqual(c.get("report"), pickle.dumps(report))
+        c.store_many({"many": value, "few": b"tiny"})
+        self.assertEqual(len(list(c.iter_chunks("many"))), 11)
+        self.assertEqual(c.mget(["many", "few"]), {"many": value, "few": b"tiny"})
+        c.invalidate("big")
+        self.assertRaises(CacheMissException, c.get, "big")
+        self.assertEqual(list(c.connection.scan_iter(b"SimpleCache-chunked:big\x00*")), [])
+        c.flush()
+
+    def test_reap(self):
+        c = self.cache(100, namespace="reaped")
+        c.store_many(dict(("k%d" % i, i) for i in range(20)))
+        c.connection.delete(*[c.make_key("k%d" % i) for i in range(15)])
+        self.assertEqual(len(c), 20)
+        self.assertEqual(c.mget(["k0", "k1", "k19"]), {"k19": b"19"})
+        self.assertEqual(len(c), 18)
+        progress = c.reap(chunk_size=5)
+        self.assertEqual(progress.deleted, 13)
+        self.assertEqual(len(c), 5)
+        c.flush()
+
     def test_expire_namespace(self):
         self.c.store("foo:one", "bir")
         self.c.store("foo:two", "bor")
@@ -236,22 +713,41 @@ class SimpleCacheTest(TestCase):
         self.assertTrue(self.c.isexpired("fii") > 0)
         self.c.flush()
 
+    def test_namespace_generations(self):
+        c = self.cache(10, namespace="gens", namespace_generations=True)
+        c.store("foo:one", "bir")
+        c.store("foo:two", "bor")
+        c.store("fii", "bur")
+        self.assertEqual(c.get("foo:one"), b"bir")
+        self.assertEqual(c.mget(["foo:two", "fii"]), {"foo:two": b"bor", "fii": b"bur"})
+        self.assertEqual(c.expire_namespace('foo'), (3, None))
+        self.assertRaises(ExpiredKeyException, c.get, "foo:one")
+        self.assertEqual(c.get("fii"), b"bur")
+        c.store("foo:one", "new")
+        self.assertEqual(c.get("foo:one"), b"new")
+        self.assertEqual(c.cleanup_generations(), 2)
+        c.flush_namespace('foo')
+        self.assertRaises(CacheMissException, c.get, "foo:one")
+        self.assertRaises(CacheMissException, c.get, "foo:two")
+        self.assertEqual(c.cleanup_generations(), 1)
+        c.flush()
+
     def test_mget(self):
         self.c.store("a1", "a")
         self.c.store("a2", "aa")
         self.c.store("a3", "aaa")
         d = self.c.mget(["a1", "a2", "a3"])
-        self.assertEqual(d["a1"], "a")
-        self.assertEqual(d["a2"], "aa")
-        self.assertEqual(d["a3"], "aaa")
+        self.assertEqual(d["a1"], b"a")
+        self.assertEqual(d["a2"], b"aa")
+        self.assertEqual(d["a3"], b"aaa")
 
     def test_mget_nonexistant_key(self):
         self.c.store("b1", "b")
         self.c.store("b3", "bbb")
         d = self.c.mget(["b1", "b2", "b3"])
-        self.assertEqual(d["b1"], "b")
+        self.assertEqual(d["b1"], b"b")
         self.assertTrue("b2" not in d)
-        self.assertEqual(d["b3"], "bbb")
+        self.assertEqual(d["b3"], b"bbb")
 
     def test_mget_expiry(self):
         self.c.store("c1", "c")
@@ -259,9 +755,9 @@ class SimpleCacheTest(TestCase):
         self.c.store("c3", "ccc")
         time.sleep(1.1)
         d = self.c.mget(["c1", "c2", "c3"])
-        self.assertEqual(d["c1"], "c")
+        self.assertEqual(d["c1"], b"c")
         self.assertTrue("c2" not in d)
-        self.assertEqual(d["c3"], "ccc")
+        self.assertEqual(d["c3"], b"ccc")
 
     def test_mget_json(self):
         payload_a1 = {"example_a1": "data_a1"}
@@ -282,17 +778,215 @@ class SimpleCacheTest(TestCase):
         self.assertTrue("json_b2" not in d)
         self.assertEqual(d["json_b3"], payload_b3)
 
+    def test_store_many(self):
+        c = self.cache(100, namespace="many")
+        self.assertEqual(c.store_many(dict(("k%d" % i, "v%d" % i) for i in range(50)),
+                                      chunk_size=7), 50)
+        self.assertEqual(len(c), 50)
+        self.assertEqual(c.mget(["k0", "k49", "k50"]), {"k0": b"v0", "k49": b"v49"})
+        c.store_many_json([("j1", {"a": 1}), ("j2", [1, 2])], expire=1)
+        self.assertEqual(c.mget_json(["j1", "j2"]), {"j1": {"a": 1}, "j2": [1, 2]})
+        time.sleep(1.1)
+        self.assertEqual(c.mget_json(["j1", "j2"]), None)
+        c.flush()
+
+    def test_store_many_limit(self):
+        self.c.store_many(dict(("k%d" % i, "v") for i in range(25)), chunk_size=5)
+        self.assertEqual(len(self.c), 10)
+
+    def test_store_many_batch_at_limit(self):
+        for policy in ('random', 'lru'):
+            c = self.cache(10, namespace="batch-" + policy, eviction_policy=policy)
+            c.store_many(("k%d" % i, "v") for i in range(10))
+            # The oldest keys are stored again, along with a repeated new key.
+            self.assertEqual(c.store_many([("k0", "v0"), ("new", "a"), ("k1", "v1"),
+                                           ("new", "b")]), 4)
+            self.assertEqual(len(c), 10)
+            self.assertEqual(c.mget(["k0", "k1", "new"]),
+                             {"k0": b"v0", "k1": b"v1", "new": b"b"})
+            c.flush()
+
+    def test_mget_pickle(self):
+        self.c.store_many_pickle({"p1": ComplexNumber(1, 2), "p2": ComplexNumber(3, 4)})
+        d = self.c.mget_pickle(["p1", "p2", "p3"])
+        self.assertEqual(d, {"p1": ComplexNumber(1, 2), "p2": ComplexNumber(3, 4)})
+
     def test_invalidate_key(self):
         self.c.store("d1", "d")
         self.c.store("d2", "dd")
         self.c.store("d3", "ddd")
         self.c.invalidate("d2")
         d = self.c.mget(["d1", "d2", "d3"])
-        self.assertEqual(d["d1"], "d")
+        self.assertEqual(d["d1"], b"d")
         self.assertTrue("d2" not in d)
-        self.assertEqual(d["d3"], "ddd")
+        self.assertEqual(d["d3"], b"ddd")
+
+    def test_metrics(self):
+        c = self.cache(2, namespace="metrics", metrics=True)
+        c.store("m1", "abc")
+        c.store_pickle("m2", 1)
+        c.store("m3", "abcd")
+        self.assertEqual(c.get("m3"), b"abcd")
+        self.assertRaises(CacheMissException, c.get, "nope")
+        self.assertEqual(c.metrics['stores'], 3)
+        self.assertEqual(c.metrics['evictions'], 1)
+        self.assertEqual(c.metrics['hits'], 1)
+        self.assertEqual(c.metrics['misses'], 1)
+        self.assertEqual(c.metrics['bytes_read'], 4)
+        self.assertEqual(c.metrics.histograms['redis_seconds'].count, 5)
+        self.assertEqual(c.metrics.histograms['serialize_seconds'].count, 1)
+        c.flush()
+
+    def test_decorator_without_metrics(self):
+        @cache_it(cache=self.c, metrics=False)
+        def double(n):
+            return n * 2
+        self.assertEqual(double(2), double(2))
+        self.assertEqual(double.stats, {})
+        self.assertEqual(double.stats.snapshot(), {'latency': {}})
 
     def tearDown(self):
         self.c.flush()
 
-main()
+
+class KeyBuilderTest(TestCase):
+
+    def test_canonical_key(self):
+        self.assertEqual(canonical_key({"a": 1, "b": [1, 2]}),
+                         canonical_key({"b": [1, 2], "a": 1}))
+        keys = [canonical_key(value) for value in
+                (1, 1.0, "1", True, None, (1,), [1], ({"1": 1},), (ComplexNumber(1, 2),))]
+        self.assertEqual(len(set(keys)), len(keys))
+
+    def test_kwargs_order(self):
+        def f(**kwargs):
+            pass
+        builder = KeyBuilder(f, "ns")
+        self.assertEqual(builder((), {"a": 1, "b": 2}), builder((), {"b": 2, "a": 1}))
+        self.assertTrue(builder((1,), {}).startswith("ns:f:"))
+
+    def test_text_types(self):
+        def f(*args, **kwargs):
+            pass
+        for builder in (KeyBuilder(f), KeyBuilder(f, hash="md5")):
+            self.assertEqual(builder(("a", 1), {}), builder((u"a", 1), {}))
+            self.assertEqual(builder((), {"x": ["a"]}), builder((), {u"x": [u"a"]}))
+            self.assertNotEqual(builder((1,), {}), builder((1.0,), {}))
+        self.assertEqual(canonical_key(("a",)), canonical_key((u"a",)))
+
+    def test_hash_and_key_func(self):
+        def f(user_id, verbose=False):
+            pass
+        self.assertEqual(len(KeyBuilder(f, hash="md5")((1,), {})), len("f:") + 32)
+        builder = KeyBuilder(f, key_func=lambda user_id, verbose=False: str(user_id))
+        self.assertEqual(builder((42,), {"verbose": True}), "f:42")
+        self.assertRaises(ValueError, KeyBuilder, f, hash="crc")
+
+
+class CircuitBreakerTest(TestCase):
+
+    def test_transitions(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        self.assertFalse(breaker.record_failure())
+        breaker.record_success()
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, 'open')
+        # a round trip started before the breaker opened
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'open')
+        breaker.half_open()
+        self.assertFalse(breaker.record_failure())
+        self.assertEqual(breaker.state, 'open')
+        breaker.half_open()
+        breaker.record_success()
+        self.assertTrue(breaker.closed)
+
+    def test_unreachable_server(self):
+        c = SimpleCache(port=1, timeout=0.1, reconnect_interval=60)
+        self.assertFalse(c.available())
+
+        @cache_it(cache=c)
+        def add(a, b):
+            return a + b
+        self.assertEqual(add(1, 2), 3)
+
+
+class CostPolicyTest(TestCase):
+
+    def test_ttl(self):
+        policy = CostPolicy(min_compute_time=0.01, min_cost_per_byte=1e-7)
+        self.assertEqual(policy.ttl(0.001, 10, 60), None)
+        self.assertEqual(policy.ttl(0.5, 10 ** 8, 60), None)
+        self.assertEqual(policy.ttl(0.5, 100, 60), 60)
+        policy = CostPolicy(scale_ttl=True, reference_cost_per_byte=1e-3, min_ttl=2)
+        self.assertEqual(policy.ttl(0.05, 100, 60), 30)
+        self.assertEqual(policy.ttl(1, 100, 60), 60)
+        self.assertEqual(policy.ttl(1e-6, 100, 60), 2)
+        self.assertEqual(policy.ttl(1e-6, 100, 0), 0)
+        self.assertEqual(CostPolicy(scale_ttl=True, reference_cost_per_byte=1e-3,
+                                    max_ttl=600).ttl(1, 100, 60), 600)
+
+
+class LocalCacheTest(BackendTestCase):
+
+    def test_lru_eviction(self):
+        local = LocalCache(maxsize=2)
+        local.set("a", 1)
+        local.set("b", 2)
+        local.get("a")
+        local.set("c", 3)
+        self.assertEqual(local.get("a"), 1)
+        self.assertEqual(local.get("c"), 3)
+        self.assertEqual(len(local), 2)
+        self.assertFalse(local.get("b") == 2)
+
+    def test_local_expire(self):
+        local = LocalCache(expire=1)
+        local.set("a", 1)
+        time.sleep(1.1)
+        self.assertFalse(local.get("a") == 1)
+
+    def test_local_hit_skips_redis(self):
+        c = self.cache(10, local_cache_size=10)
+        c.store_pickle("foo", ComplexNumber(1, 2))
+        self.assertEqual(c.get_pickle("foo"), ComplexNumber(1, 2))
+        c.connection.delete(c.make_key("foo"))
+        self.assertEqual(c.get_pickle("foo"), ComplexNumber(1, 2))
+        c.invalidate("foo")
+        self.assertRaises(CacheMissException, c.get_pickle, "foo")
+        c.flush()
+
+    def test_cross_process_invalidation(self):
+        c1 = self.cache(10, local_cache_size=10)
+        c2 = self.cache(10, local_cache_size=10)
+        time.sleep(0.1)  # let both listeners subscribe
+        c1.store("foo", "bar")
+        self.assertEqual(c2.get("foo"), b"bar")
+        c1.store("foo", "baz")
+        time.sleep(0.1)
+        self.assertEqual(c2.get("foo"), b"baz")
+        c1.expire_namespace("foo")
+        c1.flush()
+        time.sleep(0.1)
+        self.assertRaises(CacheMissException, c2.get, "foo")
+
+
+class MemorySimpleCacheTest(SimpleCacheTest):
+    backend = 'memory'
+
+
+class SharedMemorySimpleCacheTest(SimpleCacheTest):
+    backend = SHARED_BACKEND
+
+
+class MemoryLocalCacheTest(LocalCacheTest):
+    backend = 'memory'
+
+
+class SharedMemoryLocalCacheTest(LocalCacheTest):
+    backend = SHARED_BACKEND
+
+
+if __name__ == '__main__':
+    main()
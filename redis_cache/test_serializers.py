@@ -0,0 +1,43 @@
+#Serializers Tests
+#~~~~~~~~~~~~~~~~~
+from unittest import TestCase, main
+import json
+import pickle
+
+from redis_cache.serializers import Codec, formats, register_format
+
+
+class CodecTest(TestCase):
+
+    payload = {"name": "foo", "values": list(range(500))}
+
+    def test_round_trip(self):
+        for format in formats():
+            for compression in (None, 'zlib'):
+                codec = Codec(format, compression, compress_threshold=100)
+                self.assertEqual(codec.loads(codec.dumps(self.payload)), self.payload)
+
+    def test_compress_threshold(self):
+        plain = Codec('pickle').dumps(self.payload)
+        self.assertTrue(len(Codec('pickle', 'zlib').dumps(self.payload)) < len(plain))
+        self.assertEqual(len(Codec('pickle', 'zlib', compress_threshold=10 ** 6)
+                             .dumps(self.payload)), len(plain))
+
+    def test_reads_any_writer_format(self):
+        reader = Codec('pickle')
+        for writer in (Codec('json', 'zlib', 10), Codec('marshal')):
+            self.assertEqual(reader.loads(writer.dumps(self.payload)), self.payload)
+
+    def test_legacy_values(self):
+        self.assertEqual(Codec().loads(pickle.dumps(self.payload)), self.payload)
+        self.assertEqual(Codec().loads(pickle.dumps(self.payload, 2)), self.payload)
+        self.assertEqual(Codec(legacy=json.loads).loads(json.dumps(self.payload)),
+                         self.payload)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, Codec, 'yaml')
+        self.assertRaises(ValueError, Codec, 'pickle', 'bz2')
+        self.assertRaises(ValueError, register_format, 'yaml', 8, None, None)
+
+if __name__ == '__main__':
+    main()
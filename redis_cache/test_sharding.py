@@ -0,0 +1,128 @@
+#Sharding Tests
+#~~~~~~~~~~~~~~
+# ShardedCacheTest needs several redis servers, listed as comma separated
+# ports in REDIS_SHARD_PORTS, e.g. REDIS_SHARD_PORTS=6379,6380,6381
+from unittest import TestCase, main, skipUnless
+import os
+
+from redis_cache.backends import MemoryBackend
+from redis_cache.rediscache import CacheMissException, cache_it, cache_it_batch
+from redis_cache.sharding import HashRing, ShardedCache, _node_config
+
+SHARD_PORTS = [int(port) for port in
+               os.environ.get('REDIS_SHARD_PORTS', '').split(',') if port]
+
+
+class HashRingTest(TestCase):
+
+    keys = [u'key:%d' % i for i in range(10000)]
+
+    def test_balance(self):
+        ring = HashRing(['a:1', 'b:1', 'c:1', 'd:1'])
+        counts = {}
+        for key in self.keys:
+            node = ring.get_node(key)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(set(counts), set(['a:1', 'b:1', 'c:1', 'd:1']))
+        for count in counts.values():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_adding_node_remaps_a_share(self):
+        ring = HashRing(['a:1', 'b:1', 'c:1', 'd:1'])
+        before = dict((key, ring.get_node(key)) for key in self.keys)
+        ring.add_node('e:1')
+        moved = [key for key in self.keys if ring.get_node(key) != before[key]]
+        self.assertTrue(len(moved) < len(self.keys) * 0.3, len(moved))
+        self.assertTrue(all(ring.get_node(key) == 'e:1' for key in moved))
+        ring.remove_node('e:1')
+        self.assertEqual(dict((key, ring.get_node(key)) for key in self.keys), before)
+
+
+class NodeConfigTest(TestCase):
+
+    def test_node_strings(self):
+        self.assertEqual(_node_config('cache1:6380/2'),
+                         (u'cache1:6380/2', {'host': 'cache1', 'port': 6380, 'db': 2}))
+        self.assertEqual(_node_config('cache1'),
+                         (u'cache1:6379', {'host': 'cache1', 'port': 6379}))
+        self.assertEqual(_node_config('cache1/3'),
+                         (u'cache1:6379/3', {'host': 'cache1', 'port': 6379, 'db': 3}))
+        self.assertEqual(_node_config(':6380'),
+                         (u'localhost:6380', {'host': 'localhost', 'port': 6380}))
+
+
+class ShardFailureTest(TestCase):
+
+    def test_down_node_only_misses_its_keys(self):
+        c = ShardedCache([{'name': 'up', 'backend': MemoryBackend()},
+                          {'name': 'down', 'host': '127.0.0.1', 'port': 1}],
+                         namespace="sharded")
+        self.assertTrue(c.available())
+        calls = []
+
+        @cache_it(cache=c)
+        def double(n):
+            calls.append(n)
+            return n * 2
+
+        @cache_it_batch(cache=c)
+        def squares(ids):
+            return [i * i for i in ids]
+
+        down = [i for i in range(20) if not c.available(double.cache_key(i))]
+        self.assertTrue(0 < len(down) < 20)
+        self.assertEqual([double(i) for i in range(20)], [double(i) for i in range(20)])
+        self.assertEqual(len(calls), 20 + len(down))
+        self.assertEqual(double.stats['hits'], 20 - len(down))
+        self.assertEqual(squares(range(20)), squares(range(20)))
+        self.assertEqual(squares.stats['hits'] + squares.stats['misses'], 40)
+        self.assertTrue(0 < squares.stats['hits'] < 20)
+        c.close()
+
+
+@skipUnless(len(SHARD_PORTS) > 1, "REDIS_SHARD_PORTS lists less than 2 ports")
+class ShardedCacheTest(TestCase):
+
+    def setUp(self):
+        self.c = ShardedCache([('localhost', port) for port in SHARD_PORTS],
+                              limit=100, namespace="sharded")
+        self.c.flush()
+
+    def tearDown(self):
+        self.c.flush()
+        self.c.close()
+
+    def test_store_retrieve(self):
+        for i in range(50):
+            self.c.store("k%d" % i, "v%d" % i)
+        self.assertEqual(len(self.c), 50)
+        self.assertTrue(all(len(shard) > 0 for shard in self.c.shards.values()))
+        self.assertEqual(self.c.get("k7"), "v7")
+        self.assertTrue("k7" in self.c)
+        self.c.invalidate("k7")
+        self.assertRaises(CacheMissException, self.c.get, "k7")
+        found = self.c.mget(["k%d" % i for i in range(10)])
+        self.assertEqual(len(found), 9)
+        self.assertEqual(found["k3"], "v3")
+
+    def test_limit(self):
+        self.c.store_many(dict(("k%d" % i, i) for i in range(300)))
+        self.assertTrue(len(self.c) <= 100 + len(SHARD_PORTS))
+
+    def test_decorators(self):
+        @cache_it(cache=self.c, single_flight=True)
+        def double(n):
+            return n * 2
+
+        @cache_it_batch(cache=self.c)
+        def squares(ids):
+            return [i * i for i in ids]
+
+        self.assertEqual([double(i) for i in range(10)], [double(i) for i in range(10)])
+        self.assertEqual(double.stats['hits'], 10)
+        self.assertEqual(squares(range(20)), squares(range(20)))
+        self.assertEqual(squares.stats['hits'], 20)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#Snapshot Tests
+#~~~~~~~~~~~~~~
+from io import BytesIO
+from unittest import TestCase, main
+import os
+import tempfile
+
+from redis_cache.backends import SharedMemoryBackend
+from redis_cache.rediscache import CacheMissException, SimpleCache
+from redis_cache.snapshot import CHUNK, ENTRY, SnapshotReader, SnapshotWriter
+
+
+class SnapshotFormatTest(TestCase):
+
+    def test_round_trip(self):
+        f = BytesIO()
+        writer = SnapshotWriter(f, created=1000.0)
+        writer.write(CHUNK, u'0', 5000, None, b'\x00\x01chunk')
+        writer.write(ENTRY, u'k\xe9y', -1, 2.5, b'payload')
+        f.seek(0)
+        reader = SnapshotReader(f)
+        self.assertEqual(reader.created, 1000.0)
+        self.assertEqual(list(reader), [
+            (CHUNK, u'0', 5000, None, b'\x00\x01chunk'),
+            (ENTRY, u'k\xe9y', -1, 2.5, b'payload')])
+
+    def test_truncated(self):
+        f = BytesIO()
+        SnapshotWriter(f).write(ENTRY, u'key', -1, None, b'payload')
+        reader = SnapshotReader(BytesIO(f.getvalue()[:-2]))
+        self.assertRaises(ValueError, list, reader)
+        self.assertRaises(ValueError, SnapshotReader, BytesIO(b'not a snapshot!!'))
+
+
+class SnapshotTest(TestCase):
+    backend = None
+
+    def test_export_import(self):
+        source = SimpleCache(100, namespace="snapshot-source", eviction_policy='lru',
+                             chunk_threshold=100, chunk_size=40, backend=self.backend)
+        target = SimpleCache(100, namespace="snapshot-target", eviction_policy='lru',
+                             backend=self.backend)
+        source.flush()
+        target.flush()
+        source.store_many(dict(("k%d" % i, "v%d" % i) for i in range(50)), expire=60)
+        source.store("forever", "young", expire=0)
+        source.store("big", b"x" * 150)
+        f = BytesIO()
+        self.assertEqual(source.export_snapshot(f, chunk_size=10), 52)
+        f.seek(0)
+        self.assertEqual(target.import_snapshot(f, chunk_size=7), 52)
+        source.flush()
+        self.assertEqual(len(target), 52)
+        self.assertEqual(target.get("k7"), b"v7")
+        self.assertEqual(target.get("big"), b"x" * 150)
+        self.assertTrue(0 < target.isexpired("k7") <= 60000)
+        self.assertEqual(target.connection.pttl(target.make_key("forever")), -1)
+        self.assertEqual(target.connection.zcard(target.get_scores_name()), 52)
+        chunks = [name for name in target.connection.keys("*big\x00*")]
+        self.assertEqual(len(chunks), 4)
+        self.assertTrue(all(name.startswith(target.make_key("big").encode('utf-8'))
+                            for name in chunks))
+        target.flush()
+        self.assertEqual(target.connection.keys("*big\x00*"), [])
+        self.assertRaises(CacheMissException, target.get, "k7")
+
+
+class MemorySnapshotTest(SnapshotTest):
+    backend = 'memory'
+
+
+class SharedMemorySnapshotTest(SnapshotTest):
+    backend = SharedMemoryBackend(os.path.join(tempfile.mkdtemp(), 'test.sqlite3'))
+
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,12 @@ setup(
     packages=['redis_cache'],
     long_description=openf("README.md").read(),
     install_requires=[line.strip() for line in openf("requirements.txt") if line.strip()],
+    extras_require={
+        "asyncio": ["redis>=4.2.0"],
+    },
+    entry_points={
+        "console_scripts": ["redis-simple-cache-snapshot = redis_cache.snapshot:main"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Topic :: Utilities",